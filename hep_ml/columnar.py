@@ -0,0 +1,215 @@
+"""
+`columnar` contains ColumnarDataset - a lightweight replacement for pandas.DataFrame
+used to train and evaluate classifiers on big samples.
+
+Each feature is stored as a separate one-dimensional array (float32 by default),
+arrays may be numpy.memmap-s of .npy files, so the data is not loaded into memory at all.
+Selection of columns (i.e. train_variables, uniform_variables) never copies data,
+selection of rows by indices is lazy: only requested columns are copied when accessed.
+
+Dense two-dimensional matrix (needed by sklearn) is built by numpy.array(dataset),
+this is done in one pass, without intermediate copies.
+
+Memory-mapped dataset (opened by `load`) is pickled as reference to the directory,
+so passing it to other processes (or cluster engines with shared filesystem) doesn't copy the data.
+"""
+from __future__ import division, print_function, absolute_import
+
+import os
+import json
+import numbers
+from collections import OrderedDict
+import numpy
+import pandas
+from six import string_types
+
+__author__ = 'Alex Rogozhnikov'
+
+__all__ = ['ColumnarDataset']
+
+_META_FILE = 'columns.json'
+
+
+def _column_filename(directory, index):
+    return os.path.join(directory, 'column_{}.npy'.format(index))
+
+
+class ColumnarDataset(object):
+    def __init__(self, columns, indices=None):
+        """
+        Dataset with named columns, each column is stored as separate array.
+        :param columns: OrderedDict {name: numpy.array of shape [n_total_samples]} (or list of pairs),
+            the arrays are used as is (without copying)
+        :param indices: None or numpy.array with indices of rows that are selected from arrays
+        """
+        self._columns = OrderedDict(columns)
+        lengths = set(len(column) for column in self._columns.values())
+        assert len(lengths) <= 1, 'columns have different lengths'
+        self._n_total = lengths.pop() if len(lengths) > 0 else 0
+        if indices is not None:
+            indices = numpy.asarray(indices)
+            if indices.dtype == bool:
+                assert len(indices) == self._n_total, 'wrong length of boolean mask'
+                indices = numpy.flatnonzero(indices)
+        self._indices = indices
+        # (directory, mmap_mode) if columns are memory-mapped from directory
+        self._source = None
+
+    def _derive(self, columns, indices):
+        result = ColumnarDataset(columns, indices=indices)
+        result._source = self._source
+        return result
+
+    # region Creating and storing
+
+    @staticmethod
+    def from_dataframe(data, dtype='float32', directory=None):
+        """
+        Converts pandas.DataFrame (or numpy.array, or dict with columns) to columnar format.
+        :param dtype: the type of stored columns, if None, types are kept
+        :param directory: str or None, if not None, the columns are written into this directory
+            and the result is memory-mapped from it.
+        :rtype: ColumnarDataset
+        """
+        data = pandas.DataFrame(data)
+        columns = OrderedDict()
+        for name in data.columns:
+            values = data[name].values
+            columns[name] = values.astype(dtype) if dtype is not None else values
+        result = ColumnarDataset(columns)
+        if directory is not None:
+            result.save(directory)
+            result = ColumnarDataset.load(directory)
+        return result
+
+    @staticmethod
+    def create_empty(directory, column_names, length, dtype='float32'):
+        """
+        Creates memory-mapped dataset filled with zeros, which can be later written column-by-column
+        (useful when the data is produced by parts).
+        :rtype: ColumnarDataset, columns are opened in read-write mode.
+        """
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        columns = OrderedDict()
+        for index, name in enumerate(column_names):
+            columns[name] = numpy.lib.format.open_memmap(_column_filename(directory, index), mode='w+',
+                                                         dtype=dtype, shape=(length, ))
+        with open(os.path.join(directory, _META_FILE), 'w') as meta_file:
+            json.dump({'columns': [str(name) for name in column_names], 'length': length}, meta_file)
+        return ColumnarDataset(columns)
+
+    def save(self, directory):
+        """Writes the dataset (only selected rows) into directory, each column is stored in separate .npy file"""
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        for index, name in enumerate(self.columns):
+            numpy.save(_column_filename(directory, index), self[name])
+        with open(os.path.join(directory, _META_FILE), 'w') as meta_file:
+            json.dump({'columns': [str(name) for name in self.columns], 'length': len(self)}, meta_file)
+
+    @staticmethod
+    def load(directory, mmap_mode='r'):
+        """
+        Loads the dataset, written by `save`.
+        :param mmap_mode: passed to numpy.load, if None, the data is read into memory
+        :rtype: ColumnarDataset
+        """
+        with open(os.path.join(directory, _META_FILE)) as meta_file:
+            meta = json.load(meta_file)
+        columns = OrderedDict()
+        for index, name in enumerate(meta['columns']):
+            columns[name] = numpy.load(_column_filename(directory, index), mmap_mode=mmap_mode)
+        result = ColumnarDataset(columns)
+        if mmap_mode is not None:
+            result._source = (os.path.abspath(directory), mmap_mode)
+        return result
+
+    def __reduce__(self):
+        if self._source is None:
+            return ColumnarDataset, (self._columns, self._indices)
+        directory, mmap_mode = self._source
+        return _load_columns, (directory, mmap_mode, self.columns, self._indices)
+
+    # endregion
+
+    # region pandas-like interface
+
+    @property
+    def columns(self):
+        return list(self._columns.keys())
+
+    def __len__(self):
+        if self._indices is None:
+            return self._n_total
+        return len(self._indices)
+
+    @property
+    def shape(self):
+        return len(self), len(self._columns)
+
+    def __contains__(self, name):
+        return name in self._columns
+
+    def _get_column(self, name):
+        column = self._columns[name]
+        if self._indices is None:
+            return column
+        return numpy.take(column, self._indices)
+
+    def __getitem__(self, key):
+        """
+        dataset['mass'] returns one column as numpy.array (no copy if rows were not selected),
+        dataset[['mass', 'pt']] returns ColumnarDataset with the same arrays
+        """
+        if isinstance(key, string_types) or isinstance(key, numbers.Number):
+            return self._get_column(key)
+        key = list(key)
+        for name in key:
+            assert name in self._columns, 'Dataset is missing {} column'.format(name)
+        return self._derive([(name, self._columns[name]) for name in key], indices=self._indices)
+
+    def take(self, indices):
+        """
+        Selects rows by indices (or boolean mask), the data is not copied
+        :rtype: ColumnarDataset
+        """
+        indices = numpy.asarray(indices)
+        if indices.dtype == bool:
+            assert len(indices) == len(self), 'wrong length of boolean mask'
+            indices = numpy.flatnonzero(indices)
+        if self._indices is not None:
+            indices = self._indices[indices]
+        return self._derive(self._columns, indices=indices)
+
+    def get_values(self, dtype='float32', out=None):
+        """
+        Returns dense C-ordered matrix of shape [n_samples, n_features], built in one pass
+        :param out: None or preallocated numpy.array of shape [n_samples, n_features]
+        """
+        if out is None:
+            out = numpy.empty(self.shape, dtype=dtype)
+        assert out.shape == self.shape, 'wrong shape of output array'
+        for i, name in enumerate(self._columns):
+            out[:, i] = self._get_column(name)
+        return out
+
+    @property
+    def values(self):
+        return self.get_values()
+
+    def __array__(self, dtype=None):
+        return self.get_values(dtype='float32' if dtype is None else dtype)
+
+    def to_dataframe(self):
+        return pandas.DataFrame(OrderedDict([(name, self._get_column(name)) for name in self.columns]))
+
+    # endregion
+
+
+def _load_columns(directory, mmap_mode, names, indices):
+    """Restores pickled memory-mapped dataset"""
+    result = ColumnarDataset.load(directory, mmap_mode=mmap_mode)[names]
+    if indices is not None:
+        result = result.take(indices)
+    return result
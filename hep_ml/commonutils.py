@@ -7,15 +7,26 @@ from __future__ import print_function, division, absolute_import
 
 import math
 import io
+import sys
 import numbers
+import multiprocessing
 import numpy
 import pandas
+from multiprocessing.pool import ThreadPool
 from numpy.random.mtrand import RandomState
 from scipy.special import expit
 import sklearn.cross_validation
 from sklearn.utils.validation import check_arrays
 from sklearn.neighbors.unsupervised import NearestNeighbors
 
+from .quantile_utils import weighted_percentiles_2d
+from .columnar import ColumnarDataset
+
+try:
+    from scipy.sparse import _sparsetools as sparsetools
+except ImportError:
+    from scipy.sparse import sparsetools
+
 __author__ = "Alex Rogozhnikov"
 
 
@@ -125,20 +136,25 @@ def train_test_split(*arrays, **kw_args):
 def weighted_percentile(array, percentiles, sample_weight=None, array_sorted=False, old_style=False):
     """ Very close to numpy.precentile, but supports weights.
     NOTE: percentiles should be in [0, 1]!
-    :param array: numpy.array with data
+    :param array: numpy.array with data, if two-dimensional,
+        percentiles are computed for each row (see quantile_utils.weighted_percentiles_2d)
     :param percentiles: array-like with many percentiles
     :param sample_weight: array-like of the same length as `array`
     :param array_sorted: bool, if True, then will avoid sorting
     :param old_style: if True, will correct output to be consistent with numpy.percentile.
     :return: numpy.array with computed percentiles.
     """
-    array = numpy.array(array)
-    percentiles = numpy.array(percentiles)
+    array = numpy.asarray(array)
+    if array.ndim == 2:
+        return weighted_percentiles_2d(array, percentiles, sample_weight=sample_weight,
+                                       arrays_sorted=array_sorted, old_style=old_style)
+    percentiles = numpy.asarray(percentiles)
     sample_weight = check_sample_weight(array, sample_weight)
     assert numpy.all(percentiles >= 0) and numpy.all(percentiles <= 1), 'Percentiles should be in [0, 1]'
 
     if not array_sorted:
-        array, sample_weight = reorder_by_first(array, sample_weight)
+        order = numpy.argsort(array)
+        array, sample_weight = array[order], sample_weight[order]
 
     weighted_quantiles = numpy.cumsum(sample_weight) - 0.5 * sample_weight
     if old_style:
@@ -176,15 +192,16 @@ def compute_cut_for_efficiency(efficiency, mask, y_pred, sample_weight=None):
     """ Computes such cut(s), that provide given signal efficiency.
     :type efficiency: float or numpy.array with target efficiencies, shape = [n_effs]
     :type mask: array-like, shape = [n_samples], True for needed classes
-    :type y_pred: array-like, shape = [n_samples], predictions or scores (float)
+    :type y_pred: array-like, shape = [n_samples], predictions or scores (float),
+        or shape = [n_stages, n_samples], then cuts are computed for each row
     :type sample_weight: None | array-like, shape = [n_samples]
-    :return: float or numpy.array, shape = [n_effs]
+    :return: float or numpy.array, shape = [n_effs] (or [n_stages, n_effs])
     """
     sample_weight = check_sample_weight(mask, sample_weight)
-    assert len(mask) == len(y_pred), 'lengths are different'
+    assert len(mask) == numpy.shape(y_pred)[-1], 'lengths are different'
     efficiency = numpy.array(efficiency)
     is_signal = mask > 0.5
-    y_pred, sample_weight = y_pred[is_signal], sample_weight[is_signal]
+    y_pred, sample_weight = numpy.asarray(y_pred)[..., is_signal], sample_weight[is_signal]
     return weighted_percentile(y_pred, 1. - efficiency, sample_weight=sample_weight)
 
 
@@ -193,9 +210,10 @@ def compute_bdt_cut(target_efficiency, y_true, y_pred, sample_weight=None):
     :type target_efficiency: float from 0 to 1 or numpy.array with floats in [0,1]
     :type y_true: numpy.array, of zeros and ones, shape = [n_samples]
     :type y_pred: numpy.array, prediction probabilities returned by classifier, shape = [n_samples]
+        or shape = [n_stages, n_samples], then cuts are computed for each row
     """
-    assert len(y_true) == len(y_pred), "different size"
-    signal_proba = y_pred[y_true > 0.5]
+    assert len(y_true) == numpy.shape(y_pred)[-1], "different size"
+    signal_proba = numpy.asarray(y_pred)[..., y_true > 0.5]
     percentiles = 1. - target_efficiency
     sig_weights = None if sample_weight is None else sample_weight[y_true > 0.5]
     return weighted_percentile(signal_proba, percentiles, sample_weight=sig_weights)
@@ -216,9 +234,9 @@ def computeSignalKnnIndices(uniform_variables, dataframe, is_signal, n_neighbors
     signal_indices = numpy.where(is_signal)[0]
     for variable in uniform_variables:
         assert variable in dataframe.columns, "Dataframe is missing %s column" % variable
-    uniforming_features_of_signal = numpy.array(dataframe.ix[is_signal, uniform_variables])
-    neighbours = NearestNeighbors(n_neighbors=n_neighbors, algorithm='kd_tree').fit(uniforming_features_of_signal)
-    _, knn_signal_indices = neighbours.kneighbors(dataframe[uniform_variables])
+    uniforming_features = numpy.array(dataframe[list(uniform_variables)])
+    neighbours = NearestNeighbors(n_neighbors=n_neighbors, algorithm='kd_tree').fit(uniforming_features[is_signal])
+    _, knn_signal_indices = neighbours.kneighbors(uniforming_features)
     return numpy.take(signal_indices, knn_signal_indices)
 
 
@@ -280,6 +298,40 @@ def indices_of_values(array):
         yield sorted_array[limits[i]], indices[limits[i]: limits[i + 1]]
 
 
+def compute_segments(group_ids):
+    """Precomputes grouping of events for segment reductions:
+    events are ordered by group, each group is a continuous segment in this order.
+    :param group_ids: numpy.array of shape [n_samples], the group (i.e. event) of each element
+    :return: (order, starts, group_values), order - permutation ordering elements by group,
+        starts - positions in ordered array where segments start, group_values - ids of groups for segments
+    """
+    group_ids = numpy.asarray(group_ids)
+    order = numpy.argsort(group_ids, kind='mergesort')
+    sorted_ids = group_ids[order]
+    starts = numpy.flatnonzero(numpy.concatenate([[True], sorted_ids[1:] != sorted_ids[:-1]])) \
+        if len(group_ids) > 0 else numpy.zeros(0, dtype=int)
+    return order, starts, sorted_ids[starts]
+
+
+def reduce_segments(values, order, starts, ufunc=numpy.maximum):
+    """Applies reduction to each segment, i.e. computes maximal value in each group
+    :param values: numpy.array of shape [n_samples]
+    :param order, starts: computed by `compute_segments`
+    :param ufunc: numpy binary ufunc (numpy.maximum, numpy.add, numpy.minimum, ...)
+    :return: numpy.array of shape [n_segments]
+    """
+    return ufunc.reduceat(numpy.take(values, order), starts)
+
+
+def spread_segments(segment_values, order, starts):
+    """Inverse to reduction: each element gets the value of its segment
+    :return: numpy.array of shape [n_samples]"""
+    lengths = numpy.diff(numpy.append(starts, len(order)))
+    result = numpy.empty(len(order), dtype=numpy.asarray(segment_values).dtype)
+    result[order] = numpy.repeat(segment_values, lengths)
+    return result
+
+
 def print_header(text, level=3):
     """
     Function to be used in notebooks to display headers not just plain text
@@ -291,18 +343,75 @@ def print_header(text, level=3):
     display_html("<h{level}>{header}</h{level}>".format(header=text, level=level), raw=True)
 
 
+def csr_dot(matrix, vector, out=None, n_threads=1):
+    """
+    Computes matrix.dot(vector) for sparse matrix in CSR format.
+    With n_threads > 1 rows are split into blocks with equal number of nonzero elements,
+    blocks are multiplied in parallel threads (sparse routines of scipy release GIL).
+    :param matrix: scipy.sparse.csr_matrix of shape [n_rows, n_columns]
+    :param vector: numpy.array of shape [n_columns]
+    :param out: None or numpy.array of shape [n_rows], where the result is written
+    :return: numpy.array of shape [n_rows]
+    """
+    n_rows, n_columns = matrix.shape
+    assert len(vector) == n_columns, 'wrong length of vector'
+    dtype = numpy.result_type(matrix.dtype, vector.dtype)
+    if out is None:
+        out = numpy.empty(n_rows, dtype=dtype)
+    assert out.shape == (n_rows, ), 'wrong shape of output'
+    if n_threads == 1 or out.dtype != dtype or not out.flags.c_contiguous or \
+            not hasattr(sparsetools, 'csr_matvec'):
+        out[:] = matrix.dot(vector)
+        return out
+
+    data = numpy.asarray(matrix.data, dtype=dtype)
+    vector = numpy.ascontiguousarray(vector, dtype=dtype)
+    bounds = numpy.searchsorted(matrix.indptr, numpy.linspace(0, matrix.nnz, n_threads + 1))
+    bounds[0], bounds[-1] = 0, n_rows
+    # csr_matvec adds the product to the output
+    out[:] = 0
+
+    def multiply_block(block):
+        start, stop = bounds[block], bounds[block + 1]
+        if stop > start:
+            sparsetools.csr_matvec(stop - start, n_columns, matrix.indptr[start:stop + 1], matrix.indices,
+                                   data, vector, out[start:stop])
+
+    pool = ThreadPool(n_threads)
+    try:
+        pool.map(multiply_block, range(n_threads))
+    finally:
+        pool.close()
+    return out
+
+
+def check_fork_start_method():
+    """
+    Processes which get data through module-level variables (instead of pickled arguments)
+    should be forked, this is checked here.
+    """
+    if hasattr(multiprocessing, 'get_start_method'):
+        start_method = multiprocessing.get_start_method()
+    else:
+        start_method = 'spawn' if sys.platform == 'win32' else 'fork'
+    assert start_method == 'fork', \
+        'processes should be started with fork (see multiprocessing.set_start_method), not {}'.format(start_method)
+
+
 def take_features(X, features):
     """
     Takes features from dataset.
-    :param X: numpy.array or pandas.DataFrame
-    :param features: list of strings (if pandas.DataFrame) or list of ints
-    :return: pandas.DataFrame or numpy.array with the same length.
+    :param X: numpy.array, pandas.DataFrame or ColumnarDataset
+    :param features: list of strings (if pandas.DataFrame or ColumnarDataset) or list of ints
+    :return: pandas.DataFrame, ColumnarDataset or numpy.array with the same length.
     NOTE: may return view to original data!
     """
     from numbers import Number
 
     are_strings = all([isinstance(feature, str) for feature in features])
     are_numbers = all([isinstance(feature, Number) for feature in features])
+    if isinstance(X, ColumnarDataset):
+        return X[features]
     if are_strings and isinstance(X, pandas.DataFrame):
         return X.ix[:, features]
     elif are_numbers:
@@ -311,21 +420,33 @@ def take_features(X, features):
         raise NotImplementedError("Can't take features {} from object of type {}".format(features, type(X)))
 
 
-def check_sample_weight(y_true, sample_weight):
+def check_sample_weight(y_true, sample_weight, dtype=numpy.float):
     """
     Checks the weights, returns normalized version
     :param y_true: numpy.array of shape [n_samples]
     :param sample_weight: array-like of shape [n_samples] or None
+    :param dtype: type of returned weights, float64 by default, numpy.float32 may be used to save memory
     :returns: numpy.array with weights of shape [n_samples]"""
     if sample_weight is None:
-        return numpy.ones(len(y_true), dtype=numpy.float)
+        return numpy.ones(len(y_true), dtype=dtype)
     else:
-        sample_weight = numpy.array(sample_weight, dtype=numpy.float)
+        sample_weight = numpy.array(sample_weight, dtype=dtype)
         assert len(y_true) == len(sample_weight), \
             "The length of weights is different: not {0}, but {1}".format(len(y_true), len(sample_weight))
         return sample_weight
 
 
+def get_float_dtype(*arrays):
+    """
+    Returns float32 if all passed arrays are float32 (float32 mode is turned on by passing float32 weights),
+    otherwise float64. None-s are ignored.
+    """
+    dtypes = set(numpy.asarray(array).dtype for array in arrays if array is not None)
+    if dtypes == {numpy.dtype(numpy.float32)}:
+        return numpy.dtype(numpy.float32)
+    return numpy.dtype(numpy.float64)
+
+
 def check_xyw(X, y, sample_weight=None):
     """
     Checks parameters of classifier / loss / metrics
@@ -338,8 +459,19 @@ def check_xyw(X, y, sample_weight=None):
     y = column_or_1d(y)
     sample_weight = check_sample_weight(y, sample_weight=sample_weight)
     assert len(X) == len(y), 'Lengths are different'
-    if not (isinstance(X, pandas.DataFrame) or (isinstance(X, numpy.ndarray))):
+    if not isinstance(X, (pandas.DataFrame, numpy.ndarray, ColumnarDataset)):
         X = numpy.array(X)
     return X, y, sample_weight
 
 
+def check_dataframe(X):
+    """
+    Datasets are passed to classifiers as is if those are pandas.DataFrame or ColumnarDataset,
+    other objects are converted to pandas.DataFrame
+    :rtype: pandas.DataFrame | ColumnarDataset
+    """
+    if isinstance(X, (pandas.DataFrame, ColumnarDataset)):
+        return X
+    return pandas.DataFrame(X)
+
+
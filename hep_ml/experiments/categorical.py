@@ -4,6 +4,7 @@ from hep_ml.commonutils import check_sample_weight
 from hep_ml.experiments import fasttree
 import numpy
 from sklearn.base import BaseEstimator, RegressorMixin, ClassifierMixin
+from sklearn.utils.random import check_random_state
 from collections import OrderedDict
 from hep_ml.losses import BinomialDevianceLossFunction
 from scipy.special import expit
@@ -102,6 +103,59 @@ class CategoricalTreeRegressor(fasttree.FastTreeRegressor):
             self._apply_node(X, leaf_indices, predictions, right, passed_right_subtree)
 
 
+def compute_hashed_categories(X, feature_ids, feature_coeffs, n_categories_power, shift_rows=False, out=None):
+    """
+    Computes hashed categories (sum of features multiplied by coefficients, modulo 2 ** n_categories_power)
+    for several attempts (combinations of features and coefficients) at once.
+    :param X: integer numpy.array of shape [n_samples, n_total_features],
+        column-ordered (numpy.asfortranarray) array is the fastest
+    :param feature_ids: int numpy.array of shape [n_attempts, n_features]
+    :param feature_coeffs: int numpy.array of shape [n_attempts, n_features]
+    :param shift_rows: bool, if True, categories of i-th attempt are shifted by i * 2 ** n_categories_power,
+        so the categories of all attempts can be passed to a single numpy.bincount
+    :param out: None or flat int numpy.array with at least n_attempts * n_samples elements, which is reused
+    :return: int numpy.array of shape [n_attempts, n_samples]
+    """
+    feature_ids = numpy.atleast_2d(feature_ids)
+    feature_coeffs = numpy.atleast_2d(feature_coeffs)
+    assert feature_ids.shape == feature_coeffs.shape, 'different shapes of feature_ids and feature_coeffs'
+    n_attempts, n_features = feature_ids.shape
+    if out is None:
+        out = numpy.empty(n_attempts * len(X), dtype=int)
+    result = out[:n_attempts * len(X)].reshape(n_attempts, len(X))
+    for position in range(n_features):
+        if numpy.isfortran(X):
+            # rows of transposed matrix are contiguous columns
+            feature_values = numpy.take(numpy.transpose(X), feature_ids[:, position], axis=0)
+        else:
+            feature_values = numpy.take(X, feature_ids[:, position], axis=1).T
+        if position == 0:
+            numpy.multiply(feature_values, feature_coeffs[:, position, numpy.newaxis], out=result)
+        else:
+            result += feature_values * feature_coeffs[:, position, numpy.newaxis]
+    n_categories = 2 ** n_categories_power
+    result &= n_categories - 1
+    if shift_rows:
+        result += numpy.arange(n_attempts)[:, numpy.newaxis] * n_categories
+    return result
+
+
+def bincount_rows(shifted_categories, n_categories, weights=None):
+    """
+    Computes numpy.bincount for each row of categories in a single call.
+    :param shifted_categories: int numpy.array of shape [n_rows, n_samples],
+        values of i-th row are in [i * n_categories, (i + 1) * n_categories), see `compute_hashed_categories`
+    :param weights: None or numpy.array of shape [n_rows, n_samples] or flat array with at least n_rows * n_samples
+        elements (i.e. weights repeated n_rows times, which may be reused)
+    :return: numpy.array of shape [n_rows, n_categories]
+    """
+    n_rows, n_samples = shifted_categories.shape
+    if weights is not None:
+        weights = numpy.ravel(weights)[:n_rows * n_samples]
+    result = numpy.bincount(numpy.ravel(shifted_categories), weights=weights, minlength=n_rows * n_categories)
+    return result.reshape(n_rows, n_categories)
+
+
 class SimpleCategoricalRegressor(BaseEstimator, RegressorMixin):
     def __init__(self, n_features=1, n_categories_power=7, regularization=1., n_attempts=1, method='pvalue'):
         """
@@ -117,31 +171,51 @@ class SimpleCategoricalRegressor(BaseEstimator, RegressorMixin):
 
     def fit(self, X, y, sample_weight, check_input=False):
         minlength = 2 ** self.n_categories_power
-        candidates = []
         mask = generate_slice(len(X), min(1., 100000. / len(X)))
-        testX, testY, testW = X[mask], y[mask], sample_weight[mask]
+        testX, testY = X[mask], y[mask]
+        if self.n_attempts * self.n_features > X.shape[1]:
+            # columns are taken many times, so they are made contiguous
+            testX = numpy.asfortranarray(testX)
+        attempts_ids = []
+        attempts_coeffs = []
         for _ in range(self.n_attempts):
-            feature_ids = numpy.random.choice(X.shape[1], size=self.n_features, replace=False)
-            feature_coeffs = numpy.random.choice([-1, 0, 0, 0, 2, 5, 7, 13, 51, 113, 227],
-                                                 size=self.n_features, replace=False)
-            categories = self._compute_categories_full(testX, feature_ids, feature_coeffs)
+            attempts_ids.append(numpy.random.choice(X.shape[1], size=self.n_features, replace=False))
+            attempts_coeffs.append(numpy.random.choice([-1, 0, 0, 0, 2, 5, 7, 13, 51, 113, 227],
+                                                       size=self.n_features, replace=False))
+        attempts_ids = numpy.array(attempts_ids)
+        attempts_coeffs = numpy.array(attempts_coeffs)
+
+        # attempts are evaluated by blocks, which fit into cache,
+        # buffers (and weights repeated for all attempts of block) are reused
+        block_size = min(self.n_attempts, max(1, 2 ** 18 // len(testX)))
+        categories_buffer = numpy.empty(block_size * len(testX), dtype=int)
+        qualities = numpy.zeros(self.n_attempts)
+        if self.method == 'pvalue':
+            repeated_y = numpy.tile(testY, block_size)
+        else:
+            assert self.method == 'cv'
+            denom = numpy.abs(testY) * (1 - numpy.abs(testY))
+            repeated_y = numpy.tile(testY[::2], block_size)
+            repeated_denom = numpy.tile(denom[::2], block_size)
+        for start in range(0, self.n_attempts, block_size):
+            block = slice(start, start + block_size)
+            categories = compute_hashed_categories(testX, attempts_ids[block], attempts_coeffs[block],
+                                                   self.n_categories_power, shift_rows=True, out=categories_buffer)
             if self.method == 'pvalue':
-                quality_nom = numpy.bincount(categories, weights=testY, minlength=minlength) ** 2
-                quality_denom = numpy.bincount(categories, minlength=minlength) + 3.
-                quality = (quality_nom / quality_denom).sum()
+                quality_nom = bincount_rows(categories, minlength, weights=repeated_y) ** 2
+                quality_denom = bincount_rows(categories, minlength) + 3.
+                qualities[block] = (quality_nom / quality_denom).sum(axis=1)
             else:
-                assert self.method == 'cv'
-                denom = numpy.abs(testY) * (1 - numpy.abs(testY))
-                values = 0.1 * numpy.bincount(categories[::2], weights=testY[::2], minlength=minlength)
-                values /= numpy.bincount(categories[::2], weights=denom[::2], minlength=minlength) + 1e-6
-                quality = testY[1::2] * values[categories[1::2]] - denom[1::2] * values[categories[1::2]] ** 2 / 2.
-                quality = quality.sum()
-
-            candidates.append([quality, feature_ids, feature_coeffs])
+                train_categories = numpy.ascontiguousarray(categories[:, ::2])
+                values = 0.1 * bincount_rows(train_categories, minlength, weights=repeated_y)
+                values /= bincount_rows(train_categories, minlength, weights=repeated_denom) + 1e-6
+                test_values = numpy.take(values, categories[:, 1::2])
+                quality = testY[1::2] * test_values - denom[1::2] * test_values ** 2 / 2.
+                qualities[block] = quality.sum(axis=1)
 
         # selecting best (with max quality)
-        candidates = sorted(candidates, key=lambda x: -x[0])
-        quality, self.feature_ids, self.feature_coeffs = candidates[0]
+        best = numpy.argmax(qualities)
+        self.feature_ids, self.feature_coeffs = attempts_ids[best], attempts_coeffs[best]
 
         # computing statistics
         feature_categories = self._compute_categories(X)
@@ -154,15 +228,8 @@ class SimpleCategoricalRegressor(BaseEstimator, RegressorMixin):
         self.categories_values = categories_sum / (categories_denominator + self.regularization)
         return self
 
-    def _compute_categories_full(self, X, feature_ids, feature_coeffs):
-        result = numpy.zeros(len(X), dtype='uint16')
-        for feature, coeff in zip(feature_ids, feature_coeffs):
-            result += X[:, feature] * coeff
-        result &= 2 ** self.n_categories_power - 1
-        return result
-
     def _compute_categories(self, X):
-        return self._compute_categories_full(X, self.feature_ids, self.feature_coeffs)
+        return compute_hashed_categories(X, self.feature_ids, self.feature_coeffs, self.n_categories_power)[0]
 
     def predict(self, X):
         feature_categories = self._compute_categories(X)
@@ -210,11 +277,13 @@ class ObliviousCategoricalRegressor(BaseEstimator, RegressorMixin):
         self.maps = []
         selection = generate_slice(len(X), self.subsample)
 
-        for feature, coeff in zip(self.feature_ids, self.feature_coeffs):
-            data = (X[selection, feature] * coeff) & self.mask
-
-            denom = numpy.bincount(data, minlength=n_categories) + 1e-10
-            nom = numpy.bincount(data, weights=y[selection], minlength=n_categories)
+        # each feature is hashed separately
+        hashed = compute_hashed_categories(X[selection], self.feature_ids[:, numpy.newaxis],
+                                           self.feature_coeffs[:, numpy.newaxis], self.n_categories_power,
+                                           shift_rows=True)
+        denoms = bincount_rows(hashed, n_categories) + 1e-10
+        noms = bincount_rows(hashed, n_categories, weights=numpy.tile(y[selection], self.n_features))
+        for nom, denom in zip(noms, denoms):
             mean = nom / denom
             percentiles = numpy.random.choice(mean, p=denom / denom.sum(), size=self.splits, replace=False)
             percentiles = numpy.unique(percentiles)
@@ -236,11 +305,13 @@ class ObliviousCategoricalRegressor(BaseEstimator, RegressorMixin):
         return self
 
     def _compute_categories(self, X):
-        result = numpy.zeros(len(X), dtype=int)
-        for feature, coeff, mapping in zip(self.feature_ids, self.feature_coeffs, self.maps):
-            result *= (self.splits + 1)
-            result += numpy.take(mapping, (X[:, feature] * coeff) & self.mask)
-        return result
+        hashed = compute_hashed_categories(X, self.feature_ids[:, numpy.newaxis],
+                                           self.feature_coeffs[:, numpy.newaxis], self.n_categories_power,
+                                           shift_rows=True)
+        # bin of each feature, the first feature is the most significant digit
+        bins = numpy.take(numpy.concatenate(self.maps), hashed)
+        multipliers = (self.splits + 1) ** numpy.arange(self.n_features - 1, -1, -1)
+        return multipliers.dot(bins)
 
     def predict(self, X):
         feature_categories = self._compute_categories(X)
@@ -248,60 +319,149 @@ class ObliviousCategoricalRegressor(BaseEstimator, RegressorMixin):
 
 
 class CategoricalLinearClassifier(BaseEstimator, ClassifierMixin):
-    def __init__(self, learning_rate=0.01, l1_reg=0., l2_reg=0., max_categories=128):
+    def __init__(self, learning_rate=0.01, l1_reg=0., l2_reg=0., max_categories=128,
+                 batch_size=None, adagrad=False, random_state=None):
         """
 
         :param learning_rate:
         :param l1_reg:
         :param l2_reg:
         :param max_categories: in each feature number should be in [0, n_categories)
+        :param batch_size: None or int, if None, each iteration is one step over all data,
+            otherwise data is split into chunks of batch_size consecutive events (so events should be shuffled),
+            at each iteration a step is done for each chunk, chunks are taken in random order.
+            Only categories present in a chunk are updated; regularization of the steps, at which category
+            was absent, is applied at once when the category appears again (and at the end of each pass).
+        :param adagrad: bool, if True, each category has its own learning rate,
+            which decreases as learning_rate / sqrt(1 + sum of squared previous steps)
+        :param random_state: used to shuffle chunks
         :return:
         """
         self.learning_rate = learning_rate
         self.l1_reg = l1_reg
         self.l2_reg = l2_reg
         self.max_categories = max_categories
+        self.batch_size = batch_size
+        self.adagrad = adagrad
+        self.random_state = random_state
 
-    def fit(self, X, y, sample_weight=None, iterations=100, loss=None):
+    def _check_input(self, X, y, sample_weight):
         X, y = check_arrays(X, y)
         sample_weight = check_sample_weight(y, sample_weight=sample_weight)
-        if loss is None:
-            loss = BinomialDevianceLossFunction()
-        loss.fit(X, y, sample_weight=sample_weight)
-        self.n_features = X.shape[1]
-        self.coeffs = numpy.zeros([self.n_features, self.max_categories], dtype='float')
         assert numpy.max(X) < self.max_categories
         assert numpy.min(X) >= 0
+        return X, y, sample_weight
+
+    def _initialize(self, n_features):
+        self.n_features = n_features
+        self.coeffs = numpy.zeros([self.n_features, self.max_categories], dtype='float')
+        self.squared_steps = numpy.ones([self.n_features, self.max_categories], dtype='float')
+        # the number of steps done and the number of steps, after which category was last regularized
+        self.n_steps = 0
+        self.last_steps = numpy.zeros([self.n_features, self.max_categories], dtype=int)
+        self._random_state = check_random_state(self.random_state)
 
+    def fit(self, X, y, sample_weight=None, iterations=100, loss=None):
+        X, y, sample_weight = self._check_input(X, y, sample_weight)
+        self._initialize(X.shape[1])
         for iteration in range(iterations):
-            # this line could be skipped, but we need it to avoid
-            # mistakes after too many steps of computations
-            y_pred = self.decision_function(X)
-            print(iteration, loss(y_pred))
-
-            for feature in range(self.n_features):
-                ngradient = loss.negative_gradient(y_pred)
-                nominator = numpy.bincount(X[:, feature], weights=ngradient, minlength=self.max_categories)
-                nominator -= self.l2_reg * self.coeffs[feature, :] + self.l1_reg * numpy.sign(self.coeffs[feature, :])
-
-                denominator = numpy.abs(ngradient) * (1. - numpy.abs(ngradient))
-                denominator = numpy.bincount(X[:, feature], weights=denominator, minlength=self.max_categories)
-                denominator += 2 * self.l2_reg + 5
-
-                gradients = nominator / denominator
-                right_gradients = gradients
-                # those already zeros not to become nonzero
-                mask = (self.coeffs[feature, :] == 0) & (numpy.abs(gradients) < self.l1_reg)
-                right_gradients[mask] = 0
-                # those already not zeros
-                old_coeffs = self.coeffs[feature, :]
-                new_coeffs = old_coeffs + self.learning_rate * right_gradients
-                new_coeffs[new_coeffs * old_coeffs < 0] = 0
-                y_pred += numpy.take(new_coeffs - old_coeffs, X[:, feature])
-                self.coeffs[feature, :] = new_coeffs
+            print(iteration, self._fit_batches(X, y, sample_weight, loss=loss))
+        return self
 
+    def partial_fit(self, X, y, sample_weight=None, loss=None):
+        """
+        Makes one pass over passed data (by batches), coefficients trained by previous calls are kept,
+        so the classifier can be trained on data, which arrives in pieces (i.e. is read from disk).
+        """
+        X, y, sample_weight = self._check_input(X, y, sample_weight)
+        if getattr(self, 'coeffs', None) is None:
+            self._initialize(X.shape[1])
+        assert X.shape[1] == self.n_features, 'different number of features'
+        self._fit_batches(X, y, sample_weight, loss=loss)
         return self
 
+    def _fit_batches(self, X, y, sample_weight, loss=None):
+        """One pass over data by batches, returns the sum of losses on batches (computed before the steps)"""
+        if loss is None:
+            loss = BinomialDevianceLossFunction()
+        batch_size = len(X) if self.batch_size is None else self.batch_size
+        starts = numpy.arange(0, len(X), batch_size)
+        self._random_state.shuffle(starts)
+        total_loss = 0.
+        for start in starts:
+            batch = slice(start, start + batch_size)
+            batch_X = X[batch]
+            self._regularize_skipped(batch_X)
+            loss.fit(batch_X, y[batch], sample_weight=sample_weight[batch])
+            # this line could be skipped, but we need it to avoid
+            # mistakes after too many steps of computations
+            y_pred = self.decision_function(batch_X)
+            total_loss += loss(y_pred)
+            self._make_step(batch_X, y_pred, loss)
+            self.n_steps += 1
+        self._regularize_skipped(None)
+        return total_loss
+
+    def _regularize_skipped(self, X):
+        """
+        Applies regularization of the steps, at which categories were absent in batches
+        (as if the steps were done with zero gradient of loss), to categories present in X (all if X is None).
+        With adagrad current learning rates of categories are used.
+        """
+        if self.l1_reg == 0 and self.l2_reg == 0:
+            return
+        for feature in range(self.n_features):
+            if X is None:
+                present = numpy.arange(self.max_categories)
+            else:
+                present = numpy.flatnonzero(numpy.bincount(X[:, feature], minlength=self.max_categories))
+            n_skipped = self.n_steps - self.last_steps[feature, present]
+            self.last_steps[feature, present] = self.n_steps
+            learning_rates = self.learning_rate
+            if self.adagrad:
+                learning_rates = self.learning_rate / numpy.sqrt(self.squared_steps[feature, present])
+            # at each step |coeff| becomes max(0, decay * |coeff| - shift)
+            denominator = 2 * self.l2_reg + 5
+            decay = numpy.clip(1 - learning_rates * self.l2_reg / denominator, 0, 1) * numpy.ones(len(present))
+            shift = learning_rates * self.l1_reg / denominator
+            total_decay = decay ** n_skipped
+            # sum of decay ** i for i in range(n_skipped)
+            total_shift = shift * numpy.where(decay == 1, n_skipped,
+                                              (1 - total_decay) / numpy.maximum(1 - decay, 1e-300))
+            old_coeffs = self.coeffs[feature, present]
+            new_abs = numpy.maximum(0, total_decay * numpy.abs(old_coeffs) - total_shift)
+            self.coeffs[feature, present] = numpy.sign(old_coeffs) * new_abs
+
+    def _make_step(self, X, y_pred, loss):
+        """Updates coefficients of each feature, only categories present in X are changed, y_pred is updated"""
+        for feature in range(self.n_features):
+            ngradient = loss.negative_gradient(y_pred)
+            categories = X[:, feature]
+            present = numpy.flatnonzero(numpy.bincount(categories, minlength=self.max_categories))
+            old_coeffs = self.coeffs[feature, present]
+            nominator = numpy.bincount(categories, weights=ngradient, minlength=self.max_categories)[present]
+            nominator -= self.l2_reg * old_coeffs + self.l1_reg * numpy.sign(old_coeffs)
+
+            denominator = numpy.abs(ngradient) * (1. - numpy.abs(ngradient))
+            denominator = numpy.bincount(categories, weights=denominator, minlength=self.max_categories)[present]
+            denominator += 2 * self.l2_reg + 5
+
+            gradients = nominator / denominator
+            # those already zeros not to become nonzero
+            gradients[(old_coeffs == 0) & (numpy.abs(gradients) < self.l1_reg)] = 0
+            learning_rates = self.learning_rate
+            if self.adagrad:
+                self.squared_steps[feature, present] += gradients ** 2
+                learning_rates = self.learning_rate / numpy.sqrt(self.squared_steps[feature, present])
+            new_coeffs = old_coeffs + learning_rates * gradients
+            # those already not zeros
+            new_coeffs[new_coeffs * old_coeffs < 0] = 0
+            changes = numpy.zeros(self.max_categories)
+            changes[present] = new_coeffs - old_coeffs
+            y_pred += numpy.take(changes, categories)
+            self.coeffs[feature, present] = new_coeffs
+            self.last_steps[feature, present] = self.n_steps + 1
+
     def decision_function(self, X):
         X = numpy.array(X)
         assert X.shape[1] == self.n_features
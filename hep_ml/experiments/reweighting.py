@@ -1,12 +1,14 @@
+import numbers
 import numpy
 
-from collections import defaultdict
+from collections import defaultdict, deque
+from functools import partial
+from scipy import sparse
 from sklearn.base import BaseEstimator, ClassifierMixin, clone
 from sklearn.ensemble.forest import RandomForestClassifier
 from sklearn.tree.tree import DecisionTreeClassifier
 
 from .. import commonutils
-from ..metrics import compute_group_efficiencies
 
 __author__ = "Alex Rogozhnikov"
 
@@ -25,14 +27,40 @@ This approach turned out to be very inefficient.
 """
 
 
+def compute_knn_matrix(knn_indices):
+    """
+    :param knn_indices: numpy.array of shape [n_samples, n_neighbours]
+    :return: scipy.sparse.csr_matrix of shape [n_samples, n_samples],
+        matrix.dot(values) computes mean of values over neighbours of each event
+    """
+    n_samples, n_neighbours = knn_indices.shape
+    indptr = numpy.arange(0, n_samples * n_neighbours + 1, n_neighbours)
+    data = numpy.ones(n_samples * n_neighbours) / n_neighbours
+    return sparse.csr_matrix((data, numpy.ravel(knn_indices), indptr), shape=(n_samples, n_samples))
+
+
 class ReweightClassifier(BaseEstimator, ClassifierMixin):
     def __init__(self, uniform_variables, knn=50, iterations=10,
                  base_estimator=DecisionTreeClassifier(max_depth=6),
-                 train_variables=None, learning_rate=10, efficiencies_as_sum=True):
+                 train_variables=None, learning_rate=10, efficiencies_as_sum=True,
+                 debug_size=None, warm_start=False, warm_start_window=3, n_threads=1):
         """This classifier tries to obtain flat efficiency in signal by
         changing the weights of training sample. Doesn't use boosting or whatever
 
         :type base_estimator: BaseEstimator
+        :param debug_size: None or int, the number of last iterations, for which weights, local efficiencies
+            and estimators are kept in debug_dict (weights and efficiencies are stored in float32).
+            If None, information about all iterations (and indices of neighbours) is kept.
+        :param warm_start: bool, if True and base_estimator is an ensemble with warm_start
+            (i.e. RandomForestClassifier), the same ensemble is used in all iterations:
+            each iteration adds n_estimators new estimators trained with new weights.
+            Otherwise base_estimator is trained from scratch at each iteration.
+        :param warm_start_window: None or int, with warm start only estimators trained
+            at the last warm_start_window iterations are kept (the oldest ones are dropped),
+            so the ensemble contains at most warm_start_window * n_estimators estimators.
+            If None, all estimators are kept and the ensemble grows linearly with iterations.
+            Dropping is supported only for ensembles which keep estimators_ in list (forests, bagging).
+        :param n_threads: number of threads used to compute local efficiencies
         """
         self.base_estimator = base_estimator
         self.uniform_variables = uniform_variables
@@ -41,48 +69,90 @@ class ReweightClassifier(BaseEstimator, ClassifierMixin):
         self.train_variables = train_variables
         self.learning_rate = learning_rate
         self.efficiencies_as_sum = efficiencies_as_sum
+        self.debug_size = debug_size
+        self.warm_start = warm_start
+        self.warm_start_window = warm_start_window
+        self.n_threads = n_threads
+
+    def _is_warm_started(self):
+        params = self.base_estimator.get_params()
+        return self.warm_start and 'warm_start' in params and 'n_estimators' in params
+
+    def _store_debug(self, name, value):
+        if self.debug_size is not None and isinstance(value, numpy.ndarray):
+            value = value.astype(numpy.float32)
+        self.debug_dict[name].append(value)
 
     def fit(self, X, y):
         assert len(X) == len(y), 'different length'
         assert self.iterations > 0, 'number of iterations should be positive'
-        self.debug_dict = defaultdict(list)
+        assert self.debug_size is None or self.debug_size >= 0, 'debug_size should be non-negative'
+        assert self.warm_start_window is None or self.warm_start_window > 0, 'warm_start_window should be positive'
+        if self.debug_size is None:
+            self.debug_dict = defaultdict(list)
+        else:
+            # deque with maxlen is ring buffer, which keeps only last elements
+            self.debug_dict = defaultdict(partial(deque, maxlen=self.debug_size))
         y = numpy.array(y > 0.5)
         knn_all_indices = commonutils.computeSignalKnnIndices(self.uniform_variables, X,
                                                               is_signal=(y > -1), n_neighbors=self.knn)
-        self.debug_dict['knn_all_indices'] = knn_all_indices
-        weights = 1.0 / (numpy.take(y * 1.0, knn_all_indices).mean(axis=1) + 1e-8)
+        weights = 1.0 / (compute_knn_matrix(knn_all_indices).dot(y * 1.0) + 1e-8)
         bg_weight = numpy.mean(weights[y])
         weights[~y] = bg_weight
         weights /= numpy.sum(weights)
 
         knn_indices = commonutils.computeSignalKnnIndices(self.uniform_variables, X, is_signal=y, n_neighbors=self.knn)
+        # the matrix is computed once and used to find local efficiencies at each iteration
+        knn_matrix = compute_knn_matrix(knn_indices)
+        if self.debug_size is None:
+            self.debug_dict['knn_all_indices'] = knn_all_indices
+            self.debug_dict['knn_indices'] = knn_indices
+        del knn_all_indices, knn_indices
         X_train = self.get_train_variables(X)
 
-        self.debug_dict['knn_indices'] = knn_indices
-
-        estimator = None
+        estimator = clone(self.base_estimator)
+        warm_started = self._is_warm_started()
+        n_new_estimators = estimator.get_params()['n_estimators'] if warm_started else 0
+        seed = estimator.get_params().get('random_state')
+        local_efficiencies = numpy.zeros(len(X))
         for iteration in range(1, self.iterations + 1):
-            estimator = clone(self.base_estimator)
+            if warm_started:
+                n_kept = 0
+                if iteration > 1:
+                    n_kept = len(estimator.estimators_)
+                    if self.warm_start_window is not None:
+                        n_kept = min(n_kept, n_new_estimators * (self.warm_start_window - 1))
+                        if n_kept < len(estimator.estimators_):
+                            assert isinstance(estimator.estimators_, list), \
+                                'dropping estimators is not supported for {}'.format(type(estimator).__name__)
+                            del estimator.estimators_[:len(estimator.estimators_) - n_kept]
+                estimator.set_params(warm_start=True, n_estimators=n_kept + n_new_estimators)
+                if isinstance(seed, numbers.Integral):
+                    # otherwise new estimators repeat random seeds of previous iteration after dropping
+                    estimator.set_params(random_state=seed + iteration)
+            else:
+                estimator = clone(self.base_estimator)
             estimator.fit(X_train, y, sample_weight=weights)
             predict_proba = estimator.predict_proba(X_train)
 
             if self.efficiencies_as_sum:
                 # here we compute local efficiency as mean probability of signal among knn
-                local_efficiencies = numpy.take(predict_proba[:, 1], knn_indices).mean(axis=1)
+                passed = predict_proba[:, 1]
             else:
                 # here we compute local efficiency at the cut, corresponding to global_efficiency=0.5
                 global_cut = commonutils.compute_bdt_cut(0.5, y, predict_proba[:, 1])
-                local_efficiencies = compute_group_efficiencies(predict_proba[:, 1], knn_indices,
-                                                                cut=global_cut, sample_weight=None)
+                passed = (predict_proba[:, 1] > global_cut) * 1.0
+            commonutils.csr_dot(knn_matrix, passed, out=local_efficiencies, n_threads=self.n_threads)
             mse = numpy.std(numpy.log(local_efficiencies))
 
             weights *= numpy.exp(- local_efficiencies * y * self.learning_rate * mse)
             bg_weight = numpy.mean(weights[y])
             weights[~y] = bg_weight
             weights /= numpy.sum(weights)
-            self.debug_dict['weights'].append(weights.copy())
-            self.debug_dict['local_efficiencies'].append(local_efficiencies.copy())
-            self.debug_dict['estimators'].append(estimator)
+            self._store_debug('weights', weights.copy())
+            self._store_debug('local_efficiencies', local_efficiencies.copy())
+            if not warm_started:
+                self._store_debug('estimators', estimator)
 
         self.trained_estimator = estimator
         return self
@@ -102,6 +172,8 @@ class ReweightClassifier(BaseEstimator, ClassifierMixin):
         return self.trained_estimator.predict_proba(X)
 
     def staged_predict_proba(self, X):
+        """Yields predictions of estimators kept in debug_dict (only last debug_size iterations, if it is set)"""
+        assert not self._is_warm_started(), 'staged predictions are not available with warm start'
         X = self.get_train_variables(X)
         for estimator in self.debug_dict['estimators']:
             yield estimator.predict_proba(X)
@@ -122,6 +194,22 @@ def test_reweighting():
     reweighting.predict(testX)
     reweighting.predict_proba(testX)
     reweighting.staged_predict_proba(testX)
+
+    # lean mode: debug information is kept only for the last iterations, forest is reused
+    lean = ReweightClassifier(uniform_variables=trainX.columns[:1],
+                              base_estimator=RandomForestClassifier(n_estimators=2),
+                              iterations=5, learning_rate=100, debug_size=2, warm_start=True)
+    lean.fit(trainX, trainY)
+    assert len(lean.trained_estimator.estimators_) == 6
+    assert len(lean.debug_dict['weights']) == 2 and lean.debug_dict['weights'][0].dtype == numpy.float32
+    assert 'knn_indices' not in lean.debug_dict
+    assert lean.predict_proba(testX).shape == (len(testX), 2)
+
+    growing = ReweightClassifier(uniform_variables=trainX.columns[:1],
+                                 base_estimator=RandomForestClassifier(n_estimators=2, random_state=42),
+                                 iterations=5, learning_rate=100, warm_start=True, warm_start_window=None)
+    growing.fit(trainX, trainY)
+    assert len(growing.trained_estimator.estimators_) == 10
     print("reweighting is ok")
 
 
@@ -1,12 +1,71 @@
 from __future__ import division, print_function, absolute_import
 import numpy
 
-from ..commonutils import indices_of_values
+from ..commonutils import compute_segments, reduce_segments, spread_segments
 
 
 __author__ = 'Alex Rogozhnikov'
 
 
+def _segment_lengths(starts, n_samples):
+    return numpy.diff(numpy.append(starts, n_samples))
+
+
+def _max_reducer(scores, order, starts):
+    return reduce_segments(scores, order, starts, ufunc=numpy.maximum)
+
+
+def _mean_reducer(scores, order, starts):
+    return reduce_segments(scores, order, starts, ufunc=numpy.add) / _segment_lengths(starts, len(order))
+
+
+def _softmax_reducer(temperature):
+    def reducer(scores, order, starts):
+        """temperature * log(sum(exp(score / temperature))) - smooth maximum"""
+        maxima = _max_reducer(scores, order, starts)
+        exponents = numpy.exp((scores - spread_segments(maxima, order, starts)) / temperature)
+        return maxima + temperature * numpy.log(reduce_segments(exponents, order, starts, ufunc=numpy.add))
+    return reducer
+
+
+def _top_k_reducer(k):
+    def reducer(scores, order, starts):
+        """mean of k largest scores in the group (of all scores, if group is smaller)"""
+        lengths = _segment_lengths(starts, len(order))
+        segments = numpy.repeat(numpy.arange(len(starts)), lengths)
+        # ordering inside each segment by decreasing score
+        scores_in_order = numpy.take(scores, order)
+        inner_order = numpy.lexsort([-scores_in_order, segments])
+        ranks = numpy.arange(len(order)) - numpy.repeat(starts, lengths)
+        selected = numpy.where(ranks < k, scores_in_order[inner_order], 0)
+        return numpy.add.reduceat(selected, starts) / numpy.minimum(lengths, k)
+    return reducer
+
+
+def generate_group_voter(event_indices, reducer='max', temperature=1., k=2):
+    """
+    Voter prepared specially for experiments in triggers: all SVRs of one event get the same score,
+    which is computed from scores of all SVRs of this event.
+    The grouping is computed once, the voting is done with vectorized segment reductions.
+    :param event_indices: array, each element is the index of event which current SVR belongs to.
+    :param str reducer: 'max', 'mean', 'softmax' (smooth maximum with given temperature)
+        or 'top-k' (mean of k best scores)
+    :return: voter, which should be used as voting in meanadaboost
+    """
+    order, starts, _ = compute_segments(event_indices)
+    reducers = {'max': _max_reducer, 'mean': _mean_reducer,
+                'softmax': _softmax_reducer(temperature), 'top-k': _top_k_reducer(k)}
+    assert reducer in reducers, 'unknown reducer: {}'.format(reducer)
+    reduce_function = reducers[reducer]
+
+    def voter(cumulative_score, knn_scores=None):
+        return spread_segments(reduce_function(cumulative_score, order, starts), order, starts)
+
+    # scores of neighbours are not used
+    voter.needs_knn_scores = False
+    return voter
+
+
 def generate_max_voter(event_indices):
     """
     This voter is prepared specially for experiments in triggers.
@@ -16,12 +75,4 @@ def generate_max_voter(event_indices):
 
     Result should be used as voter in meanadaboost.
     """
-    groups = indices_of_values(event_indices)
-
-    def voter(cumulative_score, knn_scores):
-        result = numpy.zeros(len(cumulative_score))
-        for key, group in groups:
-            result[group] = numpy.max(cumulative_score[group])
-        return result
-
-    return voter
+    return generate_group_voter(event_indices, reducer='max')
@@ -5,6 +5,12 @@
 
 from __future__ import division, print_function
 
+import os
+import sys
+import time
+import signal
+import numbers
+import multiprocessing
 from itertools import islice
 from collections import defaultdict, OrderedDict
 from warnings import warn
@@ -12,19 +18,25 @@ import numpy
 import pandas
 import sklearn
 import logging
+from six import string_types
 
+from scipy.stats import norm
 from sklearn.base import BaseEstimator, ClassifierMixin
+from sklearn.ensemble import RandomForestRegressor
 from sklearn.cross_validation import StratifiedKFold
 from sklearn.grid_search import _check_param_grid
 from sklearn.metrics.metrics import roc_auc_score
 from sklearn.utils.random import check_random_state
 from . import commonutils
+from .result_store import ResultStore, data_fingerprint, describe_value, describe_estimator
 
 __author__ = 'Alex Rogozhnikov'
 
-# TODO think of regression and other techniques (sub grids + annealing are implemented now)
+# special parameter: if present, only this part of training data is used to train classifier
+TRAIN_FRACTION = 'train_fraction'
+
+# TODO think of other techniques (sub grids + annealing, regression, successive halving are implemented now)
 # TODO pareto-optimization
-# TODO use staged predictions
 
 
 class AbstractParameterGenerator(object):
@@ -72,13 +84,21 @@ class AbstractParameterGenerator(object):
             state_indices.append(self.generate_next_point())
         return zip(*state_indices)
 
-    def add_result(self, key, value):
-        """key is an n-tuple with integers"""
-        self.grid_scores_[key] = value
+    def add_result(self, state_indices, value):
+        """state_indices is an n-tuple with integers"""
+        self.grid_scores_[state_indices] = value
+
+    def seed_result(self, state_indices, value):
+        """Adds result computed before (i.e. in previous search), returns True if the result was used"""
+        if state_indices in self.queued_tasks_:
+            return False
+        self.queued_tasks_.add(state_indices)
+        self.add_result(state_indices, value)
+        return True
 
     @property
     def best_score_(self):
-        return numpy.max(self.grid_scores_.values())
+        return numpy.max(list(self.grid_scores_.values()))
 
     @property
     def best_params_(self):
@@ -115,7 +135,7 @@ class AbstractParameterGenerator(object):
             for b in best:
                 best_stats[b].append(numpy.zeros(n_values))
 
-        thresholds = [commonutils.weighted_percentile(list(self.grid_scores_.values()), [1. - b])[0] for b in best]
+        thresholds = commonutils.weighted_percentile(list(self.grid_scores_.values()), 1. - numpy.array(best))
         for index, score in self.grid_scores_.items():
             for feat_i, feat_val in enumerate(index):
                 all_stats[feat_i][feat_val] += 1
@@ -203,7 +223,7 @@ class SimpleParameterOptimizer(AbstractParameterGenerator):
         std = numpy.std(results) + 1e-5
         probabilities = numpy.exp(numpy.clip((results - numpy.mean(results)) * 3. / std, -5, 5))
         probabilities /= numpy.sum(probabilities)
-        while True:
+        for _ in range(1000):
             start = self.random_state.choice(len(probabilities), p=probabilities)
             start_indices = list(self.grid_scores_.keys())[start]
             new_state_indices = list(start_indices)
@@ -223,6 +243,9 @@ class SimpleParameterOptimizer(AbstractParameterGenerator):
             self.queued_tasks_.add(new_state_indices)
             # print(distance)
             return new_state_indices, self.indices_to_parameters(new_state_indices)
+        # neighbours of evaluated points are queued (i.e. are being evaluated), taking random point
+        indices = self._generate_start_point()
+        return indices, self.indices_to_parameters(indices)
 
     def add_result(self, state_indices, value):
         if state_indices[0] == 'subgrid':
@@ -232,33 +255,225 @@ class SimpleParameterOptimizer(AbstractParameterGenerator):
             self.grid_scores_[state_indices] = value
 
 
+class SuccessiveHalvingOptimizer(AbstractParameterGenerator):
+    def __init__(self, param_grid, n_evaluations, random_state=None, budget_parameter=TRAIN_FRACTION,
+                 min_budget=0.1, max_budget=1., eta=3):
+        """
+        Multi-fidelity optimizer (asynchronous successive halving).
+        Configurations are first evaluated with small budget (part of training data or small number of trees),
+        the best 1/eta of configurations evaluated with some budget are promoted to eta times bigger budget.
+        Promotions are done as soon as there are enough results, so the optimizer works with asynchronous evaluations.
+
+        :param budget_parameter: str, the name of estimator parameter which is used as budget (i.e. 'n_estimators')
+            or 'train_fraction' - then the part of training data is used as budget.
+            The budget parameter shouldn't be present in param_grid.
+        :param min_budget: the smallest budget, the configurations are started with
+        :param max_budget: the budget of the final evaluations
+        :param eta: int, the factor of budget increase (and decrease of number of configurations)
+
+        Keys of points are (rung, indices), where rung is the index of budget.
+        grid_scores_ contain the scores obtained with the largest budget reached by now.
+        """
+        AbstractParameterGenerator.__init__(self, param_grid=param_grid, n_evaluations=n_evaluations,
+                                            random_state=random_state)
+        assert budget_parameter not in self.param_grid, 'budget parameter should not be in param_grid'
+        assert 0 < min_budget <= max_budget, 'wrong budgets'
+        assert eta > 1, 'eta should be greater than 1'
+        self.budget_parameter = budget_parameter
+        self.eta = eta
+        n_rungs = int(numpy.floor(numpy.log(max_budget / min_budget) / numpy.log(eta) + 1e-10)) + 1
+        self.budgets = [max_budget * eta ** (rung - n_rungs + 1.) for rung in range(n_rungs)]
+        if isinstance(max_budget, int):
+            self.budgets = [int(numpy.round(budget)) for budget in self.budgets]
+        # scores obtained on each rung and configurations already promoted from each rung
+        self.rung_scores_ = [OrderedDict() for _ in self.budgets]
+        self.promoted_ = [set() for _ in self.budgets]
+
+    def _make_point(self, rung, indices):
+        parameters = self.indices_to_parameters(indices)
+        parameters[self.budget_parameter] = self.budgets[rung]
+        return (rung, indices), parameters
+
+    def generate_next_point(self):
+        # promoting the best configurations, higher rungs are checked first
+        for rung in reversed(range(len(self.budgets) - 1)):
+            results = self.rung_scores_[rung]
+            n_promoted = len(results) // self.eta
+            best = sorted(results, key=lambda indices: -results[indices])[:n_promoted]
+            for indices in best:
+                if indices not in self.promoted_[rung]:
+                    self.promoted_[rung].add(indices)
+                    return self._make_point(rung + 1, indices)
+
+        if len(self.queued_tasks_) >= numpy.prod(self.dimensions):
+            raise RuntimeError("The grid is exhausted, cannot generate more points")
+        return self._make_point(0, self._generate_start_point())
+
+    def add_result(self, state_indices, value):
+        rung, indices = state_indices
+        self.rung_scores_[rung][indices] = value
+        self.top_rung_ = max(r for r, results in enumerate(self.rung_scores_) if len(results) > 0)
+        self.grid_scores_ = OrderedDict(self.rung_scores_[self.top_rung_])
+
+    def seed_result(self, state_indices, value):
+        """Previous results are not used, since they are obtained with other budget"""
+        return False
+
+    @property
+    def best_params_(self):
+        result = AbstractParameterGenerator.best_params_.fget(self)
+        if self.budget_parameter != TRAIN_FRACTION:
+            result[self.budget_parameter] = self.budgets[self.top_rung_]
+        return result
+
+
+class RegressionParameterOptimizer(AbstractParameterGenerator):
+    def __init__(self, param_grid, n_evaluations, random_state=None, start_evaluations=5, n_candidates=2000,
+                 n_estimators=50, xi=0.):
+        """
+        Bayesian-like optimizer: random forest (surrogate) is fitted on the indices of evaluated points,
+        the next point is the one with maximal expected improvement,
+        the variance is estimated from the spread of trees predictions.
+
+        Points being computed (queued, but without result) are added to training of surrogate with the mean score
+        ('constant liar'), so the consequent calls of generate_next_point give different points,
+        this makes batch proposals (generate_batch_points) and asynchronous evaluation possible.
+
+        :param start_evaluations: the number of random points evaluated before using surrogate
+        :param n_candidates: the max number of random unexplored points, among which the next point is selected
+        :param n_estimators: the number of trees in surrogate
+        :param xi: float, exploration parameter in expected improvement
+        """
+        AbstractParameterGenerator.__init__(self, param_grid=param_grid, n_evaluations=n_evaluations,
+                                            random_state=random_state)
+        self.start_evaluations = start_evaluations
+        self.n_candidates = n_candidates
+        self.n_estimators = n_estimators
+        self.xi = xi
+
+    def _generate_candidates(self):
+        size = numpy.prod(self.dimensions)
+        if size <= self.n_candidates:
+            candidates = numpy.indices(self.dimensions).reshape([len(self.dimensions), -1]).T
+        else:
+            candidates = numpy.array([self.random_state.randint(0, n_values, size=self.n_candidates)
+                                      for n_values in self.dimensions]).T
+        candidates = set(map(tuple, candidates)) - self.queued_tasks_
+        return numpy.array(sorted(candidates))
+
+    def generate_next_point(self):
+        if len(self.queued_tasks_) >= numpy.prod(self.dimensions):
+            raise RuntimeError("The grid is exhausted, cannot generate more points")
+        candidates = self._generate_candidates()
+        if len(self.grid_scores_) < self.start_evaluations or len(candidates) == 0:
+            indices = self._generate_start_point()
+            return indices, self.indices_to_parameters(indices)
+
+        scores = numpy.array(list(self.grid_scores_.values()))
+        pending = list(self.queued_tasks_ - set(self.grid_scores_))
+        train_X = numpy.array(list(self.grid_scores_.keys()) + pending)
+        train_y = numpy.concatenate([scores, numpy.zeros(len(pending)) + numpy.mean(scores)])
+        surrogate = RandomForestRegressor(n_estimators=self.n_estimators, min_samples_leaf=2,
+                                          random_state=self.random_state.randint(2 ** 30))
+        surrogate.fit(train_X, train_y)
+        trees_predictions = numpy.array([tree.predict(candidates) for tree in surrogate.estimators_])
+        mean = numpy.mean(trees_predictions, axis=0)
+        std = numpy.std(trees_predictions, axis=0) + 1e-10
+        z = (mean - numpy.max(scores) - self.xi) / std
+        expected_improvement = (mean - numpy.max(scores) - self.xi) * norm.cdf(z) + std * norm.pdf(z)
+
+        indices = tuple(candidates[numpy.argmax(expected_improvement)])
+        self.queued_tasks_.add(indices)
+        return indices, self.indices_to_parameters(indices)
+
+
+# data shared with forked worker processes, so that tasks contain only indices of events
+_shared_data = {}
+
+
+def _estimate_fold(params_dict, base_estimator, X, y, sample_weight, train_indices, test_indices,
+                   score_function, label, scorer_needs_x, stages=None):
+    """Trains classifier on one fold and returns its score on the test part,
+    if stages are passed, returns scores of staged predictions after each of stages"""
+    trainX, trainY = X.take(train_indices), y[train_indices]
+    testX, testY = X.take(test_indices), y[test_indices]
+    estimator = sklearn.clone(base_estimator).set_params(**params_dict)
+
+    train_options = {}
+    test_options = {}
+    if sample_weight is not None:
+        train_weights, test_weights = \
+            sample_weight[train_indices], sample_weight[test_indices]
+        train_options['sample_weight'] = train_weights
+        test_options['sample_weight'] = test_weights
+    if scorer_needs_x:
+        test_options['X'] = testX
+
+    estimator.fit(trainX, trainY, **train_options)
+    if stages is None:
+        proba = estimator.predict_proba(testX)
+        return score_function(testY, proba[:, label], **test_options)
+    stage_scores = {}
+    n_stages, proba = 0, None
+    for n_stages, proba in enumerate(estimator.staged_predict_proba(testX), 1):
+        if n_stages in stages:
+            stage_scores[n_stages] = score_function(testY, proba[:, label], **test_options)
+    missing = [stage for stage in stages if stage not in stage_scores]
+    if len(missing) > 0:
+        if proba is None or any(stage < n_stages for stage in missing):
+            raise ValueError('Estimator has no staged predictions for stages {}'.format(missing))
+        # estimator stopped early (i.e. AdaBoost with zero error), next stages have the same predictions
+        last_score = score_function(testY, proba[:, label], **test_options)
+        for stage in missing:
+            stage_scores[stage] = last_score
+    return numpy.array([stage_scores[stage] for stage in stages])
+
+
+def _estimate_shared_fold(args):
+    X, y, sample_weight = _shared_data['data']
+    params_dict, base_estimator, train_indices, test_indices, score_function, label, scorer_needs_x, stages = args
+    return _estimate_fold(params_dict, base_estimator, X, y, sample_weight, train_indices, test_indices,
+                          score_function, label, scorer_needs_x, stages=stages)
+
+
 def estimate_classifier(params_dict, base_estimator, X, y, folds, fold_checks,
                         score_function, sample_weight=None, label=1,
-                        scorer_needs_x=False, catch_exceptions=True):
-    """This function is needed to train classifier with some parameters on the cluster."""
+                        scorer_needs_x=False, catch_exceptions=True, n_jobs=1, stages=None, random_state=None):
+    """This function is needed to train classifier with some parameters on the cluster.
+    If params_dict contains 'train_fraction', only this part of training events is used.
+    If n_jobs > 1, folds are evaluated in parallel processes, the data is not sent to processes
+    (they are forked with data, so fork start method is required), only the indices of events.
+    If stages (list of integers) are passed, estimator is trained once and evaluated after each of these stages
+    with staged_predict_proba, array of scores is returned.
+    random_state (int, RandomState or None) determines folds and the subsample used with 'train_fraction'."""
+    if n_jobs > 1:
+        commonutils.check_fork_start_method()
     try:
-        k_folder = StratifiedKFold(y=y, n_folds=folds, shuffle=True)
-        score = 0.
-        for train_indices, test_indices in islice(k_folder, fold_checks):
-            trainX, trainY = X.irow(train_indices), y[train_indices]
-            testX, testY = X.irow(test_indices), y[test_indices]
-            estimator = sklearn.clone(base_estimator).set_params(**params_dict)
-
-            train_options = {}
-            test_options = {}
-            if sample_weight is not None:
-                train_weights, test_weights = \
-                    sample_weight[train_indices], sample_weight[test_indices]
-                train_options['sample_weight'] = train_weights
-                test_options['sample_weight'] = test_weights
-            if scorer_needs_x:
-                test_options['X'] = testX
-
-            estimator.fit(trainX, trainY, **train_options)
-            proba = estimator.predict_proba(testX)
-            score += score_function(testY, proba[:, label], **test_options)
-
-        return score / fold_checks
+        params_dict = dict(params_dict)
+        train_fraction = params_dict.pop(TRAIN_FRACTION, 1.)
+        random_state = check_random_state(random_state)
+        k_folder = StratifiedKFold(y=y, n_folds=folds, shuffle=True, random_state=random_state)
+        fold_indices = list(islice(k_folder, fold_checks))
+        if train_fraction < 1:
+            fold_indices = [(numpy.sort(random_state.choice(train_indices, int(len(train_indices) * train_fraction),
+                                                            replace=False)), test_indices)
+                            for train_indices, test_indices in fold_indices]
+        if n_jobs == 1:
+            scores = [_estimate_fold(params_dict, base_estimator, X, y, sample_weight, train_indices, test_indices,
+                                     score_function, label, scorer_needs_x, stages=stages)
+                      for train_indices, test_indices in fold_indices]
+        else:
+            _shared_data['data'] = X, y, sample_weight
+            pool = multiprocessing.Pool(min(n_jobs, len(fold_indices)))
+            try:
+                scores = pool.map(_estimate_shared_fold, [(params_dict, base_estimator, train_indices, test_indices,
+                                                           score_function, label, scorer_needs_x, stages)
+                                                          for train_indices, test_indices in fold_indices])
+            finally:
+                pool.close()
+                pool.join()
+                _shared_data.clear()
+        return numpy.mean(scores, axis=0)
     except Exception as e:
         # If there was some exception on the node, it will be returned
         if catch_exceptions:
@@ -267,10 +482,62 @@ def estimate_classifier(params_dict, base_estimator, X, y, folds, fold_checks,
             raise
 
 
+def _peak_memory():
+    """Peak memory of this process and its finished children in megabytes, None if not available.
+    This is the high-water mark over the whole life of process, so it describes one evaluation
+    only if the evaluation was done in a new process."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and in kilobytes on linux
+    return peak / 2. ** 20 if sys.platform == 'darwin' else peak / 1024.
+
+
+def _timed_estimate_classifier(*args, **kwargs):
+    """Calls estimate_classifier, returns (score, time of evaluation, peak memory).
+    Peak memory is measured only if measure_memory=True is passed (evaluation is done in a new process),
+    otherwise it is None."""
+    measure_memory = kwargs.pop('measure_memory', False)
+    start = time.time()
+    score = estimate_classifier(*args, **kwargs)
+    return score, time.time() - start, _peak_memory() if measure_memory else None
+
+
+def _estimate_in_subprocess(connection, kwargs):
+    """Target of worker process: evaluates classifier and sends the result (score or exception) back"""
+    _make_process_group()
+    try:
+        connection.send(_timed_estimate_classifier(catch_exceptions=True, measure_memory=True, **kwargs))
+    finally:
+        connection.close()
+
+
+def _make_process_group(pid=0):
+    """Makes process the leader of new process group, so processes it starts (pool evaluating folds)
+    are in this group and are terminated together with it"""
+    try:
+        os.setpgid(pid, pid)
+    except (AttributeError, OSError):
+        # not supported (Windows) or the child already did it itself
+        pass
+
+
+def _terminate_process(process):
+    """Terminates evaluation process together with processes started by it"""
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except (AttributeError, OSError):
+        process.terminate()
+
+
 class GridOptimalSearchCV(BaseEstimator, ClassifierMixin):
     def __init__(self, base_estimator, param_grid, n_evaluations=40, score_function=None, folds=3, fold_checks=1,
                  scorer_needs_x=False, ipc_profile=None, param_generator_type=None,
-                 random_state=None, refit=False, label=1, log_name=""):
+                 random_state=None, refit=False, label=1, log_name="", n_jobs=1, timeout=None,
+                 fold_n_jobs=1, result_store=None, stages_parameter=None):
         """Optimal search over specified parameter values for an estimator. Metropolis-like algorithm is used
         Important members are fit, predict.
 
@@ -300,7 +567,8 @@ class GridOptimalSearchCV(BaseEstimator, ClassifierMixin):
             The number of attempts of evaluations, will be truncated
 
         random_state: int or None or RandomState object,
-            used to generate random numbers
+            used to generate random numbers. The same folds (and subsamples of training data for 'train_fraction')
+            are used to evaluate all points, they are reproducible if random_state is int.
 
         scorer_needs_x: bool, if True, then test X (dataframe) is passed
             to the scoring function.
@@ -308,6 +576,31 @@ class GridOptimalSearchCV(BaseEstimator, ClassifierMixin):
         ipc_profile: str, the name of IPython parallel cluster profile to use,
             or None to perform computations locally
 
+        n_jobs: int, the number of local processes used when ipc_profile is None.
+            Evaluations are asynchronous: as soon as some evaluation is finished,
+            its result is passed to the parameter generator and the next point is started.
+
+        timeout: float or None, max time in seconds for one local evaluation,
+            evaluations running longer are cancelled (and have no score)
+
+        fold_n_jobs: int, the number of processes used to evaluate folds of one point in parallel.
+            Local worker processes are forked, so the training data is not copied to them
+            (fork start method of multiprocessing is required).
+
+        result_store: None, ResultStore or str (path to SQLite file).
+            If passed, each result is saved to store (together with time and peak memory of evaluation,
+            peak memory is measured only for evaluations in separate processes: n_jobs > 1 or timeout).
+            Results are not stored if score function or parameters can't be described (i.e. lambdas).
+            Results previously computed with the same estimator, data and cross-validation settings
+            are not recomputed and are passed to parameter generator before the search starts.
+
+        stages_parameter: None or str, the name of parameter which is the number of stages (i.e. 'n_estimators').
+            If passed, points which differ only in this parameter are evaluated together:
+            estimator is trained once with maximal number of stages from grid and evaluated
+            with staged_predict_proba after each number of stages from grid.
+            For staged scores to be the same as for separately trained estimators
+            the score function should depend only on order of predictions (as ROC AUC does).
+
         refit: if True, an estimator is trained with best found parameters
 
         Attributes
@@ -340,6 +633,11 @@ class GridOptimalSearchCV(BaseEstimator, ClassifierMixin):
         self.log_name = log_name
         self.label = label
         self.scorer_needs_x = scorer_needs_x
+        self.n_jobs = n_jobs
+        self.timeout = timeout
+        self.fold_n_jobs = fold_n_jobs
+        self.result_store = result_store
+        self.stages_parameter = stages_parameter
 
     def _log(self, *objects):
         logger = logging.getLogger(__name__)
@@ -356,60 +654,306 @@ class GridOptimalSearchCV(BaseEstimator, ClassifierMixin):
         if self.score_function is None:
             self.score_function = roc_auc_score
         assert self.fold_checks <= self.folds, "We cannot have more checks than folds"
+        # with int random_state scores are reproducible, so it is a part of setup in result store
+        self._reproducible_seed = self.random_state if isinstance(self.random_state, numbers.Integral) else None
         self.random_state = check_random_state(self.random_state)
+        # folds and subsamples are the same for all evaluations
+        self._evaluation_seed = self.random_state.randint(2 ** 30)
+        if isinstance(self.result_store, string_types):
+            self.result_store = ResultStore(self.result_store)
+        if self.stages_parameter is not None:
+            assert self.stages_parameter in self.generator.param_grid, 'stages_parameter should be in param_grid'
+            # one evaluation gives results for all numbers of stages,
+            # so there are only this number of different evaluations
+            n_points = numpy.prod(self.generator.dimensions) // len(self.generator.param_grid[self.stages_parameter])
+            if self.generator.n_evaluations > n_points:
+                warn('The number of evaluations was decreased to %i' % n_points, UserWarning)
+                self.generator.n_evaluations = n_points
+
+    def _evaluation_options(self, state_dict):
+        """:return: parameters of estimator to train and stages to evaluate (or None)"""
+        if self.stages_parameter is None:
+            return state_dict, None
+        stages = list(self.generator.param_grid[self.stages_parameter])
+        params_dict = OrderedDict(state_dict)
+        params_dict[self.stages_parameter] = max(stages)
+        return params_dict, stages
+
+    def _describe_point(self, state_dict):
+        """Descriptions of all parameters of estimator with parameters from grid"""
+        point = dict(state_dict)
+        extra = {}
+        if TRAIN_FRACTION in point:
+            extra[TRAIN_FRACTION] = describe_value(point.pop(TRAIN_FRACTION))
+        _, params = describe_estimator(sklearn.clone(self.base_estimator).set_params(**point))
+        params.update(extra)
+        return params
+
+    def _prepare_store(self, X, y, sample_weight):
+        """Computes key of this search in result store and passes previous results to generator.
+        If score function or estimator can't be described (i.e. it is lambda), results are not stored."""
+        try:
+            store_key = dict(estimator=describe_estimator(self.base_estimator)[0],
+                             data=data_fingerprint(X, y, sample_weight),
+                             setup={'folds': self.folds, 'fold_checks': self.fold_checks, 'label': self.label,
+                                    'score_function': describe_value(self.score_function),
+                                    'scorer_needs_x': self.scorer_needs_x,
+                                    'random_state': self._reproducible_seed})
+            _, base_params = describe_estimator(self.base_estimator)
+        except ValueError as e:
+            warn('Results are not stored: {}'.format(e), UserWarning)
+            return
+        self._store_key = store_key
+        grid = self.generator.param_grid
+        value_indices = dict((name, {}) for name in grid)
+        for name, values in grid.items():
+            for index, value in enumerate(values):
+                try:
+                    value_indices[name][describe_value(value)] = index
+                except ValueError:
+                    # points with this value are not stored
+                    pass
+        n_seeded = 0
+        # with stages_parameter one evaluation gives results for all stages
+        seeded_evaluations = set()
+        for params, score in self.result_store.get_all(**self._store_key):
+            if set(params) != set(base_params):
+                continue
+            if any(params[name] != value for name, value in base_params.items() if name not in grid):
+                continue
+            if any(params[name] not in value_indices[name] for name in grid):
+                continue
+            state_indices = tuple(value_indices[name][params[name]] for name in grid)
+            if self.generator.seed_result(state_indices, score):
+                n_seeded += 1
+                seeded_evaluations.add(self._evaluation_key(state_indices))
+        self.evaluations_done += len(seeded_evaluations)
+        self._log("{} results are taken from store".format(n_seeded))
+
+    def _evaluation_key(self, state_indices):
+        """Points with the same key are computed by the same evaluation (they differ only in number of stages)"""
+        if self.stages_parameter is None:
+            return state_indices
+        axis = list(self.generator.param_grid).index(self.stages_parameter)
+        return state_indices[:axis] + state_indices[axis + 1:]
+
+    def _stage_siblings(self, state_indices):
+        """Yields (stage_index, indices) of points differing from this one only in number of stages"""
+        if self.stages_parameter is None or \
+                not all(isinstance(index, numbers.Integral) for index in state_indices):
+            # special keys of generators (i.e. for subgrids) have no siblings
+            return
+        axis = list(self.generator.param_grid).index(self.stages_parameter)
+        for stage_index in range(len(self.generator.param_grid[self.stages_parameter])):
+            if stage_index != state_indices[axis]:
+                yield stage_index, state_indices[:axis] + (stage_index, ) + state_indices[axis + 1:]
+
+    def _generate_next_point(self):
+        """Requests point from generator. Points differing only in number of stages are marked as queued,
+        so that generator doesn't propose them while evaluation of this point is running"""
+        state_indices, state_dict = self.generator.generate_next_point()
+        for _, other_indices in self._stage_siblings(state_indices):
+            if other_indices not in self.generator.queued_tasks_:
+                self.generator.queued_tasks_.add(other_indices)
+                self._reserved_points.add(other_indices)
+        return state_indices, state_dict
+
+    def _generate_batch_points(self, size):
+        if self.stages_parameter is None:
+            return self.generator.generate_batch_points(size=size)
+        return zip(*[self._generate_next_point() for _ in range(size)])
+
+    def _describe_stored_point(self, state_dict):
+        """Descriptions of parameters used in result store, None if results are not stored"""
+        if self._store_key is None:
+            return None
+        try:
+            return self._describe_point(state_dict)
+        except ValueError:
+            return None
+
+    def _get_stored_score(self, state_dict):
+        params = self._describe_stored_point(state_dict)
+        if params is None:
+            return None
+        return self.result_store.get(params=params, **self._store_key)
 
     def fit(self, X, y, sample_weight=None):
         self._check_params()
         self.evaluations_done = 0
-        X = pandas.DataFrame(X)
+        X = commonutils.check_dataframe(X)
         self._log("\n\nGridSearch started\n\n")
+        self._store_key = None
+        # points marked as queued by evaluation of other point with different number of stages
+        self._reserved_points = set()
+        if self.result_store is not None:
+            self._prepare_store(X, y, sample_weight)
 
-        if self.ipc_profile is None:
+        if self.ipc_profile is None and self.n_jobs == 1 and self.timeout is None:
             while self.evaluations_done < self.generator.n_evaluations:
-                state_indices, state_dict = self.generator.generate_next_point()
-                value = estimate_classifier(params_dict=state_dict, base_estimator=self.base_estimator,
-                                            X=X, y=y, folds=self.folds, fold_checks=self.fold_checks,
-                                            score_function=self.score_function, sample_weight=sample_weight,
-                                            label=self.label,
-                                            scorer_needs_x=self.scorer_needs_x,
-                                            catch_exceptions=False)
-
-                self.generator.add_result(state_indices, value)
-                self.evaluations_done += 1
-                state_string = ", ".join([k + '=' + str(v) for k, v in state_dict.items()])
-                self._log(value, ": ", state_string)
+                state_indices, state_dict = self._generate_next_point()
+                stored_score = self._get_stored_score(state_dict)
+                if stored_score is not None:
+                    self._add_result(state_indices, state_dict, stored_score)
+                    continue
+                params_dict, stages = self._evaluation_options(state_dict)
+                result = _timed_estimate_classifier(params_dict=params_dict, base_estimator=self.base_estimator,
+                                                    X=X, y=y, folds=self.folds, fold_checks=self.fold_checks,
+                                                    score_function=self.score_function, sample_weight=sample_weight,
+                                                    label=self.label,
+                                                    scorer_needs_x=self.scorer_needs_x,
+                                                    catch_exceptions=False, n_jobs=self.fold_n_jobs, stages=stages,
+                                                    random_state=self._evaluation_seed)
+                self._add_result(state_indices, state_dict, *result)
+        elif self.ipc_profile is None:
+            self._fit_local_async(X, y, sample_weight=sample_weight)
         else:
-            from IPython.parallel import Client
-            direct_view = Client(profile=self.ipc_profile).direct_view()
+            from IPython.parallel import Client, Reference
+            client = Client(profile=self.ipc_profile)
+            direct_view = client.direct_view()
             portion = len(direct_view)
             print("There are {0} cores in cluster, the portion is equal {1}".format(len(direct_view), portion))
+            # data is sent to each engine once, tasks only refer to it
+            direct_view.push({'_grid_search_X': X, '_grid_search_y': y, '_grid_search_weight': sample_weight},
+                             block=True)
+            balanced_view = client.load_balanced_view()
             while self.evaluations_done < self.generator.n_evaluations:
-                state_indices_array, state_dict_array = self.generator.generate_batch_points(size=portion)
-                result = direct_view.map_sync(estimate_classifier, state_dict_array,
-                    [self.base_estimator] * portion, [X]*portion, [y]*portion,
-                    [self.folds] * portion, [self.fold_checks] * portion,
-                    [self.score_function] * portion,
-                    [sample_weight]*portion,
-                    [self.label]*portion,
-                    [self.scorer_needs_x] * portion)
-                assert len(result) == portion, "The length of result is very strange"
-                for state_indices, state_dict, score in zip(state_indices_array, state_dict_array, result):
-                    params = ", ".join([k + '=' + str(v) for k, v in state_dict.items()])
-                    if isinstance(score, Exception):
-                        # returned exception
-                        message = 'Fail during training on the node \nException ' + str(score) +\
-                                  '\nParameters:' + params
-                        print(message)
-                        self._log(message)
+                state_indices_array, state_dict_array = self._generate_batch_points(size=portion)
+                tasks = []
+                for state_indices, state_dict in zip(state_indices_array, state_dict_array):
+                    stored_score = self._get_stored_score(state_dict)
+                    if stored_score is not None:
+                        self._add_result(state_indices, state_dict, stored_score)
                         continue
-                    self.generator.add_result(state_indices, score)
-                    self._log(score, ": ", params)
-
-                self.evaluations_done += portion
+                    params_dict, stages = self._evaluation_options(state_dict)
+                    task = balanced_view.apply_async(_timed_estimate_classifier, params_dict, self.base_estimator,
+                                                     Reference('_grid_search_X'), Reference('_grid_search_y'),
+                                                     self.folds, self.fold_checks, self.score_function,
+                                                     Reference('_grid_search_weight'), self.label,
+                                                     self.scorer_needs_x, stages=stages,
+                                                     random_state=self._evaluation_seed)
+                    tasks.append((state_indices, state_dict, task))
+                for state_indices, state_dict, task in tasks:
+                    self._add_result(state_indices, state_dict, *task.get())
                 print("%i evaluations done" % self.evaluations_done)
+            direct_view.execute('del _grid_search_X, _grid_search_y, _grid_search_weight', block=True)
         if self.refit:
             self._fit_best_estimator(X, y, sample_weight=sample_weight)
 
+    def _add_result(self, state_indices, state_dict, score, evaluation_time=None, peak_memory=None):
+        """Passes the result of evaluation to generator (and to store), failed evaluations return exceptions.
+        Results taken from store have no time of evaluation."""
+        self.evaluations_done += 1
+        if isinstance(score, Exception):
+            params = ", ".join([k + '=' + str(v) for k, v in state_dict.items()])
+            message = 'Fail during training \nException ' + str(score) + '\nParameters:' + params
+            print(message)
+            self._log(message)
+            return
+        if numpy.ndim(score) == 0:
+            self._add_point_result(state_indices, state_dict, score, evaluation_time, peak_memory)
+            # score of single point is taken from store, other stages can be proposed again
+            for _, other_indices in self._stage_siblings(state_indices):
+                if other_indices in self._reserved_points:
+                    self._reserved_points.remove(other_indices)
+                    self.generator.queued_tasks_.discard(other_indices)
+            return
+
+        # scores for all numbers of stages in grid
+        stages = list(self.generator.param_grid[self.stages_parameter])
+        own_stage = stages.index(state_dict[self.stages_parameter])
+        self._add_point_result(state_indices, state_dict, score[own_stage], evaluation_time, peak_memory)
+        for stage_index, other_indices in self._stage_siblings(state_indices):
+            stage_score = score[stage_index]
+            if other_indices in self._reserved_points:
+                self._reserved_points.remove(other_indices)
+                self.generator.add_result(other_indices, stage_score)
+            elif not self.generator.seed_result(other_indices, stage_score):
+                continue
+            self._add_point_result(other_indices, self.generator.indices_to_parameters(other_indices),
+                                   stage_score, evaluation_time, peak_memory, add_to_generator=False)
+
+    def _add_point_result(self, state_indices, state_dict, score, evaluation_time, peak_memory,
+                          add_to_generator=True):
+        params = ", ".join([k + '=' + str(v) for k, v in state_dict.items()])
+        if add_to_generator:
+            self.generator.add_result(state_indices, score)
+        stored_params = self._describe_stored_point(state_dict) if evaluation_time is not None else None
+        if stored_params is not None:
+            self.result_store.add(params=stored_params, score=score,
+                                  evaluation_time=evaluation_time, peak_memory=peak_memory, **self._store_key)
+        self._log(score, ": ", params)
+
+    def _fit_local_async(self, X, y, sample_weight=None):
+        """
+        Evaluations are done in separate processes, at most n_jobs at the same time.
+        New point is requested from generator as soon as some evaluation is finished,
+        so slow evaluations don't stall others. Process is terminated if evaluation exceeds timeout,
+        all running processes are terminated if fit is interrupted.
+        Each evaluation process leads its own process group, so it is terminated together with
+        the pool evaluating folds (fold_n_jobs > 1). Such processes can't be daemonic, so unlike
+        processes with fold_n_jobs=1 they are not terminated if the main process is killed.
+        """
+        evaluation_kwargs = dict(base_estimator=self.base_estimator, X=X, y=y, folds=self.folds,
+                                 fold_checks=self.fold_checks, score_function=self.score_function,
+                                 sample_weight=sample_weight, label=self.label, scorer_needs_x=self.scorer_needs_x,
+                                 n_jobs=self.fold_n_jobs, random_state=self._evaluation_seed)
+        # list of [process, connection, state_indices, state_dict, start_time]
+        running = []
+        n_started = 0
+        # results taken from store before search
+        n_seeded = self.evaluations_done
+        try:
+            while self.evaluations_done < self.generator.n_evaluations:
+                while len(running) < self.n_jobs and n_started < self.generator.n_evaluations - n_seeded:
+                    state_indices, state_dict = self._generate_next_point()
+                    n_started += 1
+                    stored_score = self._get_stored_score(state_dict)
+                    if stored_score is not None:
+                        self._add_result(state_indices, state_dict, stored_score)
+                        continue
+                    params_dict, stages = self._evaluation_options(state_dict)
+                    connection, child_connection = multiprocessing.Pipe(duplex=False)
+                    process = multiprocessing.Process(target=_estimate_in_subprocess,
+                                                      args=(child_connection, dict(params_dict=params_dict,
+                                                                                   stages=stages,
+                                                                                   **evaluation_kwargs)))
+                    # daemonic processes can't start pools, so with fold_n_jobs > 1 processes are not daemonic
+                    process.daemon = self.fold_n_jobs == 1
+                    process.start()
+                    # done both here and in child, so the group exists whichever is first
+                    _make_process_group(process.pid)
+                    child_connection.close()
+                    running.append([process, connection, state_indices, state_dict, time.time()])
+
+                still_running = []
+                for task in running:
+                    process, connection, state_indices, state_dict, start_time = task
+                    if connection.poll():
+                        try:
+                            result = connection.recv()
+                        except EOFError:
+                            result = [RuntimeError('Worker process finished without result')]
+                    elif not process.is_alive() and not connection.poll():
+                        result = [RuntimeError('Worker process died, exit code {}'.format(process.exitcode))]
+                    elif self.timeout is not None and time.time() - start_time > self.timeout:
+                        _terminate_process(process)
+                        result = [RuntimeError('Evaluation cancelled after {} seconds'.format(self.timeout))]
+                    else:
+                        still_running.append(task)
+                        continue
+                    process.join()
+                    connection.close()
+                    self._add_result(state_indices, state_dict, *result)
+                if len(still_running) == len(running):
+                    time.sleep(0.01)
+                running = still_running
+        finally:
+            for process, connection, _, _, _ in running:
+                _terminate_process(process)
+                process.join()
+                connection.close()
+
     def _fit_best_estimator(self, X, y, sample_weight=None):
         # Training classifier once again
         self.best_estimator_ = sklearn.clone(self.base_estimator).set_params(**self.generator.best_params_)
@@ -10,10 +10,13 @@ import pandas
 from scipy import sparse
 from scipy.special import expit
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 from sklearn.utils.validation import check_random_state
 from sklearn.base import BaseEstimator
+from sklearn.neighbors.unsupervised import NearestNeighbors
 
-from .commonutils import computeSignalKnnIndices, indices_of_values, check_sample_weight, check_uniform_label
+from .commonutils import computeSignalKnnIndices, indices_of_values, check_sample_weight, check_uniform_label, \
+    check_dataframe, get_float_dtype, csr_dot
 from .metrics_utils import bin_to_group_indices, compute_group_weights, compute_bin_indices
 
 __author__ = 'Alex Rogozhnikov'
@@ -21,17 +24,22 @@ __author__ = 'Alex Rogozhnikov'
 
 def compute_positions(y_pred, sample_weight):
     """For each event computes it position among other events by prediction.
-    position = part of elements with lower predictions => position belongs to [0, 1]"""
+    position = part of elements with lower predictions => position belongs to [0, 1]
+    Positions have the same type as weights, but are accumulated in float64."""
     order = numpy.argsort(y_pred)
     ordered_weights = sample_weight[order]
-    ordered_weights /= float(numpy.sum(ordered_weights))
-    efficiencies = (numpy.cumsum(ordered_weights) - 0.5 * ordered_weights)
-    return efficiencies[numpy.argsort(order)]
+    ordered_weights /= numpy.sum(ordered_weights, dtype=numpy.float64)
+    efficiencies = numpy.cumsum(ordered_weights, dtype=numpy.float64)
+    efficiencies -= 0.5 * ordered_weights
+    result = numpy.empty(len(order), dtype=sample_weight.dtype)
+    result[order] = efficiencies
+    return result
 
 
 class AbstractLossFunction(BaseEstimator):
     def fit(self, X, y, sample_weight):
-        """ This method is optional, it is called before all the others."""
+        """ This method is optional, it is called before all the others.
+        Losses which support float32 mode compute in float32 if sample_weight passed to fit is float32."""
         pass
 
     def negative_gradient(self, y_pred):
@@ -93,14 +101,24 @@ class AdaLossFunction(AbstractLossFunction):
 
     def fit(self, X, y, sample_weight):
         self.y = y
-        self.sample_weight = sample_weight
-        self.y_signed = 2 * y - 1
+        self.sample_weight = check_sample_weight(y, sample_weight, dtype=get_float_dtype(sample_weight))
+        self.y_signed = numpy.array(2 * y - 1, dtype=self.sample_weight.dtype)
+
+    def _weighted_exponents(self, y_pred):
+        """ sample_weight * exp(- y_signed * y_pred), computed without extra temporary arrays """
+        result = numpy.multiply(self.y_signed, y_pred)
+        numpy.negative(result, out=result)
+        numpy.exp(result, out=result)
+        result *= self.sample_weight
+        return result
 
     def __call__(self, y_pred):
-        return numpy.sum(self.sample_weight * numpy.exp(- self.y_signed * y_pred))
+        return numpy.sum(self._weighted_exponents(y_pred), dtype=numpy.float64)
 
     def negative_gradient(self, y_pred):
-        return self.y_signed * self.sample_weight * numpy.exp(- self.y_signed * y_pred)
+        result = self._weighted_exponents(y_pred)
+        result *= self.y_signed
+        return result
 
     def update_tree_leaf(self, leaf, indices_in_leaf, X, y, y_pred, sample_weight, update_mask, residual):
         leaf_ans = y[indices_in_leaf]
@@ -117,11 +135,11 @@ class AdaLossFunction(AbstractLossFunction):
 class BinomialDevianceLossFunction(AbstractLossFunction):
     def fit(self, X, y, sample_weight):
         self.y = y
-        self.sample_weight = sample_weight
-        self.y_signed = 2 * y - 1
+        self.sample_weight = check_sample_weight(y, sample_weight, dtype=get_float_dtype(sample_weight))
+        self.y_signed = numpy.array(2 * y - 1, dtype=self.sample_weight.dtype)
 
     def __call__(self, y_pred):
-        return numpy.sum(self.sample_weight * numpy.logaddexp(0, - self.y_signed * y_pred))
+        return numpy.sum(self.sample_weight * numpy.logaddexp(0, - self.y_signed * y_pred), dtype=numpy.float64)
 
     def negative_gradient(self, y_pred):
         return self.y_signed * self.sample_weight * expit(- self.y_signed * y_pred)
@@ -140,13 +158,102 @@ class BinomialDevianceLossFunction(AbstractLossFunction):
 # region MatrixLossFunction
 
 
+class CompactSparseMatrix(object):
+    def __init__(self, indptr, indices, row_values, n_columns, chunk_size=1000000):
+        """
+        Sparse matrix, in which all nonzero elements of each row are equal (like matrices of knn-based losses).
+        Only positions of elements (indptr and indices as in CSR format) and one value per row are stored,
+        the product with transposed matrix is computed without building transposed copy.
+        :param indptr: numpy.array of shape [n_rows + 1], row i has nonzero elements in columns
+            indices[indptr[i]:indptr[i + 1]]
+        :param indices: numpy.array with column indices (int32 is used if there are less than 2^31 columns)
+        :param row_values: numpy.array of shape [n_rows], the value of nonzero elements in each row
+        :param int n_columns: the number of columns
+        :param int chunk_size: the number of nonzero elements processed at once (limits temporary memory)
+        """
+        self.indptr = numpy.asarray(indptr)
+        self.indices = numpy.asarray(indices)
+        self.row_values = numpy.asarray(row_values)
+        assert len(self.indptr) == len(self.row_values) + 1, 'wrong length of indptr'
+        assert self.indptr[-1] == len(self.indices), 'wrong length of indices'
+        self.shape = (len(self.row_values), n_columns)
+        self.chunk_size = chunk_size
+
+    @property
+    def nnz(self):
+        return len(self.indices)
+
+    def _row_blocks(self, chunk_size):
+        """Splits rows into blocks with approximately chunk_size nonzero elements"""
+        bounds = numpy.searchsorted(self.indptr, numpy.arange(0, self.nnz, max(chunk_size, 1)), side='right') - 1
+        bounds = numpy.unique(numpy.append(bounds, [0, self.shape[0]]))
+        return zip(bounds[:-1], bounds[1:])
+
+    def dot(self, vector, out=None, n_threads=1):
+        """
+        Computes the product with vector of shape [n_columns]
+        :param out: None or numpy.array of shape [n_rows], where the result is written
+        :param int n_threads: the number of threads, blocks of rows are processed in parallel
+        """
+        assert len(vector) == self.shape[1], 'wrong length of vector'
+        if out is None:
+            out = numpy.empty(self.shape[0], dtype=numpy.result_type(vector, self.row_values))
+
+        def multiply_block(bounds):
+            start, stop = bounds
+            first, last = self.indptr[start], self.indptr[stop]
+            out[start:stop] = 0
+            row_starts = self.indptr[start:stop] - first
+            nonempty = numpy.flatnonzero(numpy.diff(self.indptr[start:stop + 1]) > 0)
+            if len(nonempty) > 0:
+                values = numpy.take(vector, self.indices[first:last])
+                out[start + nonempty] = numpy.add.reduceat(values, row_starts[nonempty]) \
+                    * self.row_values[start + nonempty]
+
+        blocks = self._row_blocks(self.chunk_size)
+        if n_threads == 1:
+            for block in blocks:
+                multiply_block(block)
+        else:
+            pool = ThreadPool(n_threads)
+            try:
+                pool.map(multiply_block, blocks)
+            finally:
+                pool.close()
+        return out
+
+    def transpose_dot(self, vector):
+        """Computes the product of transposed matrix with vector of shape [n_rows]"""
+        assert len(vector) == self.shape[0], 'wrong length of vector'
+        result = numpy.zeros(self.shape[1])
+        # blocks have at least n_columns elements, so the time of bincount is proportional to number of elements
+        for start, stop in self._row_blocks(max(self.chunk_size, self.shape[1])):
+            first, last = self.indptr[start], self.indptr[stop]
+            weights = numpy.repeat(vector[start:stop] * self.row_values[start:stop],
+                                   numpy.diff(self.indptr[start:stop + 1]))
+            result += numpy.bincount(self.indices[first:last], weights=weights, minlength=self.shape[1])
+        return result
+
+    def tocsr(self):
+        """Converts to scipy.sparse.csr_matrix"""
+        data = numpy.repeat(self.row_values, numpy.diff(self.indptr))
+        return sparse.csr_matrix((data, self.indices, self.indptr), shape=self.shape)
+
+
 class AbstractMatrixLossFunction(AbstractLossFunction):
-    def __init__(self, uniform_variables):
+    def __init__(self, uniform_variables, n_threads=1):
         """KnnLossFunction is a base class to be inherited by other loss functions,
         which choose the particular A matrix and w vector. The formula of loss is:
         loss = \sum_i w_i * exp(- \sum_j a_ij y_j score_j)
+        A may be any scipy.sparse matrix (A_t is its transposed view, the data is not copied)
+        or CompactSparseMatrix.
+
+        Exponents are computed once for each value of predictions (loss, gradient and update of tree
+        at the same predictions share them), intermediate arrays are preallocated during fitting.
+        :param int n_threads: number of threads used in sparse matrix-vector products
         """
         self.uniform_variables = uniform_variables
+        self.n_threads = n_threads
         # real matrix and vector will be computed during fitting
         self.A = None
         self.A_t = None
@@ -156,25 +263,53 @@ class AbstractMatrixLossFunction(AbstractLossFunction):
         """This method is used to compute A matrix and w based on train dataset"""
         assert len(X) == len(y), "different size of arrays"
         A, w = self.compute_parameters(X, y)
-        self.A = sparse.csr_matrix(A)
-        self.A_t = sparse.csr_matrix(self.A.transpose())
+        if isinstance(A, CompactSparseMatrix):
+            self.A = A
+            self.A_t = None
+        else:
+            self.A = sparse.csr_matrix(A)
+            # CSC matrix which shares arrays with A
+            self.A_t = self.A.transpose()
         self.w = numpy.array(w)
         assert A.shape[0] == len(w), "inconsistent sizes"
         assert A.shape[1] == len(X), "wrong size of matrix"
         self.y_signed = 2 * y - 1
+        # buffers: predictions for which exponents were computed, signed predictions, w * exponents
+        self._cached_pred = numpy.zeros(len(X))
+        self._signed_pred = numpy.zeros(len(X))
+        self._exponents = numpy.zeros(A.shape[0])
+        self._cache_valid = False
         return self
 
+    def compute_exponents(self, y_pred):
+        """Returns w * exp(- A (y_signed * y_pred)), computed only if predictions have changed since the last call.
+        The result is stored in a buffer, which is overwritten by next calls."""
+        assert len(y_pred) == self.A.shape[1], "something is wrong with sizes"
+        if self._cache_valid and numpy.array_equal(self._cached_pred, y_pred):
+            return self._exponents
+        self._cached_pred[:] = y_pred
+        numpy.multiply(self.y_signed, y_pred, out=self._signed_pred)
+        if isinstance(self.A, CompactSparseMatrix):
+            self.A.dot(self._signed_pred, out=self._exponents, n_threads=self.n_threads)
+        else:
+            csr_dot(self.A, self._signed_pred, out=self._exponents, n_threads=self.n_threads)
+        numpy.negative(self._exponents, out=self._exponents)
+        numpy.exp(self._exponents, out=self._exponents)
+        self._exponents *= self.w
+        self._cache_valid = True
+        return self._exponents
+
     def __call__(self, y_pred):
         """Computing the loss itself"""
-        assert len(y_pred) == self.A.shape[1], "something is wrong with sizes"
-        exponents = numpy.exp(- self.A.dot(self.y_signed * y_pred))
-        return numpy.sum(self.w * exponents)
+        return numpy.sum(self.compute_exponents(y_pred))
 
     def negative_gradient(self, y_pred):
         """Computing negative gradient"""
-        assert len(y_pred) == self.A.shape[1], "something is wrong with sizes"
-        exponents = numpy.exp(- self.A.dot(self.y_signed * y_pred))
-        result = self.A_t.dot(self.w * exponents) * self.y_signed
+        if isinstance(self.A, CompactSparseMatrix):
+            result = self.A.transpose_dot(self.compute_exponents(y_pred))
+        else:
+            result = self.A_t.dot(self.compute_exponents(y_pred))
+        result *= self.y_signed
         return result
 
     def compute_parameters(self, trainX, trainY):
@@ -182,7 +317,7 @@ class AbstractMatrixLossFunction(AbstractLossFunction):
         raise NotImplementedError()
 
     def update_tree(self, tree, X, y, y_pred, sample_weight, update_mask, residual):
-        self.update_exponents = self.w * numpy.exp(- self.A.dot(self.y_signed * y_pred))
+        self.update_exponents = self.compute_exponents(y_pred)
         AbstractLossFunction.update_tree(self, tree, X, y, y_pred, sample_weight, update_mask, residual)
 
     def update_tree_leaf(self, leaf, indices_in_leaf, X, y, y_pred, sample_weight, update_mask, residual):
@@ -195,56 +330,73 @@ class AbstractMatrixLossFunction(AbstractLossFunction):
 
 
 class SimpleKnnLossFunction(AbstractMatrixLossFunction):
-    def __init__(self, uniform_variables, knn=10, uniform_label=1, distinguish_classes=True, row_norm=1.):
+    def __init__(self, uniform_variables, knn=10, uniform_label=1, distinguish_classes=True, row_norm=1.,
+                 n_threads=1, compact_matrix=False):
         """A matrix is square, each row corresponds to a single event in train dataset, in each row we put ones
         to the closest neighbours of that event if this event from class along which we want to have uniform prediction.
         :param list[str] uniform_variables: the features, along which uniformity is desired
         :param int knn: the number of nonzero elements in the row, corresponding to event in 'uniform class'
         :param int|list[int] uniform_label: the label (labels) of 'uniform classes'
         :param bool distinguish_classes: if True, 1's will be placed only for events of same class.
+        :param int n_threads: number of threads used in sparse matrix-vector products
+        :param bool compact_matrix: if True, A is stored as CompactSparseMatrix, which takes about 1/3 of memory
+            of scipy CSR matrix, but products with it are 2-3 times slower (and products with transposed matrix
+            are not done in threads), otherwise scipy CSR matrix is used.
         """
         self.knn = knn
         self.distinguish_classes = distinguish_classes
         self.row_norm = row_norm
+        self.compact_matrix = compact_matrix
         self.uniform_label = check_uniform_label(uniform_label)
-        AbstractMatrixLossFunction.__init__(self, uniform_variables)
-
-    def compute_parameters(self, trainX, trainY):
-        sample_weight = numpy.ones(len(trainX))
-        A_parts = []
-        w_parts = []
-        for label in self.uniform_label:
-            label_mask = trainY == label
-            n_label = numpy.sum(label_mask)
+        AbstractMatrixLossFunction.__init__(self, uniform_variables, n_threads=n_threads)
+
+    def compute_parameters(self, trainX, trainY, chunk_size=100000):
+        """Returns A (CSR or compact matrix): rows of events from 'uniform classes' (knn nonzero elements each)
+        go first, then rows of other events (one element on diagonal).
+        Neighbours are computed by chunks of chunk_size events and written directly into the array of indices."""
+        trainY = numpy.asarray(trainY)
+        n_samples = len(trainX)
+        uniform_masks = [trainY == label for label in self.uniform_label]
+        other_masks = [trainY == label for label in set(trainY) - set(self.uniform_label)]
+        n_knn_rows = sum(numpy.sum(mask) for mask in uniform_masks)
+        n_other_rows = sum(numpy.sum(mask) for mask in other_masks)
+        n_knn_elements = n_knn_rows * self.knn
+        nnz = n_knn_elements + n_other_rows
+
+        indptr = numpy.concatenate([numpy.arange(0, n_knn_elements, self.knn),
+                                    numpy.arange(n_knn_elements, nnz + 1)])
+        indptr = indptr.astype(numpy.int32 if nnz < 2 ** 31 else numpy.int64)
+        indices = numpy.zeros(nnz, dtype=numpy.int32 if n_samples < 2 ** 31 else numpy.int64)
+        row_values = numpy.concatenate([numpy.repeat(self.row_norm / self.knn, n_knn_rows),
+                                        numpy.repeat(float(self.row_norm), n_other_rows)])
+
+        uniform_features = numpy.array(trainX[list(self.uniform_variables)])
+        position = 0
+        for label_mask in uniform_masks:
             if self.distinguish_classes:
                 mask = label_mask
             else:
-                mask = numpy.ones(len(trainY), dtype=numpy.bool)
-            knn_indices = computeSignalKnnIndices(self.uniform_variables, trainX, mask, self.knn)
-            knn_indices = knn_indices[label_mask, :]
-            ind_ptr = numpy.arange(0, n_label * self.knn + 1, self.knn)
-            column_indices = knn_indices.flatten()
-            data = numpy.ones(n_label * self.knn, dtype=float) * self.row_norm / self.knn
-            A_part = sparse.csr_matrix((data, column_indices, ind_ptr), shape=[n_label, len(trainX)])
-            w_part = numpy.mean(numpy.take(sample_weight, knn_indices), axis=1)
-            assert A_part.shape[0] == len(w_part)
-            A_parts.append(A_part)
-            w_parts.append(w_part)
-
-        for label in set(trainY) - set(self.uniform_label):
-            label_mask = trainY == label
-            n_label = numpy.sum(label_mask)
-            ind_ptr = numpy.arange(0, n_label + 1)
-            column_indices = numpy.where(label_mask)[0].flatten()
-            data = numpy.ones(n_label, dtype=float) * self.row_norm
-            A_part = sparse.csr_matrix((data, column_indices, ind_ptr), shape=[n_label, len(trainX)])
-            w_part = sample_weight[label_mask]
-            A_parts.append(A_part)
-            w_parts.append(w_part)
-
-        A = sparse.vstack(A_parts, format='csr', dtype=float)
-        w = numpy.concatenate(w_parts)
-        assert A.shape == (len(trainX), len(trainX))
+                mask = numpy.ones(n_samples, dtype=bool)
+            neighbours = NearestNeighbors(n_neighbors=self.knn, algorithm='kd_tree').fit(uniform_features[mask])
+            reference_indices = numpy.flatnonzero(mask)
+            query_indices = numpy.flatnonzero(label_mask)
+            for start in range(0, len(query_indices), chunk_size):
+                chunk = query_indices[start:start + chunk_size]
+                _, knn_indices = neighbours.kneighbors(uniform_features[chunk])
+                indices[position:position + knn_indices.size] = numpy.take(reference_indices, knn_indices).ravel()
+                position += knn_indices.size
+
+        for label_mask in other_masks:
+            rows = numpy.flatnonzero(label_mask)
+            indices[position:position + len(rows)] = rows
+            position += len(rows)
+        assert position == nnz
+
+        A = CompactSparseMatrix(indptr, indices, row_values, n_columns=n_samples)
+        if not self.compact_matrix:
+            A = A.tocsr()
+        w = numpy.ones(A.shape[0])
+        assert A.shape == (n_samples, n_samples)
         return A, w
 
 
@@ -287,14 +439,14 @@ class AbstractFlatnessLossFunction(AbstractLossFunction):
         self.use_median = use_median
 
     def fit(self, X, y, sample_weight=None):
-        sample_weight = check_sample_weight(y, sample_weight=sample_weight)
+        sample_weight = check_sample_weight(y, sample_weight=sample_weight, dtype=get_float_dtype(sample_weight))
         assert len(X) == len(y), 'lengths are different'
-        X = pandas.DataFrame(X)
+        X = check_dataframe(X)
 
         self.group_indices = dict()
         self.group_weights = dict()
 
-        occurences = numpy.zeros(len(X))
+        occurences = numpy.zeros(len(X), dtype=sample_weight.dtype)
         for label in self.uniform_label:
             self.group_indices[label] = self.compute_groups_indices(X, y, label=label)
             self.group_weights[label] = compute_group_weights(self.group_indices[label], sample_weight=sample_weight)
@@ -306,7 +458,7 @@ class AbstractFlatnessLossFunction(AbstractLossFunction):
             warnings.warn("%i events out of all bins " % numpy.sum(out_of_bins), UserWarning)
 
         self.y = y
-        self.y_signed = 2 * y - 1
+        self.y_signed = numpy.array(2 * y - 1, dtype=sample_weight.dtype)
         self.sample_weight = numpy.copy(sample_weight)
         self.divided_weight = sample_weight / numpy.maximum(occurences, 1)
 
@@ -324,11 +476,11 @@ class AbstractFlatnessLossFunction(AbstractLossFunction):
 
     def negative_gradient(self, y_pred):
         y_pred = numpy.ravel(y_pred)
-        neg_gradient = numpy.zeros(len(self.y), dtype=numpy.float)
+        neg_gradient = numpy.zeros(len(self.y), dtype=self.sample_weight.dtype)
 
         for label in self.uniform_label:
             label_mask = self.y == label
-            global_positions = numpy.zeros(len(y_pred), dtype=float)
+            global_positions = numpy.zeros(len(y_pred), dtype=self.sample_weight.dtype)
             global_positions[label_mask] = \
                 compute_positions(y_pred[label_mask], sample_weight=self.sample_weight[label_mask])
 
@@ -389,7 +541,7 @@ class BinFlatnessLossFunction(AbstractFlatnessLossFunction):
             bin_limits = []
             for axis_limits in extended_bin_limits:
                 bin_limits.append(axis_limits[1 + shift:-1:2])
-            bin_indices = compute_bin_indices(X.ix[:, self.uniform_variables].values, bin_limits=bin_limits)
+            bin_indices = compute_bin_indices(numpy.array(X[list(self.uniform_variables)]), bin_limits=bin_limits)
             groups_indices += list(bin_to_group_indices(bin_indices, mask=label_mask))
         return groups_indices
 
@@ -7,9 +7,10 @@ from __future__ import division, print_function, absolute_import
 
 import numpy
 import sklearn
+from scipy import sparse
 from sklearn.tree.tree import DecisionTreeClassifier
 
-from .commonutils import computeKnnIndicesOfSameClass, check_uniform_label
+from .commonutils import computeKnnIndicesOfSameClass, check_uniform_label, csr_dot
 from .supplementaryclassifiers import AbstractBoostingClassifier
 
 
@@ -19,6 +20,47 @@ __author__ = 'Alex Rogozhnikov'
 # TODO think on the role of weights
 
 
+def _mean_kernel(knn_scores, out):
+    numpy.mean(knn_scores, axis=1, out=out)
+
+
+def _order_statistic_kernel(position):
+    """Returns kernel computing (interpolated) order statistic of each row, position is in [0, n_neighbours - 1].
+    Partial sorting (partition) is done in place."""
+    lower = int(numpy.floor(position))
+
+    def kernel(knn_scores, out):
+        upper = min(lower + 1, knn_scores.shape[1] - 1)
+        knn_scores.partition(sorted({lower, upper}), axis=1)
+        fraction = position - lower
+        numpy.multiply(knn_scores[:, lower], 1 - fraction, out=out)
+        out += fraction * knn_scores[:, upper]
+
+    return kernel
+
+
+def compute_knn_vote(cumulative_score, knn_indices, kernel, out=None, block_size=2 ** 15):
+    """
+    Computes voted score for each event by scores of its neighbours.
+    The scores of neighbours are collected by blocks of rows into reused buffer (of about block_size elements),
+    so the matrix of shape [n_samples, n_neighbours] is never built.
+    :param kernel: function(knn_scores, out), computes the vote for each row of knn_scores block,
+        may modify knn_scores
+    :param out: None or numpy.array of shape [n_samples], where the result is written
+    """
+    n_samples, n_neighbours = knn_indices.shape
+    if out is None:
+        out = numpy.empty(n_samples)
+    block_rows = max(1, block_size // n_neighbours)
+    buffer = numpy.empty([min(block_rows, n_samples), n_neighbours], dtype=cumulative_score.dtype)
+    for start in range(0, n_samples, block_rows):
+        stop = min(start + block_rows, n_samples)
+        knn_scores = buffer[:stop - start]
+        numpy.take(cumulative_score, knn_indices[start:stop], out=knn_scores)
+        kernel(knn_scores, out[start:stop])
+    return out
+
+
 class MeanAdaBoostClassifier(AbstractBoostingClassifier):
     def __init__(self,
                  uniform_variables=None,
@@ -28,7 +70,9 @@ class MeanAdaBoostClassifier(AbstractBoostingClassifier):
                  n_neighbours=10,
                  uniform_label=1,
                  train_variables=None,
-                 voting='mean'):
+                 voting='mean',
+                 warm_start=False,
+                 n_threads=1):
         """
         Modification of AdaBoostClassifier, has modified reweighting procedure
         (as described in article 'New Approaches for Boosting to Uniformity').
@@ -47,6 +91,11 @@ class MeanAdaBoostClassifier(AbstractBoostingClassifier):
             'mean', 'median', 'random-percentile', 'random-mean', 'matrix'
             (in the 'matrix' case one should also provide a matrix to fit method.
             Matrix is generalization of )
+            Callable is called as voting(cumulative_score, knn_scores), knn_scores is None
+            if callable has attribute needs_knn_scores=False (see experiments.triggermaxvoter)
+        :param warm_start: bool, if True, next call of fit (on the same data) continues training
+            with already built estimators, until there are n_estimators of them.
+        :param n_threads: number of threads used to multiply by matrix (for voting='matrix')
         """
         self.uniform_variables = uniform_variables
         self.base_estimator = base_estimator
@@ -56,44 +105,60 @@ class MeanAdaBoostClassifier(AbstractBoostingClassifier):
         self.uniform_label = uniform_label
         self.train_variables = train_variables
         self.voting = voting
+        self.warm_start = warm_start
+        self.n_threads = n_threads
 
     def fit(self, X, y, sample_weight=None, A=None):
         if self.voting == 'matrix':
             assert A is not None, 'A matrix should be passed'
             assert A.shape == (len(X), len(X)), 'wrong shape of passed matrix'
+            A = sparse.csr_matrix(A)
 
         self.uniform_label = check_uniform_label(self.uniform_label)
         X, y, sample_weight = self.check_input(X, y, sample_weight)
         y_signed = 2 * y - 1
 
-        knn_indices = computeKnnIndicesOfSameClass(self.uniform_variables, X, y, self.n_neighbours)
+        if self.warm_start and getattr(self, '_train_state', None) is not None:
+            cumulative_score, knn_indices = self._train_state
+            assert len(cumulative_score) == len(X), 'warm start is possible only on the same data'
+            assert self.n_estimators >= len(self.estimators), 'n_estimators is less than number of trained estimators'
+        else:
+            knn_indices = computeKnnIndicesOfSameClass(self.uniform_variables, X, y, self.n_neighbours)
 
-        # for those events with non-uniform label we repeat it's own index several times
-        for label in [0, 1]:
-            if label not in self.uniform_label:
-                knn_indices[y == label, :] = numpy.arange(len(y))[y == label][:, numpy.newaxis]
+            # for those events with non-uniform label we repeat it's own index several times
+            for label in [0, 1]:
+                if label not in self.uniform_label:
+                    knn_indices[y == label, :] = numpy.arange(len(y))[y == label][:, numpy.newaxis]
+            cumulative_score = numpy.zeros(len(X))
+            self.estimators = []
 
         X = self.get_train_vars(X)
-        cumulative_score = numpy.zeros(len(X))
-        self.estimators = []
 
-        for stage in range(self.n_estimators):
-            knn_scores = numpy.take(cumulative_score, knn_indices)
+        voted_score = numpy.zeros(len(X))
+        n_neighbours = knn_indices.shape[1]
+        for stage in range(len(self.estimators), self.n_estimators):
             if self.voting == 'mean':
-                voted_score = numpy.mean(knn_scores, axis=1)
+                compute_knn_vote(cumulative_score, knn_indices, _mean_kernel, out=voted_score)
             elif self.voting == 'median':
-                voted_score = numpy.median(knn_scores, axis=1)
+                kernel = _order_statistic_kernel((n_neighbours - 1) / 2.)
+                compute_knn_vote(cumulative_score, knn_indices, kernel, out=voted_score)
             elif self.voting == 'random-percentile':
-                voted_score = numpy.percentile(knn_scores, numpy.random.random(), axis=1)
+                # percentile is in [0, 1) percents, as in numpy.percentile(..., numpy.random.random())
+                kernel = _order_statistic_kernel(numpy.random.random() / 100. * (n_neighbours - 1))
+                compute_knn_vote(cumulative_score, knn_indices, kernel, out=voted_score)
             elif self.voting == 'random-mean':
                 n_feats = numpy.random.randint(self.n_neighbours//2, self.n_neighbours)
-                voted_score = numpy.mean(knn_scores[:, :n_feats], axis=1)
+                compute_knn_vote(cumulative_score, knn_indices[:, :n_feats], _mean_kernel, out=voted_score)
             elif self.voting == 'matrix':
-                voted_score = A.dot(cumulative_score)
+                csr_dot(A, cumulative_score, out=voted_score, n_threads=self.n_threads)
             else:  # self.voting is callable
                 assert not isinstance(self.voting, str), \
                     'unknown value for voting: {}'.format(self.voting)
-                voted_score = self.voting(cumulative_score, knn_scores)
+                # voters may declare that they don't need scores of neighbours
+                if getattr(self.voting, 'needs_knn_scores', True):
+                    voted_score = self.voting(cumulative_score, numpy.take(cumulative_score, knn_indices))
+                else:
+                    voted_score = self.voting(cumulative_score, None)
 
             weight = sample_weight * numpy.exp(- y_signed * voted_score)
             weight = self.normalize_weights(y=y, sample_weight=weight)
@@ -103,6 +168,8 @@ class MeanAdaBoostClassifier(AbstractBoostingClassifier):
             cumulative_score += self.learning_rate * self.compute_score(classifier, X=X)
             self.estimators.append(classifier)
 
+        # scores on training data and neighbours are needed only to continue training
+        self._train_state = (cumulative_score, knn_indices) if self.warm_start else None
         return self
 
     @staticmethod
@@ -14,7 +14,7 @@ from sklearn.metrics import roc_curve
 
 from .commonutils import check_sample_weight, computeSignalKnnIndices
 from . import metrics_utils as ut
-from hep_ml.commonutils import take_features, check_xyw, weighted_percentile
+from hep_ml.commonutils import take_features, check_xyw, weighted_percentile, check_dataframe
 
 
 __author__ = 'Alex Rogozhnikov'
@@ -102,7 +102,7 @@ def sensitivity(y_true, y_score, sample_weight=None):
 
 def optimal_sensitivity(y_true, y_score, sample_weight=None):
     """s,b are normalized to be in [0,1] """
-    from sklearn.metrics import roc_curve
+    from .roc_utils import roc_curve
 
     b, s, _ = roc_curve(y_true, y_score, sample_weight=sample_weight)
     return numpy.max(s / numpy.sqrt(s + b + 1e-6))
@@ -382,7 +382,7 @@ def sde(y, proba, X, uniform_variables, sample_weight=None, label=1, knn=30):
     y = column_or_1d(y)
     sample_weight = check_sample_weight(y, sample_weight=sample_weight)
 
-    X = pandas.DataFrame(X)
+    X = check_dataframe(X)
     mask = y == label
     groups = computeSignalKnnIndices(uniform_variables=uniform_variables, dataframe=X, is_signal=mask, n_neighbors=knn)
     groups = groups[mask, :]
@@ -420,7 +420,7 @@ def cvm_flatness(y, proba, X, uniform_variables, sample_weight=None, label=1, kn
     y = column_or_1d(y)
     sample_weight = check_sample_weight(y, sample_weight=sample_weight)
 
-    X = pandas.DataFrame(X)
+    X = check_dataframe(X)
 
     signal_mask = y == label
     groups_indices = computeSignalKnnIndices(uniform_variables=uniform_variables, dataframe=X,
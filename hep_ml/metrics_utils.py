@@ -1,7 +1,7 @@
 from __future__ import division, print_function, absolute_import
 
 import numpy
-from .commonutils import check_sample_weight, sigmoid_function, compute_cut_for_efficiency
+from .commonutils import check_sample_weight, sigmoid_function, compute_cut_for_efficiency, get_float_dtype
 from sklearn.utils.validation import column_or_1d
 
 __author__ = 'Alex Rogozhnikov'
@@ -35,7 +35,7 @@ def prepare_distibution(data, weights):
     """Prepares the distribution to be used later in KS and CvM,
     merges equal data, computes (summed) weights and cumulative distribution.
     All output arrays are of same length and correspond to each other."""
-    weights = weights / numpy.sum(weights)
+    weights = weights / numpy.sum(weights, dtype=numpy.float64)
     prepared_data, indices = numpy.unique(data, return_inverse=True)
     prepared_weights = numpy.bincount(indices, weights=weights)
     prepared_cdf = compute_cdf(prepared_weights)
@@ -104,9 +104,10 @@ def bin_to_group_indices(bin_indices, mask):
 
 def compute_cdf(ordered_weights):
     """Computes cumulative distribution function (CDF) by ordered weights,
-    be sure that sum(ordered_weights) == 1
+    be sure that sum(ordered_weights) == 1.
+    The sum is accumulated in float64 (also for float32 weights).
     """
-    return numpy.cumsum(ordered_weights) - 0.5 * ordered_weights
+    return numpy.cumsum(ordered_weights, dtype=numpy.float64) - 0.5 * ordered_weights
 
 
 def compute_bin_weights(bin_indices, sample_weight):
@@ -130,7 +131,7 @@ def compute_group_weights(group_indices, sample_weight):
     divided_weight = compute_divided_weight(group_indices, sample_weight=sample_weight)
     result = numpy.zeros(len(group_indices))
     for i, group in enumerate(group_indices):
-        result[i] = numpy.sum(divided_weight[group])
+        result[i] = numpy.sum(divided_weight[group], dtype=numpy.float64)
     return result / numpy.sum(result)
 
 
@@ -151,10 +152,12 @@ def compute_bin_efficiencies(y_score, bin_indices, cut, sample_weight, minlength
 
 
 def compute_group_efficiencies(y_score, groups_indices, cut, sample_weight=None, smoothing=0.0):
+    """Efficiencies are computed in float32 if y_score and sample_weight are float32 (otherwise in float64)"""
     y_score = column_or_1d(y_score)
-    sample_weight = check_sample_weight(y_score, sample_weight=sample_weight)
+    dtype = get_float_dtype(y_score, sample_weight)
+    sample_weight = check_sample_weight(y_score, sample_weight=sample_weight, dtype=dtype)
     # with smoothing=0, this is
-    passed_cut = sigmoid_function(y_score - cut, width=smoothing)
+    passed_cut = numpy.asarray(sigmoid_function(y_score - cut, width=smoothing), dtype=dtype)
 
     if isinstance(groups_indices, numpy.ndarray) and numpy.ndim(groups_indices) == 2:
         # this speedup is specially for knn
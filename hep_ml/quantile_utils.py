@@ -0,0 +1,210 @@
+"""
+`quantile_utils` contains weighted percentiles in three flavours:
+
+* `weighted_percentiles_2d` - percentiles for many arrays at once (one set of percentiles for each row)
+* `SortedSample` - sorts the data once, after that any number of percentiles can be computed cheaply
+* `QuantileSketch` - mergeable streaming summary with bounded memory,
+  for samples that can't be sorted in memory
+
+Percentiles should be in [0, 1], the conventions are the same as in commonutils.weighted_percentile.
+"""
+from __future__ import division, print_function, absolute_import
+
+import numpy
+
+__author__ = 'Alex Rogozhnikov'
+
+__all__ = ['weighted_percentiles_2d', 'SortedSample', 'QuantileSketch']
+
+
+def _check_percentiles(percentiles):
+    percentiles = numpy.asarray(percentiles, dtype=float)
+    assert numpy.all(percentiles >= 0) and numpy.all(percentiles <= 1), 'Percentiles should be in [0, 1]'
+    return percentiles
+
+
+def _weighted_quantiles(sorted_weights, old_style=False):
+    """Positions of sorted elements in [0, 1] (along the last axis)"""
+    result = numpy.cumsum(sorted_weights, axis=-1, dtype=float)
+    result -= 0.5 * sorted_weights
+    if old_style:
+        # To be convenient with numpy.percentile
+        result -= result[..., :1]
+        result /= numpy.maximum(result[..., -1:], 1e-300)
+    else:
+        result /= numpy.sum(sorted_weights, axis=-1, dtype=float)[..., numpy.newaxis]
+    return result
+
+
+def _interp_rows(percentiles, quantiles, values):
+    """Does the same as numpy.interp for each row of quantiles and values.
+    :param percentiles: numpy.array of shape [n_rows, n_percentiles]
+    :param quantiles: numpy.array of shape [n_rows, n_samples], each row is non-decreasing, in [0, 1]
+    :param values: numpy.array of shape [n_rows, n_samples], each row is non-decreasing
+    :return: numpy.array of shape [n_rows, n_percentiles]
+    """
+    n_rows, n_samples = quantiles.shape
+    # shifting rows, so that all the quantiles are sorted in the flattened array
+    shifts = 2. * numpy.arange(n_rows)[:, numpy.newaxis]
+    flat_quantiles = (quantiles + shifts).ravel()
+    flat_values = values.ravel()
+    row_starts = numpy.arange(n_rows)[:, numpy.newaxis] * n_samples
+
+    positions = numpy.searchsorted(flat_quantiles, (percentiles + shifts).ravel(), side='right')
+    positions = positions.reshape(percentiles.shape)
+    left = numpy.clip(positions - 1, row_starts, row_starts + n_samples - 1)
+    right = numpy.minimum(left + 1, row_starts + n_samples - 1)
+
+    denominator = flat_quantiles[right] - flat_quantiles[left]
+    t = (percentiles + shifts - flat_quantiles[left]) / numpy.where(denominator > 0, denominator, 1.)
+    t = numpy.clip(numpy.where(denominator > 0, t, 0.), 0, 1)
+    return flat_values[left] + t * (flat_values[right] - flat_values[left])
+
+
+def weighted_percentiles_2d(arrays, percentiles, sample_weight=None, arrays_sorted=False, old_style=False):
+    """ Computes weighted percentiles for each row of matrix.
+    :param arrays: numpy.array of shape [n_rows, n_samples]
+    :param percentiles: array-like of shape [n_percentiles] (the same for all rows)
+        or of shape [n_rows, n_percentiles], percentiles should be in [0, 1]
+    :param sample_weight: None, array-like of shape [n_samples] (the same for all rows)
+        or of shape [n_rows, n_samples]
+    :param arrays_sorted: bool, if True, each row is expected to be sorted (weights are sorted correspondingly)
+    :param old_style: if True, will correct output to be consistent with numpy.percentile.
+    :return: numpy.array of shape [n_rows, n_percentiles]
+    """
+    arrays = numpy.asarray(arrays)
+    assert arrays.ndim == 2, 'arrays should be two-dimensional'
+    n_rows, n_samples = arrays.shape
+    percentiles = _check_percentiles(percentiles)
+    percentiles = numpy.ones([n_rows, 1]) * numpy.atleast_2d(percentiles)
+    assert len(percentiles) == n_rows, 'wrong shape of percentiles'
+
+    if sample_weight is None:
+        sample_weight = numpy.ones(n_samples)
+    sample_weight = numpy.asarray(sample_weight, dtype=float)
+    assert sample_weight.shape[-1] == n_samples, 'The length of weights is different'
+
+    if not arrays_sorted:
+        order = numpy.argsort(arrays, axis=1)
+        rows = numpy.arange(n_rows)[:, numpy.newaxis]
+        arrays = arrays[rows, order]
+        if sample_weight.ndim == 1:
+            sample_weight = sample_weight[order]
+        else:
+            sample_weight = sample_weight[rows, order]
+    sample_weight = sample_weight * numpy.ones([n_rows, 1])
+    quantiles = _weighted_quantiles(sample_weight, old_style=old_style)
+    return _interp_rows(percentiles, quantiles, arrays)
+
+
+class SortedSample(object):
+    def __init__(self, array, sample_weight=None, array_sorted=False):
+        """
+        Sorts the (weighted) data once, after that percentiles and efficiencies
+        can be computed many times without sorting.
+        :param array: array-like of shape [n_samples]
+        :param sample_weight: None or array-like of shape [n_samples]
+        :param array_sorted: bool, if True, then will avoid sorting
+        """
+        array = numpy.ravel(array)
+        if sample_weight is None:
+            sample_weight = numpy.ones(len(array))
+        sample_weight = numpy.asarray(sample_weight, dtype=float)
+        assert len(sample_weight) == len(array), 'The length of weights is different'
+        if not array_sorted:
+            order = numpy.argsort(array)
+            array, sample_weight = array[order], sample_weight[order]
+        self.values = array
+        self.weights = sample_weight
+        self.total_weight = numpy.sum(sample_weight)
+        self._quantiles = _weighted_quantiles(sample_weight)
+        self._cumulative_weights = numpy.cumsum(sample_weight)
+
+    def percentile(self, percentiles, old_style=False):
+        """Works exactly as commonutils.weighted_percentile"""
+        percentiles = _check_percentiles(percentiles)
+        quantiles = self._quantiles if not old_style else _weighted_quantiles(self.weights, old_style=True)
+        return numpy.interp(percentiles, quantiles, self.values)
+
+    def efficiency(self, cuts):
+        """Part of weight of events with value strictly greater than cut
+        :param cuts: float or array-like of cuts"""
+        n_not_passed = numpy.searchsorted(self.values, cuts, side='right')
+        not_passed_weight = numpy.r_[0., self._cumulative_weights][n_not_passed]
+        return 1. - not_passed_weight / self.total_weight
+
+
+class QuantileSketch(object):
+    def __init__(self, compression=1000):
+        """
+        Mergeable streaming summary of (weighted) distribution, which can be used to compute percentiles
+        of data that can't be sorted in memory. Data is passed by chunks (see `update`),
+        summaries computed on different chunks (or in different processes) can be merged.
+
+        The data is stored as at most ~2 * compression weighted centroids,
+        each centroid contains at most (total weight / compression), so the error in terms of
+        rank (percentile) is of order 1 / compression. Minimal and maximal values are kept exactly.
+
+        :param int compression: the greater, the more precise and the more memory is used
+        """
+        assert compression > 1, 'compression should be greater than 1'
+        self.compression = compression
+        self.values = numpy.zeros(0)
+        self.weights = numpy.zeros(0)
+        self.min_value = numpy.inf
+        self.max_value = -numpy.inf
+
+    @property
+    def total_weight(self):
+        return numpy.sum(self.weights)
+
+    def update(self, array, sample_weight=None):
+        """Adds next chunk of data to summary.
+        :param array: array-like of shape [n_samples]
+        :param sample_weight: None or array-like of shape [n_samples]
+        :return: self
+        """
+        array = numpy.ravel(array)
+        if len(array) == 0:
+            return self
+        if sample_weight is None:
+            sample_weight = numpy.ones(len(array))
+        sample_weight = numpy.asarray(sample_weight, dtype=float)
+        assert len(sample_weight) == len(array), 'The length of weights is different'
+        self.min_value = min(self.min_value, numpy.min(array))
+        self.max_value = max(self.max_value, numpy.max(array))
+        self._compress(numpy.concatenate([self.values, array]), numpy.concatenate([self.weights, sample_weight]))
+        return self
+
+    def merge(self, other):
+        """Merges other sketch into this one
+        :type other: QuantileSketch
+        :return: self"""
+        self.min_value = min(self.min_value, other.min_value)
+        self.max_value = max(self.max_value, other.max_value)
+        if len(self.values) + len(other.values) == 0:
+            # both sketches are empty (i.e. computed on empty shards of data)
+            return self
+        self._compress(numpy.concatenate([self.values, other.values]),
+                       numpy.concatenate([self.weights, other.weights]))
+        return self
+
+    def _compress(self, values, weights):
+        order = numpy.argsort(values)
+        values, weights = values[order], weights[order]
+        cumulative = numpy.cumsum(weights)
+        total = cumulative[-1]
+        # each centroid contains at most total / compression (with exception of heavy single elements)
+        group_ids = numpy.floor((cumulative - weights) * self.compression / total).astype(int)
+        _, group_ids = numpy.unique(group_ids, return_inverse=True)
+        self.weights = numpy.bincount(group_ids, weights=weights)
+        self.values = numpy.bincount(group_ids, weights=weights * values) / numpy.maximum(self.weights, 1e-300)
+
+    def percentile(self, percentiles):
+        """Approximate weighted percentiles, percentiles should be in [0, 1]"""
+        percentiles = _check_percentiles(percentiles)
+        assert len(self.values) > 0, 'No data was passed to the sketch'
+        quantiles = _weighted_quantiles(self.weights)
+        values = numpy.r_[self.min_value, self.values, self.max_value]
+        quantiles = numpy.r_[0., quantiles, 1.]
+        return numpy.interp(percentiles, quantiles, values)
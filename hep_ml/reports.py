@@ -13,7 +13,7 @@ import warnings
 import numpy
 import pandas
 import matplotlib.pyplot as pylab
-from sklearn.metrics import auc, roc_auc_score, roc_curve
+from sklearn.metrics import roc_auc_score
 from sklearn.utils.validation import check_arrays, column_or_1d
 from matplotlib import cm
 from scipy.stats import pearsonr
@@ -25,6 +25,7 @@ from .metrics_utils import compute_sde_on_bins, compute_sde_on_groups, compute_t
     bin_based_cvm, bin_based_ks
 
 from .metrics_utils import compute_bin_efficiencies, compute_bin_weights, compute_bin_indices
+from .roc_utils import roc_curve, roc_auc, staged_roc_auc
 
 
 __author__ = 'Alex Rogozhnikov'
@@ -219,10 +220,36 @@ class Predictions(object):
                     pylab.legend()
             pylab.show()
 
+    def _staged_roc_auc(self, step=1, label=1, mask=None):
+        """Computes ROC AUC on every step-th stage of each classifier, all stages are processed together
+        :rtype: dict[str, pandas.Series]"""
+        mask = self._check_mask(mask)
+        y_true = (self.y[mask] == label) * 1
+        sample_weight = self.checked_sample_weight[mask]
+        result = OrderedDict()
+        for name, staged_proba in self._get_staged_proba().items():
+            stages = []
+
+            def selected_predictions():
+                for stage, proba in islice(enumerate(staged_proba), step - 1, None, step):
+                    stages.append(stage)
+                    yield proba[mask, label]
+
+            aucs = staged_roc_auc(y_true, selected_predictions(), sample_weight=sample_weight)
+            result[name] = pandas.Series(data=aucs, index=stages)
+        return result
+
     def learning_curves(self, metrics=roc_auc_score, step=1, label=1, mask=None):
-        y_true = (self.y == label) * 1
+        """Plots the dependence of metrics on the stage, by default ROC AUC is plotted
+        (all the stages are evaluated in one batched call in this case)"""
         mask = self._check_mask(mask)
-        self._plot_curves(lambda p: metrics(y_true[mask], p[mask, label], sample_weight=self.sample_weight), step=step)
+        if metrics is roc_auc_score:
+            for name, values in self._staged_roc_auc(step=step, label=label, mask=mask).items():
+                pylab.plot(values.keys(), values, label=name)
+        else:
+            y_true = (self.y == label) * 1
+            self._plot_curves(lambda p: metrics(y_true[mask], p[mask, label],
+                                                sample_weight=self.checked_sample_weight[mask]), step=step)
         pylab.legend(loc="lower right")
         pylab.xlabel("stage"), pylab.ylabel("ROC AUC")
 
@@ -435,14 +462,14 @@ class Predictions(object):
 
         for i, (name, proba) in enumerate(self.predictions.items(), start=1):
             ax = pylab.subplot(1, n_classifiers, i)
-            for eff in global_rcp:
-                if not compute_cuts_for_other_class:
-                    cut = compute_bdt_cut(eff, y_true=mask, y_pred=proba[:, label],
-                                          sample_weight=self.checked_sample_weight)
-                else:
-                    cut = 1 - compute_bdt_cut(eff, y_true=mask, y_pred=proba[:, 1 - label],
-                                              sample_weight=self.checked_sample_weight)
-
+            # all the cuts are computed at once (sorting only once)
+            if not compute_cuts_for_other_class:
+                cuts = compute_bdt_cut(global_rcp, y_true=mask, y_pred=proba[:, label],
+                                       sample_weight=self.checked_sample_weight)
+            else:
+                cuts = 1 - compute_bdt_cut(global_rcp, y_true=mask, y_pred=proba[:, 1 - label],
+                                           sample_weight=self.checked_sample_weight)
+            for eff, cut in zip(global_rcp, cuts):
                 bin_effs = compute_bin_efficiencies(proba[mask, label], bin_indices=bin_indices[mask], cut=cut,
                                                     sample_weight=self.checked_sample_weight[mask], minlength=n_bins)
                 ax.plot(bin_centers[bin_mask], bin_effs[bin_mask], label=legend_label.format(rcp=eff, cut=cut),
@@ -590,8 +617,8 @@ def plot_roc(y_true, y_pred, sample_weight=None, classifier_name="", is_cut=Fals
         if sample_weight is not None:
             sample_weight = sample_weight[mask]
 
-    fpr, tpr, thresholds = check_arrays(*roc_curve(y_true, y_pred, sample_weight=sample_weight))
-    roc_auc = auc(fpr, tpr)
+    fpr, tpr, thresholds = roc_curve(y_true, y_pred, sample_weight=sample_weight)
+    area = roc_auc(y_true, y_pred, sample_weight=sample_weight)
     # tpr = recall = isSasS / isS = signal efficiency
     # fpr = isBasS / isB = 1 - specificity = 1 - backgroundRejection
     bg_rejection = 1. - fpr
@@ -606,7 +633,7 @@ def plot_roc(y_true, y_pred, sample_weight=None, classifier_name="", is_cut=Fals
         tpr = tpr[indices]
         bg_rejection = bg_rejection[indices]
     if not is_cut:
-        pylab.plot(tpr, bg_rejection, label='%s (area = %0.3f)' % (classifier_name, roc_auc))
+        pylab.plot(tpr, bg_rejection, label='%s (area = %0.3f)' % (classifier_name, area))
     else:
         pylab.plot(tpr[1:2], bg_rejection[1:2], 'o', label='%s' % classifier_name)
 
@@ -0,0 +1,158 @@
+"""
+`result_store` contains ResultStore - persistent (SQLite) storage of results of grid search,
+which allows to resume crashed searches and to compare results of different searches.
+
+Each result is identified by
+* estimator - the class of estimator
+* params - all the parameters of estimator (not only the optimized ones)
+* data - the fingerprint of training data (see `data_fingerprint`)
+* setup - the description of cross-validation (number of folds, score function, ...)
+
+Parameters are compared by their descriptions (see `describe_value`), estimators passed as parameters
+(i.e. base_estimator or loss) are described by their parameters.
+"""
+from __future__ import division, print_function, absolute_import
+
+import json
+import time
+import sqlite3
+import hashlib
+import numpy
+import pandas
+
+__author__ = 'Alex Rogozhnikov'
+
+__all__ = ['ResultStore', 'data_fingerprint', 'describe_value', 'describe_estimator']
+
+
+def _hash_array(hasher, array):
+    array = numpy.ascontiguousarray(array)
+    hasher.update(repr([array.shape, array.dtype.str]).encode('utf-8'))
+    hasher.update(array.view(numpy.uint8).ravel())
+
+
+def describe_value(value):
+    """
+    Returns string, which doesn't depend on the place of object in memory (as repr may do).
+    Arrays are described by hash of their contents (repr of big arrays is truncated).
+    :raises ValueError: if value can't be described reliably: lambdas, nested functions
+        and objects whose repr contains address in memory
+    """
+    if hasattr(value, 'get_params'):
+        params = sorted(value.get_params(deep=False).items())
+        return '{}({})'.format(type(value).__name__, ', '.join('{}={}'.format(name, describe_value(param))
+                                                             for name, param in params))
+    if isinstance(value, numpy.ndarray):
+        if value.dtype == object:
+            return 'array({}, {})'.format(value.shape, describe_value(value.tolist()))
+        hasher = hashlib.sha1()
+        _hash_array(hasher, value)
+        return 'array({})'.format(hasher.hexdigest())
+    if isinstance(value, pandas.Series):
+        return 'Series({}, index={})'.format(describe_value(value.values), describe_value(value.index.values))
+    if isinstance(value, pandas.DataFrame):
+        return 'DataFrame({}, columns={}, index={})'.format(describe_value(value.values),
+                                                           describe_value(list(value.columns)),
+                                                           describe_value(value.index.values))
+    if isinstance(value, (list, tuple)):
+        return '[' + ', '.join(describe_value(element) for element in value) + ']'
+    if isinstance(value, dict):
+        return '{' + ', '.join('{}: {}'.format(describe_value(key), describe_value(element))
+                               for key, element in sorted(value.items())) + '}'
+    if callable(value) and hasattr(value, '__name__'):
+        if value.__name__ == '<lambda>' or '<locals>' in getattr(value, '__qualname__', ''):
+            raise ValueError('{} is a lambda or nested function, it can not be described'.format(value))
+        return getattr(value, '__module__', '') + '.' + value.__name__
+    result = repr(value)
+    if ' at 0x' in result:
+        raise ValueError('{} depends on the place of object in memory'.format(result))
+    return result
+
+
+def describe_estimator(estimator):
+    """:return: (class of estimator, dict with descriptions of its parameters)"""
+    estimator_class = type(estimator).__module__ + '.' + type(estimator).__name__
+    params = dict((name, describe_value(value)) for name, value in estimator.get_params(deep=False).items())
+    return estimator_class, params
+
+
+def data_fingerprint(X, y, sample_weight=None):
+    """Hash of training data: names of columns, values of features, labels and weights
+    :param X: pandas.DataFrame, ColumnarDataset or numpy.array"""
+    hasher = hashlib.sha1()
+    if hasattr(X, 'columns'):
+        columns = list(X.columns)
+        hasher.update(repr(columns).encode('utf-8'))
+        arrays = [X[column] for column in columns]
+    else:
+        arrays = [X]
+    for array in arrays + [y, sample_weight]:
+        if array is not None:
+            _hash_array(hasher, array)
+    return hasher.hexdigest()
+
+
+class ResultStore(object):
+    def __init__(self, filename):
+        """
+        Stores the results of evaluations in SQLite database, the results are written immediately,
+        so they survive crashes of the search. The same file can be used by many searches.
+        :param str filename: path to database file (created if doesn't exist)
+        """
+        self.filename = filename
+        self._execute('CREATE TABLE IF NOT EXISTS results (estimator TEXT, params TEXT, data TEXT, setup TEXT, '
+                      'score REAL, time REAL, memory REAL, timestamp REAL)')
+        self._execute('CREATE INDEX IF NOT EXISTS results_index ON results (estimator, data, setup)')
+
+    def _execute(self, query, parameters=()):
+        connection = sqlite3.connect(self.filename, timeout=60)
+        try:
+            with connection:
+                return connection.execute(query, parameters).fetchall()
+        finally:
+            connection.close()
+
+    def add(self, estimator, params, data, setup, score, evaluation_time=None, peak_memory=None):
+        """
+        :param str estimator: the class of estimator
+        :param dict params: descriptions of parameters
+        :param str data: fingerprint of data
+        :param dict setup: descriptions of evaluation settings
+        :param float score: the result of evaluation
+        :param evaluation_time: time of evaluation in seconds
+        :param peak_memory: peak memory of evaluation in megabytes
+            (None if evaluation wasn't done in a separate process, so it couldn't be measured)
+        """
+        self._execute('INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                      (estimator, json.dumps(params, sort_keys=True), data, json.dumps(setup, sort_keys=True),
+                       float(score), evaluation_time, peak_memory, time.time()))
+
+    def get(self, estimator, params, data, setup):
+        """Returns the last score computed with these parameters or None"""
+        rows = self._execute('SELECT score FROM results WHERE estimator=? AND params=? AND data=? AND setup=? '
+                             'ORDER BY timestamp DESC LIMIT 1',
+                             (estimator, json.dumps(params, sort_keys=True), data, json.dumps(setup, sort_keys=True)))
+        return rows[0][0] if len(rows) > 0 else None
+
+    def get_all(self, estimator, data, setup):
+        """Returns list of (params, score) for all results obtained with the same estimator, data and setup"""
+        rows = self._execute('SELECT params, score FROM results WHERE estimator=? AND data=? AND setup=? '
+                             'ORDER BY timestamp', (estimator, data, json.dumps(setup, sort_keys=True)))
+        return [(json.loads(params), score) for params, score in rows]
+
+    def query(self, estimator=None, data=None):
+        """Returns pandas.DataFrame with results (of all searches), can be filtered by estimator and data"""
+        conditions = []
+        parameters = []
+        for name, value in [('estimator', estimator), ('data', data)]:
+            if value is not None:
+                conditions.append(name + '=?')
+                parameters.append(value)
+        query = 'SELECT * FROM results'
+        if len(conditions) > 0:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        connection = sqlite3.connect(self.filename, timeout=60)
+        try:
+            return pandas.read_sql_query(query, connection, params=parameters)
+        finally:
+            connection.close()
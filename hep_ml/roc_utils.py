@@ -0,0 +1,153 @@
+"""
+`roc_utils` contains fast weighted ROC curves and ROC AUC.
+
+Unlike sklearn.metrics.roc_curve / roc_auc_score, arguments are checked only once,
+scores are not copied (float32 scores are sorted as float32),
+and ROC AUC for many stages (or classifiers) is computed in one batched call.
+All the accumulations are done in float64.
+"""
+from __future__ import division, print_function, absolute_import
+
+import numpy
+
+__author__ = 'Alex Rogozhnikov'
+
+__all__ = ['roc_curve', 'roc_auc', 'staged_roc_auc', 'downsampled_roc_curve']
+
+
+def _check_roc_arguments(y_true, sample_weight):
+    """Returns weights of signal and background events (both of shape [n_samples], float64)"""
+    y_true = numpy.ravel(y_true)
+    if sample_weight is None:
+        sample_weight = numpy.ones(len(y_true), dtype=float)
+    else:
+        sample_weight = numpy.asarray(sample_weight, dtype=float)
+        assert len(sample_weight) == len(y_true), 'Different lengths of y_true and sample_weight'
+    is_signal = y_true > 0.5
+    sig_weight = sample_weight * is_signal
+    bck_weight = sample_weight * (~is_signal)
+    assert numpy.sum(sig_weight) > 0 and numpy.sum(bck_weight) > 0, 'Both classes should be present'
+    return sig_weight, bck_weight
+
+
+def roc_curve(y_true, y_score, sample_weight=None, presorted=False):
+    """Does the same as sklearn.metrics.roc_curve (for two classes, positive label = 1).
+    :param y_true: array-like of shape [n_samples] with 0 and 1
+    :param y_score: array-like of shape [n_samples], predictions (float32 is ok)
+    :param sample_weight: None or array-like of shape [n_samples]
+    :param presorted: if True, y_score is expected to be already sorted in ascending order
+        (y_true and sample_weight should be permuted correspondingly)
+    :return: fpr, tpr, thresholds - parallel arrays, thresholds are decreasing
+    """
+    y_score = numpy.ravel(y_score)
+    sig_weight, bck_weight = _check_roc_arguments(y_true, sample_weight)
+    assert len(y_score) == len(sig_weight), 'Different lengths of y_true and y_score'
+    if presorted:
+        order = slice(None, None, -1)
+    else:
+        order = numpy.argsort(y_score, kind='mergesort')[::-1]
+    y_score = y_score[order]
+    # last position of each group of equal scores
+    group_ends = numpy.r_[numpy.flatnonzero(numpy.diff(y_score)), len(y_score) - 1]
+    tps = numpy.cumsum(sig_weight[order])[group_ends]
+    fps = numpy.cumsum(bck_weight[order])[group_ends]
+    thresholds = numpy.r_[y_score[0] + 1, y_score[group_ends]]
+    tpr = numpy.r_[0., tps / tps[-1]]
+    fpr = numpy.r_[0., fps / fps[-1]]
+    return fpr, tpr, thresholds
+
+
+def _batched_auc(sorted_scores, sorted_sig_weight, sorted_bck_weight):
+    """Computes ROC AUC for each row of the matrix,
+    each row of sorted_scores should be sorted in ascending order,
+    weights are permuted correspondingly. Equal scores are treated as in sklearn (trapezoid rule)."""
+    n_rows, n_samples = sorted_scores.shape
+    new_group = numpy.ones(sorted_scores.shape, dtype=bool)
+    new_group[:, 1:] = sorted_scores[:, 1:] != sorted_scores[:, :-1]
+    new_group = new_group.ravel()
+    # groups of equal scores, each row starts with new group, so groups of different rows don't mix
+    group_ids = numpy.cumsum(new_group) - 1
+    group_sig = numpy.bincount(group_ids, weights=sorted_sig_weight.ravel())
+    group_bck = numpy.bincount(group_ids, weights=sorted_bck_weight.ravel())
+    group_rows = numpy.flatnonzero(new_group) // n_samples
+
+    bck_before_group = numpy.cumsum(group_bck) - group_bck
+    first_groups = group_ids[numpy.arange(n_rows) * n_samples]
+    bck_before_group -= bck_before_group[first_groups][group_rows]
+    # each signal event 'beats' background with lower score, and half of background with same score
+    nominator = numpy.bincount(group_rows, weights=group_sig * (bck_before_group + 0.5 * group_bck),
+                               minlength=n_rows)
+    return nominator / (numpy.sum(sorted_sig_weight, axis=1) * numpy.sum(sorted_bck_weight, axis=1))
+
+
+def roc_auc(y_true, y_score, sample_weight=None, presorted=False):
+    """Weighted area under ROC curve, gives the same result as sklearn.metrics.roc_auc_score
+    :param presorted: if True, y_score is expected to be already sorted in ascending order
+        (y_true and sample_weight should be permuted correspondingly)
+    :rtype: float
+    """
+    y_score = numpy.ravel(y_score)
+    sig_weight, bck_weight = _check_roc_arguments(y_true, sample_weight)
+    assert len(y_score) == len(sig_weight), 'Different lengths of y_true and y_score'
+    if not presorted:
+        order = numpy.argsort(y_score, kind='mergesort')
+        y_score, sig_weight, bck_weight = y_score[order], sig_weight[order], bck_weight[order]
+    return _batched_auc(y_score[numpy.newaxis, :], sig_weight[numpy.newaxis, :], bck_weight[numpy.newaxis, :])[0]
+
+
+def staged_roc_auc(y_true, staged_scores, sample_weight=None, block_size=None):
+    """Computes ROC AUC for many predictions on the same events at once
+    (different stages of one classifier or different classifiers).
+    The labels and weights are checked only once.
+
+    :param y_true: array-like of shape [n_samples] with 0 and 1
+    :param staged_scores: array-like of shape [n_stages, n_samples]
+        or iterable over arrays of shape [n_samples] (i.e. staged_predict_score)
+    :param sample_weight: None or array-like of shape [n_samples]
+    :param block_size: int or None, the number of stages sorted simultaneously
+        (by default the block is chosen to have about 10^7 elements)
+    :return: numpy.array of shape [n_stages]
+    """
+    sig_weight, bck_weight = _check_roc_arguments(y_true, sample_weight)
+    n_samples = len(sig_weight)
+    if block_size is None:
+        block_size = max(1, 10 ** 7 // max(n_samples, 1))
+
+    result = []
+
+    def process_block(block):
+        block = numpy.asarray(block)
+        rows = numpy.arange(len(block))[:, numpy.newaxis]
+        order = numpy.argsort(block, axis=1, kind='mergesort')
+        result.append(_batched_auc(block[rows, order], sig_weight[order], bck_weight[order]))
+
+    if isinstance(staged_scores, numpy.ndarray) and staged_scores.ndim == 2:
+        assert staged_scores.shape[1] == n_samples, 'Different lengths of y_true and scores'
+        for start in range(0, len(staged_scores), block_size):
+            process_block(staged_scores[start:start + block_size])
+    else:
+        block = []
+        for scores in staged_scores:
+            scores = numpy.ravel(scores)
+            assert len(scores) == n_samples, 'Different lengths of y_true and scores'
+            # copying, because staged predictions frequently reuse the same array
+            block.append(numpy.array(scores))
+            if len(block) == block_size:
+                process_block(block)
+                block = []
+        if len(block) > 0:
+            process_block(block)
+
+    if len(result) == 0:
+        return numpy.zeros(0)
+    return numpy.concatenate(result)
+
+
+def downsampled_roc_curve(y_true, y_score, sample_weight=None, n_points=500, presorted=False):
+    """Computes ROC curve with fixed number of points (convenient for plotting and storing).
+    Points are uniformly distributed in signal efficiency (tpr).
+    :return: fpr, tpr - arrays of shape [n_points]
+    """
+    fpr, tpr, _ = roc_curve(y_true, y_score, sample_weight=sample_weight, presorted=presorted)
+    tpr_grid = numpy.linspace(0, 1, n_points)
+    return numpy.interp(tpr_grid, tpr, fpr), tpr_grid
@@ -1,20 +1,31 @@
 """
 Tools to work with root files
-At this moment file contains only functions that read ROOT files into pandas
-Essential to have ROOT, rootpy, root_numpy to use this function
+File contains functions that read ROOT files into pandas and into columnar format (see `read_trees`),
+converted ntuples can be cached on disk with `NtupleCache`.
+Essential to have ROOT, rootpy, root_numpy to read ROOT files, for tests and for data already converted
+to numpy NumpyFileReader can be used.
 """
 from __future__ import division, print_function
+import os
+import time
+import json
+import shutil
+import hashlib
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+from collections import OrderedDict
 import numpy
 import pandas
-import rootpy
-import rootpy.io
-import rootpy.tree
+from six import string_types
+from .columnar import ColumnarDataset
+from .commonutils import check_fork_start_method
 
 __author__ = 'Alex Rogozhnikov'
 
 
 def print_root_structure(file_name):
     """Prints the structure of root file in readable format"""
+    import rootpy.io
     with rootpy.io.root_open(file_name, "READ") as root_file:
         for path, dirs, objects in root_file.walk():
             # print([path, dirs, objects])
@@ -27,6 +38,8 @@ def print_root_structure(file_name):
 
 def root2pandas(file_name):
     """Reads some ROOT file to pandas, finds the first tree and converts it."""
+    import rootpy.io
+    import rootpy.tree
     with rootpy.io.root_open(file_name, "READ") as root_file:
         for path, dirs, objects in root_file.walk():
             for objName in objects:
@@ -41,30 +54,238 @@ def root2pandas(file_name):
     raise RuntimeError("Nothing found in the file {}".format(file_name))
 
 
-def tree2pandas(filename, treename, branches=None, start=None, stop=None, selection=None, clip=1e33):
-    import root_numpy
-    data = root_numpy.root2array(filenames=filename, treename=treename, branches=branches,
-                                 selection=selection, start=start, stop=stop)
-    data = pandas.DataFrame(data)
-    if clip is not None:
-        data = numpy.clip(data, -clip, clip)
-    return data
+# region Readers
+
+class RootNumpyReader(object):
+    """
+    Reads ROOT trees with root_numpy. Readers are passed to worker processes, so should be picklable.
+    Each reader has two methods:
+    get_entries(filename, treename) - total number of entries in tree (before selection),
+    read(filename, treename, branches, start, stop, selection) - numpy structured array with selected events.
+    """
+    def get_entries(self, filename, treename):
+        import rootpy.io
+        with rootpy.io.root_open(filename, "READ") as root_file:
+            return root_file.Get(treename).GetEntries()
+
+    def read(self, filename, treename, branches=None, start=None, stop=None, selection=None):
+        import root_numpy
+        return root_numpy.root2array(filenames=filename, treename=treename, branches=branches,
+                                     selection=selection, start=start, stop=stop)
+
+
+class NumpyFileReader(object):
+    """
+    Stand-in for RootNumpyReader, reads structured arrays from .npy files (treename is ignored)
+    or from .npz files (treename is the name of array inside archive).
+    .npy files are memory-mapped, so only requested part is read.
+    Selection is a string evaluated by pandas.DataFrame.eval, i.e. 'mass > 1000 & pt > 0'
+    """
+    def _load(self, filename, treename):
+        if filename.endswith('.npz'):
+            return numpy.load(filename)[treename]
+        return numpy.load(filename, mmap_mode='r')
+
+    def get_entries(self, filename, treename):
+        return len(self._load(filename, treename))
+
+    def read(self, filename, treename, branches=None, start=None, stop=None, selection=None):
+        data = self._load(filename, treename)[start:stop]
+        if selection is not None:
+            data = data[numpy.array(pandas.DataFrame(data).eval(selection), dtype=bool)]
+        if branches is not None:
+            data = data[list(branches)]
+        return numpy.array(data)
+
+# endregion
+
+
+def _convert_column(values, dtype, clip):
+    """Converts column of structured array, downcast and clipping are done in one copy
+    (too big values become infinite after downcast and then are clipped)"""
+    with numpy.errstate(over='ignore'):
+        values = numpy.asarray(values, dtype=dtype)
+    if clip is not None and values.dtype.kind == 'f':
+        numpy.clip(values, -clip, clip, out=values)
+    return values
+
+
+# output columns allocated before forking worker processes (in shared memory), so workers write into them
+_shared_output = {}
+
+
+def _read_chunk(task):
+    """
+    Reads one chunk in worker process.
+    If output directory is passed, columns are written directly into memory-mapped dataset,
+    if shared is True, columns are written into _shared_output, otherwise returned.
+    :return: (number of events, OrderedDict with columns or None)
+    """
+    reader, filename, treename, branches, start, stop, selection, dtype, clip, directory, shared, offset = task
+    data = reader.read(filename, treename, branches=branches, start=start, stop=stop, selection=selection)
+    if shared:
+        output = _shared_output
+    elif directory is not None:
+        output = ColumnarDataset.load(directory, mmap_mode='r+')
+    else:
+        columns = OrderedDict((branch, _convert_column(data[branch], dtype, clip)) for branch in branches)
+        return len(data), columns
+    for branch in branches:
+        column = output[branch]
+        column[offset:offset + len(data)] = _convert_column(data[branch], dtype, clip)
+        if directory is not None:
+            column.flush()
+    return len(data), None
+
+
+def _allocate_shared(length, dtype):
+    """Allocates array in shared memory, which is inherited (not copied) by forked processes"""
+    dtype = numpy.dtype(dtype)
+    buffer = RawArray('b', max(length * dtype.itemsize, 1))
+    return numpy.frombuffer(buffer, dtype=dtype)[:length]
+
+
+def _collect_selected(results, branches, dtype, length_limit, directory):
+    """
+    Collects chunks (passed with selection) in the order of arrival, each chunk is copied and freed
+    before the next one is received. In memory the chunks are copied into buffer of length_limit events
+    (its untouched part isn't actually allocated by OS), which is shrunk in the end.
+    In directory the chunks are appended to temporary files, which are then copied to memory-mapped dataset.
+    """
+    if directory is None:
+        columns = OrderedDict((branch, numpy.empty(length_limit, dtype=dtype)) for branch in branches)
+    else:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        temporary_names = [os.path.join(directory, 'collected_{}.tmp'.format(i)) for i in range(len(branches))]
+        columns = OrderedDict((branch, open(name, 'wb')) for branch, name in zip(branches, temporary_names))
+    length = 0
+    try:
+        for n_events, chunk_columns in results:
+            for branch in branches:
+                if directory is None:
+                    columns[branch][length:length + n_events] = chunk_columns[branch]
+                else:
+                    columns[branch].write(numpy.ascontiguousarray(chunk_columns[branch], dtype=dtype).tobytes())
+            length += n_events
+            del chunk_columns
+    finally:
+        if directory is not None:
+            for temporary_file in columns.values():
+                temporary_file.close()
+
+    if directory is None:
+        for column in columns.values():
+            column.resize(length, refcheck=False)
+        return ColumnarDataset(columns)
+    try:
+        result = ColumnarDataset.create_empty(directory, branches, length=length, dtype=dtype)
+        for branch, name in zip(branches, temporary_names):
+            if length > 0:
+                result[branch][:] = numpy.memmap(name, dtype=dtype, mode='r', shape=(length, ))
+            result[branch].flush()
+        del result
+    finally:
+        for name in temporary_names:
+            os.remove(name)
+    return ColumnarDataset.load(directory)
 
 
-def list_flat_branches(filename, treename, use_dtype=True):
+def read_trees(filenames, treename, branches=None, selection=None, clip=1e33, dtype='float32',
+               chunk_size=1000000, n_jobs=1, directory=None, reader=None):
+    """
+    Reads trees from many files by chunks in parallel, converts the data to ColumnarDataset.
+    The data is downcast (float32 by default) and clipped inside worker processes,
+    so the full tree in original types is never kept in memory.
+
+    :param filenames: str or list of str
+    :param treename: name of tree
+    :param branches: list of branches to read (if None, all branches of the first file are read)
+    :param selection: str or None, selection applied to events
+    :param clip: float or None, values of float columns are clipped to [-clip, clip]
+    :param dtype: type of output columns
+    :param chunk_size: max number of events read by one task
+    :param n_jobs: number of processes used, if 1, everything is done in this process
+    :param directory: str or None, if not None, the result is memory-mapped dataset stored in directory.
+        Without selection workers write events directly into preallocated output
+        (memory-mapped dataset or arrays in shared memory), with selection chunks are copied
+        to output in order as soon as they are read.
+    :param reader: RootNumpyReader (default) or another reader with the same interface (i.e. NumpyFileReader)
+    :rtype: ColumnarDataset
+    """
+    if isinstance(filenames, string_types):
+        filenames = [filenames]
+    reader = RootNumpyReader() if reader is None else reader
+    if branches is None:
+        branches = list(reader.read(filenames[0], treename, stop=1).dtype.names)
+    branches = list(branches)
+
+    chunks = []
+    for filename in filenames:
+        n_entries = reader.get_entries(filename, treename)
+        for start in range(0, n_entries, chunk_size):
+            chunks.append([filename, start, min(start + chunk_size, n_entries)])
+
+    # without selection the positions of chunks in output are known, so workers write into it directly
+    length_limit = sum(stop - start for _, start, stop in chunks)
+    write_directly = selection is None
+    shared = write_directly and directory is None
+    if n_jobs > 1 and shared:
+        check_fork_start_method()
+    if write_directly:
+        offsets = numpy.cumsum([0] + [stop - start for _, start, stop in chunks])
+        if directory is None:
+            allocate = _allocate_shared if n_jobs > 1 else numpy.empty
+            _shared_output.update((branch, allocate(length_limit, dtype=dtype)) for branch in branches)
+        else:
+            ColumnarDataset.create_empty(directory, branches, length=length_limit, dtype=dtype)
+    else:
+        offsets = [0] * len(chunks)
+    tasks = [(reader, filename, treename, branches, start, stop, selection, dtype, clip,
+              directory if write_directly else None, shared, offset)
+             for (filename, start, stop), offset in zip(chunks, offsets)]
+
+    pool = None if n_jobs == 1 else multiprocessing.Pool(n_jobs)
+    try:
+        if pool is None:
+            results = (_read_chunk(task) for task in tasks)
+        else:
+            # results are received in order of chunks
+            results = pool.imap(_read_chunk, tasks, chunksize=1)
+        if write_directly:
+            for _ in results:
+                pass
+            if shared:
+                return ColumnarDataset([(branch, _shared_output[branch]) for branch in branches])
+            return ColumnarDataset.load(directory)
+        return _collect_selected(results, branches, dtype=dtype, length_limit=length_limit, directory=directory)
+    finally:
+        _shared_output.clear()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def tree2pandas(filename, treename, branches=None, start=None, stop=None, selection=None, clip=1e33, reader=None):
+    reader = RootNumpyReader() if reader is None else reader
+    data = reader.read(filename, treename, branches=branches, start=start, stop=stop, selection=selection)
+    columns = OrderedDict((name, _convert_column(data[name], None, clip)) for name in data.dtype.names)
+    return pandas.DataFrame(columns)
+
+
+def list_flat_branches(filename, treename, use_dtype=True, reader=None):
     """ Lists branches in the file, vector branches, say D_p, turns into D_p[0], D_p[1], D_p[2], D_p[3].
     First event is used to count number of components
     :param filename: filename
     :param treename: name of tree
     :return: list of strings
     """
-    import root_numpy
-    import numpy
+    reader = RootNumpyReader() if reader is None else reader
     result = []
-    data = root_numpy.root2array(filename, treename=treename, stop=1)
-    for branch, value in data.dtype.fields.items():
+    data = reader.read(filename, treename, stop=1)
+    for branch in data.dtype.names:
         if use_dtype:
-            if value[0].name != 'object':
+            if data.dtype.fields[branch][0].name != 'object':
                 result.append(branch)
             else:
                 matrix = numpy.array(list(data[branch]))
@@ -78,3 +299,113 @@ def list_flat_branches(filename, treename, use_dtype=True):
                 result.append(branch)
     return result
 
+
+class NtupleCache(object):
+    def __init__(self, cache_directory, max_size=10 * 2 ** 30, reader=None):
+        """
+        Disk cache of converted ntuples. The trees are converted with `read_trees` once,
+        the columns are stored as .npy files and are memory-mapped on subsequent loads.
+        Cache key contains paths, modification times and sizes of files, tree name, branches, selection, clip and dtype,
+        so modified files are reconverted.
+
+        :param cache_directory: str, where the converted ntuples are stored
+        :param max_size: int, max total size of cache in bytes,
+            least recently used ntuples are evicted when size is exceeded
+        :param reader: RootNumpyReader (default) or another reader with the same interface
+        """
+        self.cache_directory = cache_directory
+        self.max_size = max_size
+        self.reader = RootNumpyReader() if reader is None else reader
+        # list of (filenames, hit, time)
+        self.loads = []
+        if not os.path.exists(cache_directory):
+            os.makedirs(cache_directory)
+
+    def _compute_key(self, filenames, treename, branches, selection, clip, dtype):
+        files = []
+        for filename in filenames:
+            stat = os.stat(filename)
+            files.append([os.path.abspath(filename), stat.st_mtime, stat.st_size])
+        description = [files, treename, branches, selection, clip, str(numpy.dtype(dtype))]
+        return hashlib.sha1(json.dumps(description).encode('utf-8')).hexdigest()
+
+    def load(self, filenames, treename, branches=None, selection=None, clip=1e33, dtype='float32',
+             chunk_size=1000000, n_jobs=1):
+        """
+        Returns memory-mapped ColumnarDataset, parameters are the same as in `read_trees`
+        :rtype: ColumnarDataset
+        """
+        start_time = time.time()
+        if isinstance(filenames, string_types):
+            filenames = [filenames]
+        branches = None if branches is None else list(branches)
+        key = self._compute_key(filenames, treename, branches, selection, clip, dtype)
+        entry_directory = os.path.join(self.cache_directory, key)
+        hit = os.path.exists(entry_directory)
+        if hit:
+            # updating time of last access
+            os.utime(entry_directory, None)
+        else:
+            temp_directory = os.path.join(self.cache_directory, 'tmp_{}_{}'.format(key, os.getpid()))
+            try:
+                read_trees(filenames, treename, branches=branches, selection=selection, clip=clip, dtype=dtype,
+                           chunk_size=chunk_size, n_jobs=n_jobs, directory=temp_directory, reader=self.reader)
+                try:
+                    os.rename(temp_directory, entry_directory)
+                except OSError:
+                    # the same ntuple was simultaneously cached by other process, its entry is used
+                    if not os.path.exists(entry_directory):
+                        raise
+            finally:
+                # conversion failed or the entry was already created by other process
+                if os.path.exists(temp_directory):
+                    shutil.rmtree(temp_directory)
+            self._evict(keep=key)
+        result = ColumnarDataset.load(entry_directory)
+        self.loads.append((filenames, hit, time.time() - start_time))
+        return result
+
+    def _get_entries(self):
+        """:return: list of (key, size in bytes, time of last access)"""
+        entries = []
+        for key in os.listdir(self.cache_directory):
+            path = os.path.join(self.cache_directory, key)
+            if key.startswith('tmp_') or not os.path.isdir(path):
+                continue
+            size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+            entries.append((key, size, os.path.getmtime(path)))
+        return entries
+
+    def _evict(self, keep=None):
+        entries = sorted(self._get_entries(), key=lambda entry: entry[2])
+        total_size = sum(size for _, size, _ in entries)
+        for key, size, _ in entries:
+            if total_size <= self.max_size:
+                break
+            if key != keep:
+                shutil.rmtree(os.path.join(self.cache_directory, key))
+                total_size -= size
+
+    @property
+    def size(self):
+        """Total size of cached ntuples in bytes"""
+        return sum(size for _, size, _ in self._get_entries())
+
+    @property
+    def n_hits(self):
+        return sum(1 for _, hit, _ in self.loads if hit)
+
+    @property
+    def n_misses(self):
+        return sum(1 for _, hit, _ in self.loads if not hit)
+
+    def report(self):
+        """Returns pandas.DataFrame with all loads: files, whether this was a cache hit and time of load"""
+        return pandas.DataFrame({'files': [', '.join(filenames) for filenames, _, _ in self.loads],
+                                 'hit': [hit for _, hit, _ in self.loads],
+                                 'time': [load_time for _, _, load_time in self.loads]},
+                                columns=['files', 'hit', 'time'])
+
+    def clear(self):
+        for key, _, _ in self._get_entries():
+            shutil.rmtree(os.path.join(self.cache_directory, key))
@@ -6,7 +6,7 @@ import pandas
 from sklearn.base import BaseEstimator, ClassifierMixin, clone
 from sklearn.utils.validation import column_or_1d
 
-from .commonutils import sigmoid_function, check_sample_weight
+from .commonutils import sigmoid_function, check_sample_weight, check_dataframe
 
 __author__ = "Alex Rogozhnikov"
 
@@ -65,7 +65,7 @@ class AbstractBoostingClassifier(BaseEstimator, ClassifierMixin):
     def check_input(X, y, sample_weight, check_two_classes=True):
         sample_weight = check_sample_weight(y, sample_weight=sample_weight)
         assert len(X) == len(y), 'Different lengths'
-        X = pandas.DataFrame(X)
+        X = check_dataframe(X)
         y = column_or_1d(y)
 
         if check_two_classes:
@@ -13,15 +13,20 @@ The more data -> the better toyMC.
 from __future__ import division, print_function
 
 import math
+import pickle
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
 import numpy
 import pandas
 import pylab
+from scipy import sparse
 from scipy.stats.stats import pearsonr
 from sklearn.neighbors import NearestNeighbors
-from .commonutils import map_on_cluster, check_sample_weight
+from .commonutils import map_on_cluster, check_sample_weight, check_fork_start_method
+from .columnar import ColumnarDataset
 
 __author__ = 'Alex Rogozhnikov'
-__all__ = ['generate_toymc_with_special_features']
+__all__ = ['generate_toymc_with_special_features', 'ToyMCGenerator']
 
 
 # TODO test whether we really need to symmetrize, in the other case everything can be simplified
@@ -29,27 +34,139 @@ __all__ = ['generate_toymc_with_special_features']
 # TODO random state
 
 
-def count_probabilities(primary_weights, secondary_weights, knn):
+def compute_neighbourhoods(data, knn, symmetrize=True):
+    """Computes neighbourhoods of events, which are used to choose the second event in pair
+    :type data: numpy.array of shape [n_samples, n_features]
+    :type knn: int, the number of neighbours (including the event itself)
+    :type symmetrize: bool, if True, b is in neighbourhood of a if a is in neighbourhood of b
+    :rtype: scipy.sparse.csr_matrix of shape [n_samples, n_samples] with ones, row i contains neighbours of event i
+    """
+    n_samples = len(data)
+    neighbours = NearestNeighbors(n_neighbors=knn, algorithm='ball_tree').fit(data)\
+        .kneighbors(data, return_distance=False)
+    # the first neighbour is the event itself
+    rows = numpy.repeat(numpy.arange(n_samples), knn - 1)
+    columns = neighbours[:, 1:].ravel()
+    if symmetrize:
+        rows, columns = numpy.concatenate([rows, neighbours.ravel()]), \
+            numpy.concatenate([columns, numpy.repeat(numpy.arange(n_samples), knn)])
+    result = sparse.csr_matrix((numpy.ones(len(rows)), (rows, columns)), shape=(n_samples, n_samples))
+    # duplicates are summed during conversion
+    result.data[:] = 1.
+    return result
+
+
+def count_probabilities(primary_weights, secondary_weights, neighbourhoods):
     """Computes probabilities of all points to be chosen as the second point in pair
     :type primary_weights: numpy.array, shape = [n_samples],
         the first event is generated according to these weights
     :type secondary_weights: numpy.array, shape = [n_samples],
         the second event is chosen between knn of first according to this weights
-    :type knn: dict, {event_id: list of neighbors ids}.
+    :type neighbourhoods: scipy.sparse.csr_matrix with ones, see `compute_neighbourhoods`
     :rtype: numpy.array, shape = [n_samples], the probabilities
     """
-    size = len(knn)
-    primary_weights /= numpy.sum(primary_weights)
-    secondary_weights = numpy.array(secondary_weights)
-    probabilities = numpy.zeros(size, dtype=float)
-    for index, neighbours in knn.items():
-        knn_weights = numpy.take(secondary_weights, neighbours)
-        knn_proba = knn_weights / numpy.sum(knn_weights) * primary_weights[index]
-        probabilities[neighbours] += knn_proba
-    return probabilities
-
-
-def generate_toymc(data, size, knn=4, symmetrize=True, power=2.0, 
+    primary_weights = primary_weights / numpy.sum(primary_weights)
+    secondary_weights = numpy.array(secondary_weights, dtype=float)
+    # probability of event j = secondary_weight_j * sum_i primary_weight_i / (total secondary weight in row i)
+    row_weights = neighbourhoods.dot(secondary_weights)
+    return secondary_weights * neighbourhoods.T.dot(primary_weights / row_weights)
+
+
+def compute_cumulative_tables(neighbourhoods, secondary_weights):
+    """Cumulative distributions of second event in each row are written one after another,
+    values in row i belong to (i, i + 1], so the table is sorted and the second events
+    for all the first events are found with single searchsorted, see `choose_second_events`
+    :rtype: numpy.array of shape [neighbourhoods.nnz]
+    """
+    weights = numpy.take(secondary_weights, neighbourhoods.indices)
+    row_lengths = numpy.diff(neighbourhoods.indptr)
+    cumulative = numpy.cumsum(weights)
+    row_starts = numpy.repeat(cumulative[neighbourhoods.indptr[:-1]] - weights[neighbourhoods.indptr[:-1]],
+                              row_lengths)
+    row_totals = numpy.repeat(neighbourhoods.dot(secondary_weights), row_lengths)
+    result = (cumulative - row_starts) / row_totals
+    result += numpy.repeat(numpy.arange(len(row_lengths)), row_lengths)
+    # guarantees that the last element of row is exactly i + 1
+    result[neighbourhoods.indptr[1:] - 1] = numpy.arange(1, len(row_lengths) + 1)
+    return result
+
+
+def choose_second_events(neighbourhoods, cumulative_tables, first_events, random_state):
+    """For each first event chooses one of its neighbours according to cumulative tables"""
+    positions = numpy.searchsorted(cumulative_tables, first_events + random_state.random_sample(len(first_events)),
+                                   side='right')
+    return neighbourhoods.indices[positions]
+
+
+def _default_knn(input_length):
+    knn = int(math.pow(input_length, 0.33) / 2)
+    knn = max(knn, 2)
+    knn = min(knn, 25)
+    knn = min(knn, input_length)
+    return knn
+
+
+class NeighbourModel(object):
+    def __init__(self, knn=4, symmetrize=True, power=2.0, reweighting_iterations=5):
+        """
+        Fitted model of toy MC: the event is generated as t * x_1 + (1 - t) * x_2,
+        where x_1 is chosen from original events (according to weights), x_2 - from neighbours of x_1.
+        The neighbours are computed once in fit, after this sampling is cheap.
+        Parameters are the same as in `generate_toymc`.
+        """
+        self.knn = knn
+        self.symmetrize = symmetrize
+        self.power = power
+        self.reweighting_iterations = reweighting_iterations
+
+    def fit(self, data, sample_weight=None):
+        """
+        :type data: numpy.array | pandas.DataFrame, the original distribution, should contain more than two events
+        """
+        data = pandas.DataFrame(data)
+        assert len(data) > 2, 'unable to generate new events with only one-two given'
+        self.columns = list(data.columns)
+        self.values = numpy.array(data.values, dtype=float)
+        self.sample_weight = check_sample_weight(data, sample_weight=sample_weight)
+        self.sample_weight /= numpy.sum(self.sample_weight)
+
+        knn = _default_knn(len(data)) if self.knn is None else self.knn
+        assert knn > 0, "knn should be positive"
+        self.neighbourhoods = compute_neighbourhoods(self.values, knn=knn, symmetrize=self.symmetrize)
+
+        secondary_weights = numpy.ones(len(data), dtype=float)
+        for _ in range(self.reweighting_iterations):
+            probabilities = count_probabilities(self.sample_weight, secondary_weights, self.neighbourhoods)
+            secondary_weights *= ((self.sample_weight / probabilities) ** 0.5)
+        self.cumulative_tables = compute_cumulative_tables(self.neighbourhoods, secondary_weights)
+        return self
+
+    def sample(self, size, random_state=numpy.random, out=None):
+        """
+        Generates toy MC
+        :param int size: the number of events
+        :param out: None or numpy.array of shape [size, n_features] to write result
+        :rtype: numpy.array of shape [size, n_features]
+        """
+        # generating indices and weights
+        k_1 = random_state.choice(len(self.values), p=self.sample_weight, size=size)
+        t_1 = 0.6 * random_state.random_sample(size) ** self.power
+        k_2 = choose_second_events(self.neighbourhoods, self.cumulative_tables, k_1, random_state=random_state)
+        if out is None:
+            out = numpy.empty([size, len(self.columns)])
+        # t_1 * x_1 + (1 - t_1) * x_2 = x_2 + t_1 * (x_1 - x_2)
+        numpy.subtract(self.values[k_1, :], self.values[k_2, :], out=out)
+        out *= t_1[:, numpy.newaxis]
+        out += self.values[k_2, :]
+        return out
+
+    def sample_chunk(self, size, random_seed, chunk):
+        """Generates chunk of toy MC with random generator seeded by (random_seed, chunk),
+        so the result depends neither on order of generation nor on process, where chunk is generated"""
+        return self.sample(size, random_state=numpy.random.RandomState([random_seed, chunk]))
+
+
+def generate_toymc(data, size, knn=4, symmetrize=True, power=2.0,
                    reweighting_iterations=5, sample_weight=None, random_state=numpy.random):
     """Generates toy Monte-Carlo, the dataset with distribution very close to the original one.
 
@@ -65,70 +182,274 @@ def generate_toymc(data, size, knn=4, symmetrize=True, power=2.0,
     :rtype: (pandas.DataFrame, int), returns the generated toymc and the number of events
         that were copied from original data set.
     """
-
     data = pandas.DataFrame(data)
-    input_length = len(data)
-
-    sample_weight = check_sample_weight(data, sample_weight=sample_weight)
-    sample_weight /= numpy.sum(sample_weight)
-
-    if input_length <= 2:
+    if len(data) <= 2:
         # unable to generate new events with only one-two given
         return data, len(data)
+    model = NeighbourModel(knn=knn, symmetrize=symmetrize, power=power, reweighting_iterations=reweighting_iterations)
+    model.fit(data, sample_weight=sample_weight)
+    return pandas.DataFrame(model.sample(size, random_state=random_state), columns=data.columns), 0
+
+
+def generate_toymc_chunks(data, size, chunk_size=1000000, random_seed=0, knn=4, symmetrize=True, power=2.0,
+                          reweighting_iterations=5, sample_weight=None):
+    """Generates toy MC by chunks, the memory used doesn't depend on size.
+    The neighbours are computed once, chunk number i is generated with random generator seeded by
+    (random_seed, i), so the chunks are reproducible and may be generated in different processes
+    (see `NeighbourModel.sample_chunk`).
+    Other parameters are the same as in `generate_toymc`.
+    :param int chunk_size: the maximal number of events in chunk
+    :return: generator of pandas.DataFrame-s
+    """
+    data = pandas.DataFrame(data)
+    model = NeighbourModel(knn=knn, symmetrize=symmetrize, power=power, reweighting_iterations=reweighting_iterations)
+    model.fit(data, sample_weight=sample_weight)
+    for chunk, start in enumerate(range(0, size, chunk_size)):
+        values = model.sample_chunk(min(chunk_size, size - start), random_seed=random_seed, chunk=chunk)
+        yield pandas.DataFrame(values, columns=data.columns)
+
+
+def write_toymc(directory, data, size, chunk_size=1000000, random_seed=0, dtype='float32', **kwargs):
+    """Generates toy MC by chunks (see `generate_toymc_chunks`) and writes it in columnar format,
+    so the toy MC may be much larger than memory
+    :param str directory: where to write the columns
+    :param kwargs: other parameters passed to `generate_toymc_chunks`
+    :rtype: ColumnarDataset, memory-mapped from directory
+    """
+    data = pandas.DataFrame(data)
+    result = ColumnarDataset.create_empty(directory, column_names=data.columns, length=size, dtype=dtype)
+    start = 0
+    for chunk in generate_toymc_chunks(data, size, chunk_size=chunk_size, random_seed=random_seed, **kwargs):
+        for column in data.columns:
+            result[column][start:start + len(chunk)] = chunk[column].values
+        start += len(chunk)
+    for column in data.columns:
+        result[column].flush()
+    return ColumnarDataset.load(directory)
+
+
+def split_size(size, group_sizes):
+    """Splits size between groups proportionally to their sizes (the sum of result is exactly size)"""
+    group_sizes = numpy.asarray(group_sizes, dtype=float)
+    expected = size * group_sizes / numpy.sum(group_sizes)
+    result = numpy.floor(expected).astype(int)
+    # the remaining events are given to groups with largest fractional parts
+    remainders = numpy.argsort(result - expected, kind='mergesort')[:size - numpy.sum(result)]
+    result[remainders] += 1
+    return result
 
-    if knn is None:
-        knn = int(math.pow(input_length, 0.33) / 2)
-        knn = max(knn, 2)
-        knn = min(knn, 25)
-        knn = min(knn, input_length)
-
-    assert knn > 0, "knn should be positive"
-
-    # generating knn
-    neighbors_helper = NearestNeighbors(n_neighbors=knn, algorithm='ball_tree', )
-    neighbors_helper.fit(data)
-    neighbours = neighbors_helper.kneighbors(data, return_distance=False)
-
-    two_side_neighbours = {}
-    for i, neighbours_i in enumerate(neighbours):
-        two_side_neighbours[i] = list(neighbours_i[1:])
 
-    if symmetrize:
-        # symmetrization goes here
-        for i in range(len(neighbours)):
-            for n in neighbours[i]:
-                two_side_neighbours[n].append(i)
-
-        # removing duplicates in neighbors
-        old_neighbours = two_side_neighbours
-        two_side_neighbours = {}
-        for i, neighbours_i in old_neighbours.items():
-            two_side_neighbours[i] = numpy.unique(neighbours_i)
-
-    secondary_weights = numpy.ones(len(neighbours), dtype=float)
-    for _ in range(reweighting_iterations):
-        probabilities = count_probabilities(sample_weight, secondary_weights, two_side_neighbours)
-        secondary_weights *= ((sample_weight / probabilities) ** 0.5)
-
-    # generating indices and weights
-    k_1 = random_state.choice(input_length, p=sample_weight, size=size)
-        # randint(0, input_length, size)
-    t_1 = 0.6 * random_state.random(size) ** power
-    t_2 = 1. - t_1
-
-    k_2 = numpy.zeros(size, dtype=int)
-    for i in range(size):
-        neighs = two_side_neighbours[k_1[i]]
-        neigh_weights = numpy.take(secondary_weights, neighs)
-        neigh_weights /= numpy.sum(neigh_weights)
-        # selected_neigh = getRandom(neighs, weights)
-        k_2[i] = random_state.choice(neighs, p=neigh_weights)
-
-    numpied_df = data.values
-    first = numpy.multiply(t_1[:, numpy.newaxis], numpied_df[k_1, :])
-    second = numpy.multiply(t_2[:, numpy.newaxis], numpied_df[k_2, :])
-
-    return pandas.DataFrame(numpy.add(first, second), columns=data.columns), 0
+# data shared with forked worker processes, so that tasks contain only numbers of groups
+_shared_data = {}
+
+
+def _fit_shared_group(group):
+    generator, values, sample_weight, groups_indices = _shared_data['fit']
+    indices = groups_indices[group]
+    return group, generator._fit_group(values[indices], sample_weight[indices])
+
+
+def _sample_shared_group(task):
+    group, start, size, seed = task
+    generator, output = _shared_data['sample']
+    generator._sample_group(group, size, out=output[start:start + size], seed=seed)
+
+
+class ToyMCGenerator(object):
+    def __init__(self, clustering_features=None, integer_features=None, knn=None, symmetrize=True, power=2.0,
+                 reweighting_iterations=5, n_jobs=1):
+        """
+        Generator of toy MC, which is fitted once and then samples many times.
+        Events with different values of clustering features are not mixed: a separate `NeighbourModel`
+        is fitted for each group, the groups with less than three events are sampled by copying events.
+        The generator can be pickled (see `save` and `load`).
+
+        :type clustering_features: list | None, the events with different values of these features
+            can not be mixed together, for instance: is_signal, number of jets / muons.
+        :type integer_features: list | None, these features are treated as usual,
+            but after toymc is generated, they are converted to integers
+        :param int n_jobs: the number of processes used to fit and sample groups.
+            Groups are processed starting from the largest one, the data is not sent to processes
+            (they are forked with it, so 'fork' start method is required),
+            generated events are written directly to shared output array.
+            `sample_chunks` forks processes once and reuses them for all chunks.
+        Other parameters are the same as in `generate_toymc`.
+        """
+        self.clustering_features = clustering_features
+        self.integer_features = integer_features
+        self.knn = knn
+        self.symmetrize = symmetrize
+        self.power = power
+        self.reweighting_iterations = reweighting_iterations
+        self.n_jobs = n_jobs
+
+    def _start_pool(self, n_tasks, **shared):
+        """Puts shared objects to _shared_data and forks processes, which inherit them"""
+        check_fork_start_method()
+        _shared_data.update(shared)
+        try:
+            return multiprocessing.Pool(min(self.n_jobs, n_tasks))
+        except:
+            _shared_data.clear()
+            raise
+
+    @staticmethod
+    def _stop_pool(pool):
+        pool.close()
+        pool.join()
+        _shared_data.clear()
+
+    def _start_sampling_pool(self, max_size):
+        """Forks processes, which write sampled events to shared output array with max_size rows.
+        :return: tuple (pool, output)"""
+        shape = (max_size, len(self.stayed_features))
+        # output is allocated in shared memory before forking, processes write their groups into it
+        output = numpy.frombuffer(RawArray('d', max(shape[0] * shape[1], 1)), dtype=float)
+        output = output[:shape[0] * shape[1]].reshape(shape)
+        return self._start_pool(len(self.models), sample=(self, output)), output
+
+    @staticmethod
+    def _map_largest_first(pool, function, tasks, sizes):
+        """Computes function on tasks in processes of pool (tasks with larger sizes go first),
+        returns the results in arbitrary order"""
+        order = numpy.argsort(-numpy.asarray(sizes), kind='mergesort')
+        return list(pool.imap_unordered(function, [tasks[i] for i in order], chunksize=1))
+
+    def fit(self, data, sample_weight=None):
+        """
+        :type data: pandas.DataFrame, the original distribution
+        :param sample_weight: None or array-like of shape [n_samples], weights of events
+        """
+        data = pandas.DataFrame(data)
+        sample_weight = check_sample_weight(data, sample_weight=sample_weight)
+        clustering_features = [] if self.clustering_features is None else list(self.clustering_features)
+        self.columns = list(data.columns)
+        self.dtypes = data.dtypes
+        self.stayed_features = [column for column in self.columns if column not in clustering_features]
+
+        if len(clustering_features) == 0:
+            groups = [((), numpy.arange(len(data)))]
+        else:
+            groups = []
+            for key, indices in data.groupby(clustering_features).indices.items():
+                groups.append((key if isinstance(key, tuple) else (key, ), indices))
+
+        self.group_keys = [key for key, _ in groups]
+        self.group_sizes = numpy.array([len(indices) for _, indices in groups], dtype=int)
+        values = data[self.stayed_features].values
+        if self.n_jobs == 1 or len(groups) == 1:
+            self.models = [self._fit_group(values[indices], sample_weight[indices]) for _, indices in groups]
+        else:
+            self.models = [None] * len(groups)
+            pool = self._start_pool(len(groups), fit=(self, values, sample_weight, [indices for _, indices in groups]))
+            try:
+                groups_order = list(range(len(groups)))
+                for group, model in self._map_largest_first(pool, _fit_shared_group, groups_order, self.group_sizes):
+                    self.models[group] = model
+            finally:
+                self._stop_pool(pool)
+        return self
+
+    def _fit_group(self, values, sample_weight):
+        if len(values) <= 2:
+            # unable to generate new events with only one-two given, events will be copied
+            return numpy.array(values, dtype=float)
+        model = NeighbourModel(knn=self.knn, symmetrize=self.symmetrize, power=self.power,
+                               reweighting_iterations=self.reweighting_iterations)
+        return model.fit(values, sample_weight=sample_weight)
+
+    def _sample_group(self, group, size, out, seed):
+        """Writes toy MC (values of stayed features) of one group into out,
+        random generator is seeded by seed + [group]"""
+        random_state = numpy.random.RandomState(list(seed) + [group])
+        model = self.models[group]
+        if isinstance(model, NeighbourModel):
+            model.sample(size, random_state=random_state, out=out)
+        else:
+            numpy.take(model, random_state.randint(0, len(model), size=size), axis=0, out=out)
+
+    def _in_parallel(self):
+        return self.n_jobs > 1 and len(self.models) > 1
+
+    def _sample(self, size, seed, sampling_pool=None):
+        """
+        :param sampling_pool: None or tuple (pool, output) returned by `_start_sampling_pool`,
+            if None and sampling is parallel, processes are forked for this call only
+        """
+        group_sizes = split_size(size, self.group_sizes)
+        starts = numpy.cumsum(group_sizes) - group_sizes
+        shape = (size, len(self.stayed_features))
+        if not self._in_parallel() or size == 0:
+            values = numpy.empty(shape)
+            for group, (start, group_size) in enumerate(zip(starts, group_sizes)):
+                self._sample_group(group, group_size, out=values[start:start + group_size], seed=seed)
+        else:
+            pool, output = self._start_sampling_pool(size) if sampling_pool is None else sampling_pool
+            assert len(output) >= size, 'shared output is too small'
+            tasks = [(group, start, group_size, seed)
+                     for group, (start, group_size) in enumerate(zip(starts, group_sizes))]
+            try:
+                self._map_largest_first(pool, _sample_shared_group, tasks, group_sizes)
+                # output is reused by next chunks
+                values = output[:size].copy()
+            finally:
+                if sampling_pool is None:
+                    self._stop_pool(pool)
+        return self._to_dataframe(values, group_sizes)
+
+    def _to_dataframe(self, values, group_sizes):
+        """Builds DataFrame from generated values of stayed features,
+        values of clustering features are set to keys of groups"""
+        result = pandas.DataFrame(values, columns=self.stayed_features)
+        clustering_features = [column for column in self.columns if column not in self.stayed_features]
+        for i, column in enumerate(clustering_features):
+            keys = numpy.array([key[i] for key in self.group_keys], dtype=self.dtypes[column])
+            result[column] = numpy.repeat(keys, group_sizes)
+        for column in (self.integer_features or []):
+            result[column] = result[column].astype(numpy.int)
+        return result[self.columns]
+
+    @property
+    def n_copied_groups(self):
+        """The number of groups, which are too small, so the toy MC is generated by copying events"""
+        return sum(not isinstance(model, NeighbourModel) for model in self.models)
+
+    def sample(self, size, random_seed=None):
+        """
+        Generates toy MC, each group gets the part of events proportional to its size
+        :param int size: the number of events
+        :param random_seed: None or int, if None, random seed is chosen randomly
+        :rtype: pandas.DataFrame with the same columns as original data
+        """
+        if random_seed is None:
+            random_seed = numpy.random.randint(0, 2 ** 31 - 1)
+        return self._sample(size, seed=[random_seed])
+
+    def sample_chunks(self, size, chunk_size=1000000, random_seed=0):
+        """
+        Generates toy MC by chunks, chunk number i is reproducible: it depends only on (random_seed, i)
+        :return: generator of pandas.DataFrame-s with at most chunk_size events
+        """
+        sampling_pool = None
+        if self._in_parallel() and size > 0:
+            sampling_pool = self._start_sampling_pool(min(chunk_size, size))
+        try:
+            for chunk, start in enumerate(range(0, size, chunk_size)):
+                yield self._sample(min(chunk_size, size - start), seed=[random_seed, chunk],
+                                   sampling_pool=sampling_pool)
+        finally:
+            if sampling_pool is not None:
+                self._stop_pool(sampling_pool[0])
+
+    def save(self, filename):
+        with open(filename, 'wb') as output_file:
+            pickle.dump(self, output_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(filename):
+        """:rtype: ToyMCGenerator"""
+        with open(filename, 'rb') as input_file:
+            return pickle.load(input_file)
 
 
 def prepare_toymc(group, clustering_features, stayed_features, size_factor):
@@ -147,7 +468,7 @@ def prepare_toymc(group, clustering_features, stayed_features, size_factor):
 
 
 def generate_toymc_with_special_features(data, size, clustering_features=None, integer_features=None,
-                                         ipc_profile=None):
+                                         ipc_profile=None, n_jobs=1):
     """Generate the toymc.
     :type data: numpy.array | pandas.DataFrame, from which data is generated
     :type size: int, how many events to generate
@@ -156,7 +477,8 @@ def generate_toymc_with_special_features(data, size, clustering_features=None, i
     :type integer_features: this features are treated as usual,
         but after toymc is generated, they are rounded to the closest integer value
     :type ipc_profile: toymc can be generated on the cluster,
-        provided there is at least one clustering feature
+        provided there is at least one clustering feature. If None, `ToyMCGenerator` is used.
+    :type n_jobs: int, the number of local processes used to generate groups (when ipc_profile is None)
     :rtype: pandas.DataFrame with result,
         all the columns should be the same as in input
     """
@@ -167,7 +489,16 @@ def generate_toymc_with_special_features(data, size, clustering_features=None, i
     stayed_features = [col for col in data.columns if col not in clustering_features]
     size_factor = float(size) / len(data)
     copied_groups = 0
-    if len(clustering_features) == 0:
+    if ipc_profile is None:
+        generator = ToyMCGenerator(clustering_features=clustering_features, integer_features=integer_features,
+                                   n_jobs=n_jobs)
+        result = generator.fit(data).sample(size)
+        copied_groups = generator.n_copied_groups
+        if copied_groups > 0:
+            print("Copied events in %i groups from original file. Totally generated %i rows " %
+                  (copied_groups, len(result)))
+        return result
+    elif len(clustering_features) == 0:
         result, copied = generate_toymc(data, size=size, knn=None)
     else:
         grouped = data.groupby(clustering_features)
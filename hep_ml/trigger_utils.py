@@ -0,0 +1,159 @@
+"""
+`trigger_utils` contains scoring of classifiers on the level of events (as it is done in triggers).
+
+Candidates (i.e. secondary vertices) belong to events, the event passes the trigger if its best candidate passes,
+so the score of event is the maximal score of its candidates.
+The threshold of trigger is chosen to have fixed output rate (the part of passed background events).
+
+All the computations use segment reductions (see `commonutils.compute_segments`),
+predictions can be computed by chunks, so samples with hundreds of millions of candidates are processed
+without keeping all predictions in memory.
+"""
+from __future__ import division, print_function, absolute_import
+
+import numpy
+import pandas
+
+from .commonutils import compute_segments, reduce_segments
+
+__author__ = 'Alex Rogozhnikov'
+
+__all__ = ['EventScoreAccumulator', 'compute_event_scores', 'predict_event_scores', 'efficiency_vs_rate']
+
+
+def _reduce_events(event_ids, scores, labels, weights):
+    """Returns event ids and maximal values of scores, labels and weights for each event"""
+    order, starts, events = compute_segments(event_ids)
+    return events, [reduce_segments(values, order, starts, ufunc=numpy.maximum)
+                    for values in [scores, labels, weights]]
+
+
+class EventScoreAccumulator(object):
+    def __init__(self, compaction_size=10 ** 6):
+        """
+        Collects scores of candidates by parts and computes score of each event (maximal score of its candidates).
+        Candidates of one event may be in different parts. Each part is reduced immediately,
+        reduced parts are merged when their total length exceeds compaction_size (or twice the number of events).
+        """
+        self.compaction_size = compaction_size
+        self._events = []
+        self._values = []
+        self._n_pending = 0
+        self._n_compacted = 0
+
+    def add(self, event_ids, scores, labels=None, sample_weight=None):
+        """
+        :param event_ids: array of shape [n_candidates], the event of each candidate
+        :param scores: array of shape [n_candidates], predictions for candidates
+        :param labels: None or array of shape [n_candidates], the label of event is the maximal label of candidates
+        :param sample_weight: None or array of shape [n_candidates], the weight of event
+            is the maximal weight of candidates (candidates of one event are expected to have the same weight)
+        """
+        event_ids = numpy.asarray(event_ids)
+        scores = numpy.asarray(scores)
+        assert len(event_ids) == len(scores), 'different lengths of event_ids and scores'
+        labels = numpy.zeros(len(scores), dtype=int) if labels is None else numpy.asarray(labels)
+        sample_weight = numpy.ones(len(scores)) if sample_weight is None else numpy.asarray(sample_weight)
+        if len(scores) == 0:
+            return self
+        events, values = _reduce_events(event_ids, scores, labels, sample_weight)
+        self._events.append(events)
+        self._values.append(values)
+        self._n_pending += len(events)
+        if self._n_pending > max(self.compaction_size, 2 * self._n_compacted):
+            self._compact()
+        return self
+
+    def _compact(self):
+        if len(self._events) > 1:
+            events, values = _reduce_events(numpy.concatenate(self._events),
+                                            *[numpy.concatenate(parts) for parts in zip(*self._values)])
+            self._events, self._values = [events], [values]
+        self._n_pending = self._n_compacted = len(self._events[0]) if len(self._events) > 0 else 0
+
+    def compute(self):
+        """
+        :return: pandas.DataFrame indexed by event id with columns 'score', 'label', 'weight'
+        """
+        self._compact()
+        if len(self._events) == 0:
+            return pandas.DataFrame(columns=['score', 'label', 'weight'])
+        scores, labels, weights = self._values[0]
+        return pandas.DataFrame({'score': scores, 'label': labels, 'weight': weights},
+                                index=self._events[0], columns=['score', 'label', 'weight'])
+
+
+def compute_event_scores(event_ids, scores, labels=None, sample_weight=None):
+    """
+    Computes the score of each event as maximal score of its candidates
+    :return: pandas.DataFrame indexed by event id with columns 'score', 'label', 'weight',
+        see `EventScoreAccumulator.add` for description of parameters
+    """
+    return EventScoreAccumulator().add(event_ids, scores, labels=labels, sample_weight=sample_weight).compute()
+
+
+def _take_chunk(X, start, stop):
+    if isinstance(X, numpy.ndarray):
+        return X[start:stop]
+    # pandas.DataFrame and ColumnarDataset
+    return X.take(numpy.arange(start, stop))
+
+
+def predict_event_scores(classifier, X, event_ids, labels=None, sample_weight=None, chunk_size=1000000):
+    """
+    Computes predictions of classifier for candidates by chunks and the score of each event,
+    predictions of all candidates are never kept in memory.
+    :param classifier: trained classifier with predict_proba method
+    :param X: pandas.DataFrame, ColumnarDataset or numpy.array with candidates
+    :param event_ids: array of shape [n_candidates], the event of each candidate
+    :param int chunk_size: the number of candidates predicted at once
+    :return: pandas.DataFrame indexed by event id with columns 'score', 'label', 'weight'
+    """
+    event_ids = numpy.asarray(event_ids)
+    assert len(X) == len(event_ids), 'different lengths of X and event_ids'
+    accumulator = EventScoreAccumulator()
+    for start in range(0, len(X), chunk_size):
+        stop = min(start + chunk_size, len(X))
+        scores = classifier.predict_proba(_take_chunk(X, start, stop))[:, 1]
+        accumulator.add(event_ids[start:stop], scores,
+                        labels=None if labels is None else labels[start:stop],
+                        sample_weight=None if sample_weight is None else sample_weight[start:stop])
+    return accumulator.compute()
+
+
+def efficiency_vs_rate(event_scores, rates):
+    """
+    Computes thresholds of trigger for fixed output rates and efficiencies of signal events.
+    Event passes if its score is greater than the threshold.
+    :param event_scores: pandas.DataFrame returned by `compute_event_scores` or `predict_event_scores`,
+        events with label 0 are background, others are signal
+    :param rates: sequence of floats in [0, 1], the parts of background events (by weight), which pass the trigger
+    :return: pandas.DataFrame with columns 'rate', 'threshold', 'efficiency', the rate is real part of
+        passed background events (it may be less than requested if there are events with equal scores)
+    """
+    rates = numpy.asarray(rates, dtype=float)
+    assert numpy.all((rates >= 0) & (rates <= 1)), 'rates should be in [0, 1]'
+    is_signal = event_scores['label'].values > 0
+    scores = event_scores['score'].values
+    weights = event_scores['weight'].values.astype(float)
+    assert numpy.any(is_signal) and numpy.any(~is_signal), 'both signal and background events are needed'
+
+    bck_scores = scores[~is_signal]
+    order = numpy.argsort(bck_scores, kind='mergesort')[::-1]
+    bck_scores = bck_scores[order]
+    bck_passed = numpy.cumsum(weights[~is_signal][order])
+    bck_passed /= bck_passed[-1]
+    # the threshold is the score of first background event, which can't pass, so all passed are strictly above
+    positions = numpy.searchsorted(bck_passed, rates * (1 + 1e-10), side='right')
+    thresholds = numpy.where(positions < len(bck_scores),
+                             bck_scores[numpy.minimum(positions, len(bck_scores) - 1)], -numpy.inf)
+
+    sig_order = numpy.argsort(scores[is_signal], kind='mergesort')
+    sig_scores = scores[is_signal][sig_order]
+    sig_weights = numpy.cumsum(weights[is_signal][sig_order][::-1])[::-1]
+    sig_weights = numpy.append(sig_weights, 0) / sig_weights[0]
+    efficiencies = sig_weights[numpy.searchsorted(sig_scores, thresholds, side='right')]
+
+    real_rates = numpy.append(0., bck_passed)[numpy.searchsorted(-bck_scores, -thresholds, side='left')]
+    return pandas.DataFrame({'rate': real_rates, 'threshold': thresholds, 'efficiency': efficiencies},
+                            columns=['rate', 'threshold', 'efficiency'])
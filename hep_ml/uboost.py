@@ -50,7 +50,8 @@ class uBoostBDT:
                  keep_debug_info=False,
                  random_state=None,
                  uniform_label=1,
-                 algorithm="SAMME"):
+                 algorithm="SAMME",
+                 warm_start=False):
         """
         uBoostBDT is AdaBoostClassifier, which is modified to have flat
         efficiency of signal (class=1) along some variables.
@@ -120,6 +121,11 @@ class uBoostBDT:
             If None, the random number generator is the RandomState
             instance used by `np.random`.
 
+        warm_start: bool, (default=False)
+            if True, next call of fit (on the same data) continues boosting
+            from the last trained estimator, until there are n_estimators of them.
+            Weights, scores and neighbours of training events are kept between calls.
+
         Attributes
         ----------
         `estimators_` : list of classifiers
@@ -152,6 +158,7 @@ class uBoostBDT:
         self.keep_debug_info = keep_debug_info
         self.random_state = random_state
         self.algorithm = algorithm
+        self.warm_start = warm_start
 
     def fit(self, X, y, sample_weight=None, neighbours_matrix=None):
         """Build a boosted classifier from the training set (X, y).
@@ -202,6 +209,15 @@ class uBoostBDT:
             "only two-class classification is implemented"
         self.signed_uniform_label = 2 * self.uniform_label - 1
 
+        if self.warm_start and getattr(self, '_boost_state', None) is not None:
+            assert self.n_estimators >= len(self.estimators_), \
+                "n_estimators is less than number of trained estimators"
+            X_train_variables, y = check_arrays(self.get_train_vars(X), column_or_1d(y), sparse_format="dense")
+            assert len(self._boost_state[0]) == len(X), "warm start is possible only on the same data"
+            self._boost(X_train_variables, y, *self._boost_state)
+            self.score_cut = self.score_cuts_[-1]
+            return self
+
         if neighbours_matrix is not None:
             assert np.shape(neighbours_matrix) == (len(X), self.n_neighbors), \
                 "Wrong shape of neighbours_matrix"
@@ -239,7 +255,7 @@ class uBoostBDT:
 
         self.random_generator = check_random_state(self.random_state)
 
-        self._boost(X_train_variables, y, sample_weight)
+        self._boost(X_train_variables, y, sample_weight, np.zeros(len(X)))
 
         self.score_cut = self.signed_uniform_label * compute_bdt_cut(
             self.target_efficiency, y == self.uniform_label, self.predict_score(X) * self.signed_uniform_label)
@@ -302,12 +318,11 @@ class uBoostBDT:
 
         return boost_weights, global_score_cut
 
-    def _boost(self, X, y, sample_weight):
+    def _boost(self, X, y, sample_weight, cumulative_score):
         """Implement a single boost using the SAMME or SAMME.R algorithm,
         which is modified in uBoost way"""
-        cumulative_score = np.zeros(len(X))
         y_signed = 2 * y - 1
-        for iteration in range(self.n_estimators):
+        for iteration in range(len(self.estimators_), self.n_estimators):
             estimator = self._make_estimator()
             mask = generate_mask(len(X), self.bagging, self.random_generator)
             estimator.fit(X, y, sample_weight=sample_weight * mask)
@@ -345,7 +360,9 @@ class uBoostBDT:
             if self.keep_debug_info:
                 self.debug_dict['weights'].append(sample_weight.copy())
 
-        if not self.keep_debug_info:
+        # weights and scores of training events are needed only to continue boosting
+        self._boost_state = (sample_weight, cumulative_score) if self.warm_start else None
+        if not self.keep_debug_info and not self.warm_start:
             self.knn_indices = None
 
     def get_train_vars(self, X):
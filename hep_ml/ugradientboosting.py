@@ -9,7 +9,7 @@ from sklearn.tree.tree import DecisionTreeRegressor, DTYPE
 from sklearn.utils.random import check_random_state
 from sklearn.utils.validation import check_arrays, column_or_1d
 
-from .commonutils import check_sample_weight, sigmoid_function
+from .commonutils import check_sample_weight, sigmoid_function, check_dataframe
 from .losses import AbstractLossFunction, AdaLossFunction, AbstractFlatnessLossFunction, \
     KnnFlatnessLossFunction, BinFlatnessLossFunction, AbstractMatrixLossFunction, \
     SimpleKnnLossFunction, BinomialDevianceLossFunction
@@ -34,10 +34,26 @@ class uGradientBoostingClassifier(BaseEstimator, ClassifierMixin):
                  criterion='mse',
                  splitter='best',
                  train_variables=None,
-                 random_state=None):
+                 random_state=None,
+                 warm_start=False,
+                 block_size=None,
+                 chunk_size=100000,
+                 dtype=None):
         """This version of gradient boosting supports only two-class classification and only special losses
         derived from AbstractLossFunction.
         :type loss: AbstractLossFunction
+        :param warm_start: bool, if True, next call of fit (on the same data) continues training
+            with already built trees, until there are n_estimators trees.
+            Predictions on training data are kept between calls.
+        :param block_size: None or int. If None, the data is converted to one matrix and each tree
+            is trained on subsample of it. Otherwise out-of-core mode is used: X is not converted
+            (so it may be memory-mapped ColumnarDataset), each tree is trained on randomly sampled block
+            of block_size events, predictions are updated by chunks (subsample is ignored).
+        :param chunk_size: int, the number of events in chunk used to compute predictions in out-of-core mode
+        :param dtype: None or floating type of predictions on training data, weights and gradients
+            (the loss receives weights of this type and computes in it). numpy.float32 halves
+            memory traffic on these arrays, sums are still accumulated in float64.
+            If None, float64 is used (float32 in out-of-core mode).
         """
         self.loss = loss
         self.n_estimators = n_estimators
@@ -54,6 +70,10 @@ class uGradientBoostingClassifier(BaseEstimator, ClassifierMixin):
         self.random_state = random_state
         self.criterion = criterion
         self.splitter = splitter
+        self.warm_start = warm_start
+        self.block_size = block_size
+        self.chunk_size = chunk_size
+        self.dtype = dtype
 
     def check_params(self):
         assert isinstance(self.loss, AbstractLossFunction), \
@@ -62,34 +82,54 @@ class uGradientBoostingClassifier(BaseEstimator, ClassifierMixin):
         assert 0 < self.subsample <= 1., 'subsample should be in (0, 1]'
         self.random_state = check_random_state(self.random_state)
 
+    def _get_dtype(self):
+        if self.dtype is not None:
+            return numpy.dtype(self.dtype)
+        return numpy.dtype(numpy.float64 if self.block_size is None else numpy.float32)
+
     def fit(self, X, y, sample_weight=None):
-        sample_weight = check_sample_weight(y, sample_weight=sample_weight)
+        sample_weight = check_sample_weight(y, sample_weight=sample_weight, dtype=self._get_dtype())
         assert len(X) == len(y), 'Different lengths of X and y'
-        X = pandas.DataFrame(X)
+        X = check_dataframe(X)
         y = numpy.array(column_or_1d(y), dtype=int)
         assert numpy.all(numpy.in1d(y, [0, 1])), 'Only two-class classification supported'
         self.check_params()
-
-        self.estimators = []
-        self.scores = []
+        continue_training = self.warm_start and getattr(self, '_train_score', None) is not None
 
         n_samples = len(X)
-        n_inbag = int(self.subsample * len(X))
-        self.loss = copy.copy(self.loss)
-        self.loss.fit(X, y, sample_weight=sample_weight)
+        if not continue_training:
+            self.estimators = []
+            self.scores = []
+            self.loss = copy.copy(self.loss)
+            self.loss.fit(X, y, sample_weight=sample_weight)
 
         # preparing for fitting in trees
         X = self.get_train_vars(X)
         self.n_features = X.shape[1]
-        X, y = check_arrays(X, y, dtype=DTYPE, sparse_format="dense", check_ccontiguous=True)
-        y_pred = numpy.zeros(len(X), dtype=float)
-
-        if self.init_estimator is not None:
-            y_signed = 2 * y - 1
-            self.init_estimator.fit(X, y_signed, sample_weight=sample_weight)
-            y_pred += numpy.ravel(self.init_estimator.predict(X))
+        if self.block_size is None:
+            X, y = check_arrays(X, y, dtype=DTYPE, sparse_format="dense", check_ccontiguous=True)
+            n_inbag = int(self.subsample * n_samples)
+        else:
+            assert not self.update_tree, 'update_tree is not supported in out-of-core mode'
+            n_inbag = min(self.block_size, n_samples)
 
-        for stage in range(self.n_estimators):
+        if continue_training:
+            assert self.n_estimators >= len(self.estimators), 'n_estimators is less than number of trained trees'
+            assert len(self._train_score) == n_samples, 'warm start is possible only on the same data'
+            y_pred = self._train_score
+        else:
+            y_pred = numpy.zeros(n_samples, dtype=self._get_dtype())
+            if self.init_estimator is not None:
+                y_signed = 2 * y - 1
+                if self.block_size is None:
+                    self.init_estimator.fit(X, y_signed, sample_weight=sample_weight)
+                else:
+                    init_indices = numpy.sort(self.random_state.choice(n_samples, size=n_inbag, replace=False))
+                    self.init_estimator.fit(self._take_rows(X, init_indices), y_signed[init_indices],
+                                            sample_weight=sample_weight[init_indices])
+                self._add_predictions(self.init_estimator, X, y_pred, 1.)
+
+        for stage in range(len(self.estimators), self.n_estimators):
             # tree creation
             tree = DecisionTreeRegressor(
                 criterion=self.criterion,
@@ -104,24 +144,45 @@ class uGradientBoostingClassifier(BaseEstimator, ClassifierMixin):
             # tree learning
             residual = self.loss.negative_gradient(y_pred)
             train_indices = self.random_state.choice(n_samples, size=n_inbag, replace=False)
+            if self.block_size is not None:
+                # sorted indices are faster to read from memory-mapped storage
+                train_indices.sort()
 
-            tree.fit(X[train_indices], residual[train_indices],
+            tree.fit(self._take_rows(X, train_indices), residual[train_indices],
                      sample_weight=sample_weight[train_indices], check_input=False)
             # update tree leaves
             if self.update_tree:
                 self.loss.update_tree(tree.tree_, X=X, y=y, y_pred=y_pred, sample_weight=sample_weight,
                                       update_mask=numpy.ones(len(X), dtype=bool), residual=residual)
 
-            y_pred += self.learning_rate * tree.predict(X)
+            self._add_predictions(tree, X, y_pred, self.learning_rate)
             self.estimators.append(tree)
             self.scores.append(self.loss(y_pred))
+        # predictions on training data are needed only to continue training
+        self._train_score = y_pred if self.warm_start else None
         return self
 
+    def _take_rows(self, X, indices):
+        """Returns float32 matrix with selected events, X is matrix or not converted data (in out-of-core mode)"""
+        if isinstance(X, numpy.ndarray):
+            return X[indices]
+        return numpy.array(X.take(indices), dtype=DTYPE)
+
+    def _add_predictions(self, estimator, X, y_pred, multiplier):
+        """y_pred += multiplier * estimator.predict(X), not converted data is processed by chunks"""
+        if isinstance(X, numpy.ndarray):
+            y_pred += multiplier * numpy.ravel(estimator.predict(X))
+            return
+        for start in range(0, len(X), self.chunk_size):
+            stop = min(start + self.chunk_size, len(X))
+            rows = self._take_rows(X, numpy.arange(start, stop))
+            y_pred[start:stop] += multiplier * numpy.ravel(estimator.predict(rows))
+
     def get_train_vars(self, X):
         if self.train_variables is None:
             return X
         else:
-            return X.loc[:, self.train_variables]
+            return X[self.train_variables]
 
     def score_to_proba(self, score):
         result = numpy.zeros([len(score), 2], dtype=float)
@@ -130,7 +191,8 @@ class uGradientBoostingClassifier(BaseEstimator, ClassifierMixin):
         return result
 
     def staged_predict_score(self, X):
-        X = self.get_train_vars(X)
+        # converting only once, not on each stage
+        X, = check_arrays(self.get_train_vars(X), dtype=DTYPE, sparse_format="dense")
         y_pred = numpy.zeros(len(X))
         if self.init_estimator is not None:
             y_pred += numpy.ravel(self.init_estimator.predict(X))
@@ -140,6 +202,18 @@ class uGradientBoostingClassifier(BaseEstimator, ClassifierMixin):
             yield y_pred
 
     def predict_score(self, X):
+        if self.block_size is not None:
+            # out-of-core mode: all trees are applied to one chunk at a time
+            X = self.get_train_vars(X)
+            result = numpy.zeros(len(X))
+            for start in range(0, len(X), self.chunk_size):
+                stop = min(start + self.chunk_size, len(X))
+                rows = self._take_rows(X, numpy.arange(start, stop))
+                if self.init_estimator is not None:
+                    result[start:stop] += numpy.ravel(self.init_estimator.predict(rows))
+                for estimator in self.estimators:
+                    result[start:stop] += self.learning_rate * estimator.predict(rows)
+            return result
         result = None
         for score in self.staged_predict_score(X):
             result = score
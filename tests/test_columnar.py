@@ -0,0 +1,79 @@
+from __future__ import division, print_function, absolute_import
+
+import pickle
+import shutil
+import tempfile
+import numpy
+from hep_ml.columnar import ColumnarDataset
+from hep_ml.commonutils import generate_sample, computeSignalKnnIndices
+from hep_ml.losses import BinomialDevianceLossFunction, BinFlatnessLossFunction
+from hep_ml.ugradientboosting import uGradientBoostingClassifier
+from hep_ml.meanadaboost import MeanAdaBoostClassifier
+
+__author__ = 'Alex Rogozhnikov'
+
+
+def test_columnar_dataset(n_samples=1000, n_features=5):
+    X, y = generate_sample(n_samples, n_features)
+    directory = tempfile.mkdtemp()
+    try:
+        dataset = ColumnarDataset.from_dataframe(X, directory=directory)
+        assert isinstance(dataset['column0'], numpy.memmap)
+        assert dataset.shape == X.shape and list(dataset.columns) == list(X.columns)
+        assert numpy.allclose(numpy.array(dataset), X.values)
+
+        # selection of columns shares data
+        part = dataset[['column1', 'column3']]
+        assert part['column1'] is dataset['column1']
+        assert numpy.allclose(part.values, X[['column1', 'column3']].values)
+
+        # selection of rows
+        indices = numpy.random.choice(n_samples, size=300)
+        rows = part.take(indices)
+        assert numpy.allclose(rows.values, X[['column1', 'column3']].values[indices])
+        assert numpy.allclose(rows.take([5, 7])['column1'], X['column1'].values[indices[[5, 7]]])
+        mask = y > 0.5
+        assert numpy.allclose(dataset.take(mask).values, X.values[mask])
+        assert numpy.allclose(rows.to_dataframe().values, rows.values)
+
+        knn1 = computeSignalKnnIndices(['column0'], X, mask, n_neighbors=5)
+        knn2 = computeSignalKnnIndices(['column0'], dataset, mask, n_neighbors=5)
+        assert numpy.mean(knn1 == knn2) > 0.95
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_classifiers_on_columnar(n_samples=1000, n_features=5):
+    X, y = generate_sample(n_samples, n_features)
+    dataset = ColumnarDataset.from_dataframe(X)
+    train_variables = list(X.columns[1:])
+
+    predictions = []
+    for data in [X, dataset]:
+        clf = uGradientBoostingClassifier(loss=BinomialDevianceLossFunction(), n_estimators=10, subsample=0.5,
+                                          train_variables=train_variables, random_state=42)
+        predictions.append(clf.fit(data, y).predict_proba(data))
+    assert numpy.allclose(predictions[0], predictions[1])
+
+    clf = uGradientBoostingClassifier(loss=BinFlatnessLossFunction(['column0']), n_estimators=5,
+                                      train_variables=train_variables)
+    assert clf.fit(dataset, y).predict_proba(dataset).shape == (n_samples, 2)
+
+    clf = MeanAdaBoostClassifier(uniform_variables=['column0'], train_variables=train_variables, n_estimators=5)
+    assert clf.fit(dataset, y).predict_proba(dataset).shape == (n_samples, 2)
+
+
+def test_columnar_pickling(n_samples=10000, n_features=5):
+    X, y = generate_sample(n_samples, n_features)
+    directory = tempfile.mkdtemp()
+    try:
+        for dataset in [ColumnarDataset.from_dataframe(X), ColumnarDataset.from_dataframe(X, directory=directory)]:
+            part = dataset[['column2', 'column1']].take(y > 0.5)
+            restored = pickle.loads(pickle.dumps(part))
+            assert restored.columns == part.columns
+            assert numpy.all(restored.values == part.values)
+        # memory-mapped data is pickled by reference
+        assert len(pickle.dumps(dataset)) < 1000
+        assert isinstance(pickle.loads(pickle.dumps(dataset))['column0'], numpy.memmap)
+    finally:
+        shutil.rmtree(directory)
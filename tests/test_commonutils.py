@@ -109,3 +109,18 @@ def test_compute_knn_indices(n_events=100):
         assert numpy.all(is_signal[neighbours] == is_signal[i]), "returned indices are not signal/bg"
 
 test_compute_knn_indices()
+
+
+def test_segments(size=1000):
+    from hep_ml.commonutils import compute_segments, reduce_segments, spread_segments
+    group_ids = numpy.random.randint(0, 100, size=size) * 3
+    values = numpy.random.normal(size=size)
+    order, starts, group_values = compute_segments(group_ids)
+    assert numpy.all(group_values == numpy.unique(group_ids))
+    maxima = reduce_segments(values, order, starts, ufunc=numpy.maximum)
+    sums = reduce_segments(values, order, starts, ufunc=numpy.add)
+    for group, maximum, total in zip(group_values, maxima, sums):
+        assert maximum == numpy.max(values[group_ids == group])
+        assert numpy.allclose(total, numpy.sum(values[group_ids == group]))
+    spread = spread_segments(maxima, order, starts)
+    assert numpy.all(spread == maxima[numpy.searchsorted(group_values, group_ids)])
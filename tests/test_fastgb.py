@@ -8,7 +8,7 @@ from hep_ml.commonutils import generate_sample
 from hep_ml.ugradientboosting import AdaLossFunction, BinomialDevianceLossFunction as BinomialDeviance, \
     uGradientBoostingClassifier
 from hep_ml.experiments.categorical import CategoricalTreeRegressor, SimpleCategoricalRegressor, ObliviousCategoricalRegressor, \
-    CategoricalLinearClassifier
+    CategoricalLinearClassifier, compute_hashed_categories, bincount_rows
 from hep_ml.experiments.fasttree import FastTreeRegressor, FastNeuroTreeRegressor
 from hep_ml.experiments.fastgb import TreeGradientBoostingClassifier, CommonGradientBoosting, FoldingGBClassifier
 import time
@@ -103,6 +103,69 @@ def test_gb_quality(n_samples=10000, n_features=10, distance=0.5):
 # test_gb_quality(n_samples=100000)
 
 
+def test_hashed_categories(n_samples=1000, n_features=10, n_attempts=20, n_categories_power=5):
+    X = numpy.random.randint(100, size=[n_samples, n_features])
+    feature_ids = numpy.random.randint(n_features, size=[n_attempts, 3])
+    feature_coeffs = numpy.random.choice([-1, 0, 2, 5, 7, 13, 51, 113, 227], size=[n_attempts, 3])
+    weights = numpy.random.random(n_samples)
+    for data in [X, numpy.asfortranarray(X)]:
+        categories = compute_hashed_categories(data, feature_ids, feature_coeffs, n_categories_power, shift_rows=True)
+        counts = bincount_rows(categories, 2 ** n_categories_power, weights=numpy.tile(weights, n_attempts))
+        for attempt in range(n_attempts):
+            expected = (X[:, feature_ids[attempt]] * feature_coeffs[attempt]).sum(axis=1) % 2 ** n_categories_power
+            assert numpy.all(categories[attempt] == expected + attempt * 2 ** n_categories_power)
+            assert numpy.allclose(counts[attempt], numpy.bincount(expected, weights=weights, minlength=2 ** n_categories_power))
+
+
+def test_categorical_linear_batches(n_samples=20000, n_features=10, p=0.7):
+    y = numpy.random.random(n_samples) > 0.5
+    X = numpy.random.randint(40, size=[n_samples, n_features]) * 2
+    X += numpy.random.random(size=[n_samples, n_features]) > p
+    X += y[:, numpy.newaxis]
+    trainX, testX, trainY, testY = X[::2], X[1::2], y[::2], y[1::2]
+
+    full = CategoricalLinearClassifier().fit(trainX, trainY, iterations=50)
+    full_auc = roc_auc_score(testY, full.predict_proba(testX)[:, 1])
+    batched = CategoricalLinearClassifier(batch_size=1000, adagrad=True, learning_rate=0.5, random_state=42)
+    batched.fit(trainX, trainY, iterations=3)
+    assert roc_auc_score(testY, batched.predict_proba(testX)[:, 1]) > full_auc - 0.01
+
+    # training on pieces
+    streamed = CategoricalLinearClassifier(batch_size=1000, adagrad=True, learning_rate=0.5, random_state=42)
+    for start in range(0, len(trainX), 2500):
+        streamed.partial_fit(trainX[start:start + 2500], trainY[start:start + 2500])
+    assert roc_auc_score(testY, streamed.predict_proba(testX)[:, 1]) > full_auc - 0.01
+
+
+class _EagerlyRegularized(CategoricalLinearClassifier):
+    """Regularizes all categories at each step"""
+    def _regularize_skipped(self, X):
+        CategoricalLinearClassifier._regularize_skipped(self, None)
+
+
+class _NotRegularizedWhenAbsent(CategoricalLinearClassifier):
+    def _regularize_skipped(self, X):
+        pass
+
+
+def test_categorical_linear_lazy_regularization(n_samples=2000, n_features=3):
+    y = numpy.random.random(n_samples) > 0.5
+    X = numpy.random.randint(30, size=[n_samples, n_features]) + 20 * y[:, numpy.newaxis]
+    # this category is present only in the first batch
+    X[:100, 0] = 100
+    y[:100] = True
+    for adagrad in [False, True]:
+        for l1_reg, l2_reg in [(0., 1.), (0.1, 0.), (0.05, 2.)]:
+            params = dict(batch_size=100, l1_reg=l1_reg, l2_reg=l2_reg, adagrad=adagrad,
+                          learning_rate=0.5, random_state=42)
+            lazy = CategoricalLinearClassifier(**params).fit(X, y, iterations=3)
+            eager = _EagerlyRegularized(**params).fit(X, y, iterations=3)
+            assert numpy.allclose(lazy.coeffs, eager.coeffs)
+            assert numpy.all(lazy.last_steps == lazy.n_steps)
+            not_regularized = _NotRegularizedWhenAbsent(**params).fit(X, y, iterations=3)
+            assert 0 <= lazy.coeffs[0, 100] < not_regularized.coeffs[0, 100]
+
+
 def test_categorical_gb(n_samples=100000, n_features=10, p=0.7):
     y = numpy.random.random(n_samples) > 0.5
     X = numpy.random.randint(40, size=[n_samples, n_features]) * 2
@@ -1,6 +1,12 @@
+import os
+import time
+import shutil
+import tempfile
 import numpy
 from collections import OrderedDict
-from hep_ml.grid_search import SimpleParameterOptimizer, AbstractParameterGenerator, GridOptimalSearchCV
+from sklearn.base import BaseEstimator, ClassifierMixin
+from hep_ml.grid_search import SimpleParameterOptimizer, AbstractParameterGenerator, GridOptimalSearchCV, \
+    SuccessiveHalvingOptimizer, RegressionParameterOptimizer
 from hep_ml.commonutils import generate_sample
 
 __author__ = 'Alex Rogozhnikov'
@@ -68,3 +74,211 @@ def test_grid_search():
     grid_cv.print_param_stats([0.1, 0.3, 0.5, 0.7])
 
 
+
+
+class SleepingClassifier(BaseEstimator, ClassifierMixin):
+    """Classifier with constant predictions, which trains for `delay` seconds"""
+    def __init__(self, delay=0., value=0.5):
+        self.delay = delay
+        self.value = value
+
+    def fit(self, X, y, sample_weight=None):
+        time.sleep(self.delay)
+        return self
+
+    def predict_proba(self, X):
+        result = numpy.zeros([len(X), 2])
+        result[:, 1] = self.value
+        return result
+
+
+def test_async_grid_search():
+    from sklearn.ensemble import AdaBoostClassifier
+    grid = OrderedDict([('learning_rate', [0.01, 0.1, 0.5, 1.]), ('n_estimators', [5, 10, 15, 20, 30])])
+    trainX, trainY = generate_sample(1000, 10, distance=0.5)
+    grid_cv = GridOptimalSearchCV(AdaBoostClassifier(), grid, n_evaluations=8, refit=True, n_jobs=3)
+    grid_cv.fit(trainX, trainY)
+    assert len(grid_cv.grid_scores_) == 8
+    grid_cv.predict_proba(trainX)
+
+    # slow evaluations are cancelled
+    grid = OrderedDict([('delay', [0., 0., 10.]), ('value', [0.1, 0.2, 0.3, 0.4])])
+    grid_cv = GridOptimalSearchCV(SleepingClassifier(), grid, n_evaluations=6, n_jobs=2, timeout=2.,
+                                  score_function=lambda y, p: p[0])
+    start = time.time()
+    grid_cv.fit(trainX, trainY)
+    assert time.time() - start < 10
+    assert grid_cv.evaluations_done == 6
+    for (delay_index, value_index), score in grid_cv.grid_scores_.items():
+        assert delay_index != 2 and score == grid['value'][value_index]
+
+
+def test_parallel_folds():
+    from sklearn.ensemble import AdaBoostClassifier
+    from sklearn.metrics import roc_auc_score
+    from hep_ml.grid_search import estimate_classifier
+    trainX, trainY = generate_sample(2000, 10, distance=0.5)
+    for n_jobs in [1, 3]:
+        score = estimate_classifier({'n_estimators': 10}, AdaBoostClassifier(), trainX, trainY, folds=3, fold_checks=3,
+                                    score_function=roc_auc_score, catch_exceptions=False, n_jobs=n_jobs)
+        assert 0.6 < score <= 1.
+
+    grid = OrderedDict([('learning_rate', [0.01, 0.1, 0.5, 1.]), ('n_estimators', [5, 10, 15, 20, 30])])
+    grid_cv = GridOptimalSearchCV(AdaBoostClassifier(), grid, n_evaluations=4, n_jobs=2, folds=3, fold_checks=2,
+                                  fold_n_jobs=2)
+    grid_cv.fit(trainX, trainY)
+    assert len(grid_cv.grid_scores_) == 4
+
+
+def test_reproducible_evaluation():
+    from sklearn.ensemble import AdaBoostClassifier
+    from sklearn.metrics import roc_auc_score
+    from hep_ml.grid_search import estimate_classifier
+    trainX, trainY = generate_sample(2000, 10, distance=0.5)
+    # folds and subsample of training data are determined by random_state
+    scores = [estimate_classifier({'n_estimators': 10, 'train_fraction': 0.3}, AdaBoostClassifier(random_state=0),
+                                  trainX, trainY, folds=3, fold_checks=2, score_function=roc_auc_score,
+                                  catch_exceptions=False, random_state=42) for _ in range(2)]
+    assert scores[0] == scores[1]
+
+
+class RecordingSleepingClassifier(SleepingClassifier):
+    """SleepingClassifier, which writes id of process, where it is trained, into directory"""
+    def __init__(self, delay=0., value=0.5, directory=None):
+        SleepingClassifier.__init__(self, delay=delay, value=value)
+        self.directory = directory
+
+    def fit(self, X, y, sample_weight=None):
+        open(os.path.join(self.directory, str(os.getpid())), 'w').close()
+        return SleepingClassifier.fit(self, X, y, sample_weight=sample_weight)
+
+
+def _is_running(pid):
+    try:
+        with open('/proc/{}/status'.format(pid)) as status_file:
+            return not any(line.startswith('State:') and 'Z' in line for line in status_file)
+    except IOError:
+        return False
+
+
+def test_cancelled_parallel_folds():
+    if not os.path.exists('/proc'):
+        return
+    trainX, trainY = generate_sample(1000, 10, distance=0.5)
+    directory = tempfile.mkdtemp()
+    try:
+        grid = OrderedDict([('delay', [30., 40.]), ('value', [0.1, 0.2])])
+        grid_cv = GridOptimalSearchCV(RecordingSleepingClassifier(directory=directory), grid, n_evaluations=2,
+                                      n_jobs=2, timeout=2., folds=2, fold_checks=2, fold_n_jobs=2)
+        start = time.time()
+        grid_cv.fit(trainX, trainY)
+        assert time.time() - start < 20
+        # processes of pools evaluating folds are terminated together with evaluation processes
+        pids = [int(name) for name in os.listdir(directory)]
+        assert len(pids) == 4
+        time.sleep(0.5)
+        assert not any(_is_running(pid) for pid in pids)
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_successive_halving(n_evaluations=60):
+    def function(x, y, n_estimators):
+        # the bigger budget, the less noise
+        return - (x - 7) ** 2 - (y - 3) ** 2 + numpy.random.normal() * 100. / n_estimators
+
+    optimizer = FunctionOptimizer(function, param_grid=OrderedDict([('x', list(range(11))), ('y', list(range(11)))]),
+                                  n_evaluations=n_evaluations,
+                                  parameter_generator_type=lambda grid, n: SuccessiveHalvingOptimizer(
+                                      grid, n, budget_parameter='n_estimators', min_budget=10, max_budget=270))
+    optimizer.optimize()
+    generator = optimizer.generator
+    assert generator.budgets == [10, 30, 90, 270]
+    n_results = [len(results) for results in generator.rung_scores_]
+    assert sum(n_results) == n_evaluations
+    assert numpy.all(numpy.diff(n_results) <= 0) and n_results[2] > 0
+    # promoted configurations are the best on previous rung
+    for rung in range(1, len(n_results)):
+        assert set(generator.rung_scores_[rung]) <= set(generator.rung_scores_[rung - 1])
+    assert generator.grid_scores_ == generator.rung_scores_[generator.top_rung_]
+    assert generator.best_params_['n_estimators'] == generator.budgets[generator.top_rung_]
+
+    # subsampling of training data
+    from sklearn.ensemble import AdaBoostClassifier
+    trainX, trainY = generate_sample(2000, 10, distance=0.5)
+    grid = OrderedDict([('learning_rate', [0.01, 0.1, 0.5, 1.]), ('n_estimators', [5, 10, 15, 20, 30])])
+    grid_cv = GridOptimalSearchCV(AdaBoostClassifier(), grid, n_evaluations=8, refit=True,
+                                  param_generator_type=lambda grid, n: SuccessiveHalvingOptimizer(grid, n, eta=2,
+                                                                                                 min_budget=0.25))
+    grid_cv.fit(trainX, trainY)
+    assert len(grid_cv.generator.rung_scores_[0]) > len(grid_cv.generator.rung_scores_[1]) > 0
+    grid_cv.predict_proba(trainX)
+
+
+def test_regression_optimizer(n_evaluations=40):
+    grid = OrderedDict([('x', list(range(11))), ('y', list(range(11))), ('z', list(range(11))),
+                        ('w', list(range(11)))])
+    optimizer = FunctionOptimizer(lambda x, y, z, w: x * y * z * w, param_grid=grid, n_evaluations=n_evaluations,
+                                  parameter_generator_type=RegressionParameterOptimizer)
+    optimizer.optimize()
+    generator = optimizer.generator
+    assert len(generator.grid_scores_) == len(generator.queued_tasks_) == n_evaluations
+    assert generator.best_score_ > 0.3 * 10 ** 4
+
+    # batch proposals are different points
+    indices, parameters = generator.generate_batch_points(size=5)
+    assert len(set(indices)) == 5 and len(generator.queued_tasks_) == n_evaluations + 5
+
+
+def test_stages_grouping():
+    from hep_ml.ugradientboosting import uGradientBoostingClassifier
+    from hep_ml.losses import BinomialDevianceLossFunction
+    trainX, trainY = generate_sample(1000, 10, distance=0.5)
+    grid = OrderedDict([('learning_rate', [0.05, 0.1, 0.2, 0.4]), ('max_depth', [2, 3]),
+                        ('n_estimators', [5, 10, 20])])
+    grid_cv = GridOptimalSearchCV(uGradientBoostingClassifier(loss=BinomialDevianceLossFunction()), grid,
+                                  n_evaluations=4, stages_parameter='n_estimators', refit=True)
+    grid_cv.fit(trainX, trainY)
+    # each fit gives scores for all numbers of stages
+    assert grid_cv.evaluations_done == 4
+    assert len(grid_cv.grid_scores_) == 4 * 3
+    for rate_index, depth_index, _ in grid_cv.grid_scores_:
+        for stage_index in range(3):
+            assert (rate_index, depth_index, stage_index) in grid_cv.grid_scores_
+    grid_cv.predict_proba(trainX)
+
+    # number of evaluations is limited by the number of points differing not only in number of stages
+    grid = OrderedDict([('learning_rate', [0.05, 0.1, 0.2, 0.4]), ('n_estimators', [2, 4, 6, 8, 10])])
+    for n_evaluations, expected in [(3, 3), (4, 4), (10, 4)]:
+        grid_cv = GridOptimalSearchCV(uGradientBoostingClassifier(loss=BinomialDevianceLossFunction()), grid,
+                                      n_evaluations=n_evaluations, stages_parameter='n_estimators')
+        grid_cv.fit(trainX, trainY)
+        assert grid_cv.evaluations_done == expected
+        assert len(grid_cv.grid_scores_) == expected * 5
+
+
+def test_parallel_stages():
+    from sklearn.ensemble import AdaBoostClassifier
+    trainX, trainY = generate_sample(500, 10, distance=0.5)
+    grid = OrderedDict([('learning_rate', [0.1, 0.5, 1.]), ('n_estimators', [2, 4, 6, 8, 10])])
+    for _ in range(5):
+        grid_cv = GridOptimalSearchCV(AdaBoostClassifier(), grid, n_evaluations=3, n_jobs=2,
+                                      stages_parameter='n_estimators')
+        grid_cv.fit(trainX, trainY)
+        # the same estimator isn't trained by concurrent evaluations
+        assert grid_cv.evaluations_done == 3
+        assert len(grid_cv.grid_scores_) == 3 * 5
+
+
+def test_early_stopped_stages():
+    from sklearn.ensemble import AdaBoostClassifier
+    from sklearn.tree import DecisionTreeClassifier
+    trainX, trainY = generate_sample(500, 10, distance=0.5)
+    # deep tree has zero error, so AdaBoost stops after first stage
+    grid = OrderedDict([('learning_rate', [0.1, 0.5, 1.]), ('n_estimators', [1, 5, 10])])
+    grid_cv = GridOptimalSearchCV(AdaBoostClassifier(DecisionTreeClassifier()), grid, n_evaluations=2,
+                                  stages_parameter='n_estimators')
+    grid_cv.fit(trainX, trainY)
+    assert len(grid_cv.grid_scores_) == 2 * 3
+    for (rate_index, stage_index), score in grid_cv.grid_scores_.items():
+        assert score == grid_cv.grid_scores_[rate_index, 0]
@@ -4,8 +4,8 @@ from unittest import TestCase
 from sklearn.metrics import roc_auc_score
 
 from hep_ml.commonutils import generate_sample
-from hep_ml.meanadaboost import MeanAdaBoostClassifier
-from hep_ml.experiments.triggermaxvoter import generate_max_voter
+from hep_ml.meanadaboost import MeanAdaBoostClassifier, compute_knn_vote, _mean_kernel, _order_statistic_kernel
+from hep_ml.experiments.triggermaxvoter import generate_max_voter, generate_group_voter
 
 __author__ = 'Alex Rogozhnikov'
 
@@ -19,8 +19,8 @@ class TestMeanAdaBoostClassifier(TestCase):
         self.uniform_variables = self.trainX.columns[:1]
         self.train_variables = self.trainX.columns[1:]
 
-    def check_clf(self, classifier):
-        classifier = classifier.fit(self.trainX, self.trainY, sample_weight=self.trainW)
+    def check_clf(self, classifier, **fit_params):
+        classifier = classifier.fit(self.trainX, self.trainY, sample_weight=self.trainW, **fit_params)
         pred = classifier.predict_proba(self.testX)
         auc = roc_auc_score(self.testY, pred[:, 1])
         print(auc, classifier)
@@ -34,7 +34,13 @@ class TestMeanAdaBoostClassifier(TestCase):
                                          train_variables=self.train_variables)
             self.check_clf(ada)
 
-        # TODO testing with matrix voter
+        # matrix voter, which computes mean of neighbours
+        from scipy import sparse
+        from hep_ml.commonutils import computeKnnIndicesOfSameClass
+        knn = computeKnnIndicesOfSameClass(self.uniform_variables, self.trainX, self.trainY, 10)
+        A = sparse.csr_matrix((numpy.ones(knn.size) / 10., knn.ravel(), numpy.arange(0, knn.size + 1, 10)))
+        self.check_clf(MeanAdaBoostClassifier(voting='matrix', uniform_variables=self.uniform_variables,
+                                              train_variables=self.train_variables, n_threads=2), A=A)
 
         # testing with voting
         n_events = 40
@@ -44,3 +50,47 @@ class TestMeanAdaBoostClassifier(TestCase):
                                               uniform_variables=self.uniform_variables,
                                               train_variables=self.train_variables))
 
+    def test_warm_start(self):
+        ada = MeanAdaBoostClassifier(uniform_variables=self.uniform_variables, train_variables=self.train_variables,
+                                     n_estimators=5, warm_start=True)
+        ada.fit(self.trainX, self.trainY)
+        ada.n_estimators = 10
+        ada.fit(self.trainX, self.trainY)
+        assert len(ada.estimators) == 10
+        full = MeanAdaBoostClassifier(uniform_variables=self.uniform_variables, train_variables=self.train_variables,
+                                      n_estimators=10).fit(self.trainX, self.trainY)
+        assert numpy.allclose(ada.predict_score(self.testX), full.predict_score(self.testX))
+
+
+    def test_voting_kernels(self, n_samples=1000):
+        scores = numpy.random.normal(size=n_samples)
+        for n_neighbours in [1, 4, 7]:
+            knn_indices = numpy.random.randint(0, n_samples, size=[n_samples, n_neighbours])
+            knn_scores = numpy.take(scores, knn_indices)
+            for block_size in [7, 100, 2 ** 15]:
+                vote = compute_knn_vote(scores, knn_indices, _mean_kernel, block_size=block_size)
+                assert numpy.allclose(vote, numpy.mean(knn_scores, axis=1))
+                kernel = _order_statistic_kernel((n_neighbours - 1) / 2.)
+                vote = compute_knn_vote(scores, knn_indices, kernel, block_size=block_size)
+                assert numpy.allclose(vote, numpy.median(knn_scores, axis=1))
+                for percentile in [0., 0.3, 55., 100.]:
+                    kernel = _order_statistic_kernel(percentile / 100. * (n_neighbours - 1))
+                    vote = compute_knn_vote(scores, knn_indices, kernel, block_size=block_size)
+                    assert numpy.allclose(vote, numpy.percentile(knn_scores, percentile, axis=1))
+
+    def test_group_voters(self, n_samples=1000, n_events=100):
+        event_indices = numpy.random.randint(0, n_events, size=n_samples)
+        scores = numpy.random.normal(size=n_samples)
+        reducers = {'max': numpy.max, 'mean': numpy.mean,
+                    'softmax': lambda x: 0.5 * numpy.log(numpy.sum(numpy.exp(x / 0.5))),
+                    'top-k': lambda x: numpy.mean(numpy.sort(x)[::-1][:3])}
+        for name, reducer in reducers.items():
+            voter = generate_group_voter(event_indices, reducer=name, temperature=0.5, k=3)
+            assert not voter.needs_knn_scores
+            voted = voter(scores)
+            for event in numpy.unique(event_indices):
+                assert numpy.allclose(voted[event_indices == event], reducer(scores[event_indices == event]))
+
+        voter = generate_group_voter(event_indices + n_events * self.trainY, reducer='softmax')
+        self.check_clf(MeanAdaBoostClassifier(voting=voter, uniform_variables=self.uniform_variables,
+                                              train_variables=self.train_variables))
@@ -0,0 +1,81 @@
+from __future__ import division, print_function, absolute_import
+
+import numpy
+from numpy.random.mtrand import RandomState
+from hep_ml.commonutils import weighted_percentile, compute_cut_for_efficiency
+from hep_ml.quantile_utils import weighted_percentiles_2d, SortedSample, QuantileSketch
+
+__author__ = 'Alex Rogozhnikov'
+
+
+def test_percentiles_2d(n_rows=10, n_samples=100):
+    random = RandomState()
+    arrays = random.normal(size=[n_rows, n_samples])
+    weights = random.exponential(size=n_samples)
+    percentiles = random.uniform(size=15)
+    for old_style in [False, True]:
+        result = weighted_percentiles_2d(arrays, percentiles, sample_weight=weights, old_style=old_style)
+        assert result.shape == (n_rows, len(percentiles))
+        for row, row_result in zip(arrays, result):
+            expected = weighted_percentile(row, percentiles, sample_weight=weights, old_style=old_style)
+            assert numpy.allclose(row_result, expected)
+        # the same via commonutils
+        assert numpy.allclose(weighted_percentile(arrays, percentiles, sample_weight=weights,
+                                                  old_style=old_style), result)
+
+    # different weights for each row
+    weights_2d = random.exponential(size=[n_rows, n_samples])
+    result = weighted_percentiles_2d(arrays, percentiles, sample_weight=weights_2d)
+    for row, row_weights, row_result in zip(arrays, weights_2d, result):
+        assert numpy.allclose(row_result, weighted_percentile(row, percentiles, sample_weight=row_weights))
+
+    # extreme percentiles
+    result = weighted_percentiles_2d(arrays, [0., 1.], old_style=True)
+    assert numpy.allclose(result[:, 0], arrays.min(axis=1)) and numpy.allclose(result[:, 1], arrays.max(axis=1))
+
+    # compute cut for many stages at once
+    mask = random.uniform(size=n_samples) > 0.5
+    cuts = compute_cut_for_efficiency([0.3, 0.7], mask, arrays, sample_weight=weights)
+    for row, row_cuts in zip(arrays, cuts):
+        assert numpy.allclose(row_cuts, compute_cut_for_efficiency([0.3, 0.7], mask, row, sample_weight=weights))
+
+
+def test_sorted_sample(n_samples=1000):
+    random = RandomState()
+    array = random.normal(size=n_samples)
+    weights = random.exponential(size=n_samples)
+    sample = SortedSample(array, sample_weight=weights)
+    percentiles = random.uniform(size=20)
+    assert numpy.allclose(sample.percentile(percentiles), weighted_percentile(array, percentiles, weights))
+    assert numpy.allclose(sample.percentile(percentiles, old_style=True),
+                          weighted_percentile(array, percentiles, weights, old_style=True))
+    for cut in random.normal(size=10):
+        assert numpy.allclose(sample.efficiency(cut), numpy.sum(weights[array > cut]) / numpy.sum(weights))
+
+
+def test_quantile_sketch(n_samples=100000, n_chunks=10, compression=200):
+    random = RandomState()
+    array = random.normal(size=n_samples)
+    weights = random.exponential(size=n_samples)
+    percentiles = numpy.linspace(0, 1, 41)
+
+    sketches = [QuantileSketch(compression=compression) for _ in range(2)]
+    for i, (chunk, chunk_weights) in enumerate(zip(numpy.array_split(array, n_chunks),
+                                                   numpy.array_split(weights, n_chunks))):
+        sketches[i % 2].update(chunk, sample_weight=chunk_weights)
+    sketch = sketches[0].merge(sketches[1])
+    assert len(sketch.values) <= 2 * compression + 1
+    assert numpy.allclose(sketch.total_weight, numpy.sum(weights))
+
+    # comparing ranks of found values with requested percentiles
+    approx = sketch.percentile(percentiles)
+    ranks = SortedSample(array, sample_weight=weights).efficiency(approx)
+    assert numpy.all(numpy.abs((1 - ranks) - percentiles) < 5. / compression)
+    assert approx[0] == array.min() and approx[-1] == array.max()
+
+    # empty sketches (i.e. computed on empty shards) can be merged
+    empty = QuantileSketch(compression=compression).merge(QuantileSketch(compression=compression))
+    assert len(empty.values) == 0 and empty.total_weight == 0
+    empty.update([])
+    assert numpy.all(empty.merge(sketch).percentile(percentiles) == approx)
+    assert numpy.all(sketch.merge(QuantileSketch()).percentile(percentiles) == approx)
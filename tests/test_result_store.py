@@ -0,0 +1,117 @@
+from __future__ import division, print_function, absolute_import
+
+import os
+import shutil
+import tempfile
+import warnings
+import numpy
+from collections import OrderedDict
+from sklearn.ensemble import AdaBoostClassifier
+from sklearn.tree import DecisionTreeClassifier
+from hep_ml.commonutils import generate_sample
+from hep_ml.grid_search import GridOptimalSearchCV
+from hep_ml.result_store import ResultStore, data_fingerprint, describe_value
+
+__author__ = 'Alex Rogozhnikov'
+
+
+def test_describe_and_fingerprint():
+    assert describe_value(DecisionTreeClassifier(max_depth=3)) == describe_value(DecisionTreeClassifier(max_depth=3))
+    assert describe_value(DecisionTreeClassifier(max_depth=3)) != describe_value(DecisionTreeClassifier(max_depth=4))
+    # arrays are described by contents, not by truncated repr
+    array = numpy.arange(10000.)
+    changed = array.copy()
+    changed[5000] = -1
+    assert describe_value(array) == describe_value(array.copy())
+    assert describe_value(array) != describe_value(changed)
+    assert describe_value([array]) != describe_value([changed])
+
+    def nested_function(y_true, y_pred):
+        return 0.
+
+    for value in [lambda y_true, y_pred: 0., nested_function, object()]:
+        try:
+            describe_value(value)
+            assert False, 'value should not be described'
+        except ValueError:
+            pass
+    X, y = generate_sample(1000, 5)
+    assert data_fingerprint(X, y) == data_fingerprint(X.copy(), y.copy())
+    assert data_fingerprint(X, y) != data_fingerprint(X, y, sample_weight=numpy.ones(len(y)))
+    assert data_fingerprint(X, y) != data_fingerprint(X[X.columns[1:]], y)
+
+
+def test_resumed_search():
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'results.sqlite')
+        trainX, trainY = generate_sample(1000, 10, distance=0.5)
+        grid = OrderedDict([('base_estimator', [DecisionTreeClassifier(max_depth=2), DecisionTreeClassifier(max_depth=3)]),
+                            ('learning_rate', [0.1, 0.5, 1.]),
+                            ('n_estimators', [5, 10, 15, 20])])
+        grid_cv = GridOptimalSearchCV(AdaBoostClassifier(), grid, n_evaluations=6, result_store=filename)
+        grid_cv.fit(trainX, trainY)
+        store = ResultStore(filename)
+        results = store.query()
+        assert len(results) == 6
+        # memory of evaluations isn't measured if they are done in main process
+        assert numpy.all(results['time'] > 0) and numpy.all(results['memory'].isnull())
+
+        # resumed search uses previous results and computes only new points
+        grid_cv = GridOptimalSearchCV(AdaBoostClassifier(), grid, n_evaluations=9, result_store=filename, n_jobs=2)
+        grid_cv.fit(trainX, trainY)
+        assert len(grid_cv.grid_scores_) == 9
+        assert len(store.query()) == 9
+        assert numpy.all(store.query()['memory'][6:] > 0)
+        for state_indices, score in grid_cv.grid_scores_.items():
+            params = grid_cv._describe_point(grid_cv.generator.indices_to_parameters(state_indices))
+            assert store.get(params=params, **grid_cv._store_key) == score
+
+        # different data
+        grid_cv = GridOptimalSearchCV(AdaBoostClassifier(), grid, n_evaluations=3, result_store=filename)
+        grid_cv.fit(trainX, 1 - trainY)
+        assert len(grid_cv.grid_scores_) == 3
+        assert len(store.query()) == 12
+        assert len(store.query(data=grid_cv._store_key['data'])) == 3
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_resumed_staged_search():
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'results.sqlite')
+        trainX, trainY = generate_sample(500, 10, distance=0.5)
+        grid = OrderedDict([('learning_rate', [0.1, 0.3, 0.5, 1.]), ('n_estimators', [2, 4, 6, 8, 10])])
+        grid_cv = GridOptimalSearchCV(AdaBoostClassifier(), grid, n_evaluations=2, result_store=filename,
+                                      stages_parameter='n_estimators')
+        grid_cv.fit(trainX, trainY)
+        assert len(ResultStore(filename).query()) == 2 * 5
+
+        # stored stages of one evaluation are counted as one evaluation
+        grid_cv = GridOptimalSearchCV(AdaBoostClassifier(), grid, n_evaluations=4, result_store=filename,
+                                      stages_parameter='n_estimators')
+        grid_cv.fit(trainX, trainY)
+        assert grid_cv.evaluations_done == 4
+        assert len(grid_cv.grid_scores_) == 4 * 5
+        assert len(ResultStore(filename).query()) == 4 * 5
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_undescribed_score_function():
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'results.sqlite')
+        trainX, trainY = generate_sample(1000, 10, distance=0.5)
+        grid = OrderedDict([('learning_rate', [0.1, 0.5, 1.]), ('n_estimators', [5, 10])])
+        grid_cv = GridOptimalSearchCV(AdaBoostClassifier(), grid, n_evaluations=2, result_store=filename,
+                                      score_function=lambda y_true, y_pred: numpy.mean(y_pred))
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            grid_cv.fit(trainX, trainY)
+        assert any('not stored' in str(warning.message) for warning in caught)
+        assert len(grid_cv.grid_scores_) == 2
+        assert len(ResultStore(filename).query()) == 0
+    finally:
+        shutil.rmtree(directory)
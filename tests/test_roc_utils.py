@@ -0,0 +1,61 @@
+from __future__ import division, print_function, absolute_import
+
+import numpy
+from numpy.random.mtrand import RandomState
+from sklearn.metrics import roc_auc_score
+from hep_ml.roc_utils import roc_curve, roc_auc, staged_roc_auc, downsampled_roc_curve
+
+__author__ = 'Alex Rogozhnikov'
+
+
+def generate_predictions(n_samples=1000, n_stages=10, n_values=None):
+    random = RandomState()
+    y = random.randint(0, 2, size=n_samples)
+    weights = random.exponential(size=n_samples)
+    scores = random.normal(size=[n_stages, n_samples]) + y * numpy.linspace(0, 2, n_stages)[:, numpy.newaxis]
+    if n_values is not None:
+        # creating a lot of equal values
+        scores = numpy.round(scores * n_values) / n_values
+    return y, weights, scores
+
+
+def test_roc_auc(n_samples=1000):
+    for n_values in [None, 3]:
+        y, weights, scores = generate_predictions(n_samples, n_stages=1, n_values=n_values)
+        score = scores[0]
+        for sample_weight in [None, weights]:
+            expected = roc_auc_score(y, score, sample_weight=sample_weight)
+            assert numpy.allclose(roc_auc(y, score, sample_weight=sample_weight), expected)
+            assert numpy.allclose(roc_auc(y, score.astype('float32'), sample_weight=sample_weight), expected)
+
+            order = numpy.argsort(score)
+            w = None if sample_weight is None else sample_weight[order]
+            assert numpy.allclose(roc_auc(y[order], score[order], sample_weight=w, presorted=True), expected)
+
+
+def test_roc_curve(n_samples=1000):
+    for n_values in [None, 3]:
+        y, weights, scores = generate_predictions(n_samples, n_stages=1, n_values=n_values)
+        fpr, tpr, thresholds = roc_curve(y, scores[0], sample_weight=weights)
+        assert numpy.all(numpy.diff(thresholds) < 0)
+        assert fpr[0] == tpr[0] == 0 and fpr[-1] == tpr[-1] == 1
+        for threshold, x, z in zip(thresholds, fpr, tpr):
+            passed = scores[0] >= threshold
+            assert numpy.allclose(x, numpy.sum(weights[passed & (y == 0)]) / numpy.sum(weights[y == 0]))
+            assert numpy.allclose(z, numpy.sum(weights[passed & (y == 1)]) / numpy.sum(weights[y == 1]))
+        area = numpy.sum(numpy.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2.)
+        assert numpy.allclose(area, roc_auc_score(y, scores[0], sample_weight=weights))
+
+        fpr, tpr = downsampled_roc_curve(y, scores[0], sample_weight=weights, n_points=100)
+        assert len(fpr) == len(tpr) == 100
+        assert numpy.all(numpy.diff(fpr) >= 0) and numpy.all(numpy.diff(tpr) >= 0)
+
+
+def test_staged_roc_auc(n_samples=1000, n_stages=20):
+    for n_values in [None, 4]:
+        y, weights, scores = generate_predictions(n_samples, n_stages=n_stages, n_values=n_values)
+        expected = [roc_auc_score(y, score, sample_weight=weights) for score in scores]
+        assert numpy.allclose(staged_roc_auc(y, scores, sample_weight=weights), expected)
+        assert numpy.allclose(staged_roc_auc(y, scores, sample_weight=weights, block_size=3), expected)
+        # passing generator
+        assert numpy.allclose(staged_roc_auc(y, iter(scores), sample_weight=weights, block_size=7), expected)
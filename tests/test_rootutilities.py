@@ -0,0 +1,117 @@
+from __future__ import division, print_function, absolute_import
+
+import os
+import shutil
+import tempfile
+import numpy
+import pandas
+from hep_ml.rootutilities import read_trees, tree2pandas, list_flat_branches, NumpyFileReader, NtupleCache
+
+__author__ = 'Alex Rogozhnikov'
+
+
+def generate_ntuples(directory, n_files=3, n_events=1000):
+    """Writes structured arrays, which are used instead of ROOT trees"""
+    filenames = []
+    for i in range(n_files):
+        data = numpy.zeros(n_events + i, dtype=[('mass', 'f8'), ('pt', 'f8'), ('n_tracks', 'i4')])
+        data['mass'] = numpy.random.normal(size=len(data)) * 100 + 1000
+        data['pt'] = numpy.random.exponential(size=len(data))
+        data['pt'][::10] = 1e40
+        data['n_tracks'] = numpy.random.randint(0, 10, size=len(data))
+        filenames.append(os.path.join(directory, 'ntuple_{}.npy'.format(i)))
+        numpy.save(filenames[-1], data)
+    return filenames
+
+
+def test_read_trees():
+    directory = tempfile.mkdtemp()
+    try:
+        filenames = generate_ntuples(directory)
+        reader = NumpyFileReader()
+        full = pandas.concat([pandas.DataFrame(numpy.load(filename)) for filename in filenames], ignore_index=True)
+        full = numpy.clip(full, -1e33, 1e33).astype('float32')
+        assert list_flat_branches(filenames[0], 'tree', reader=reader) == ['mass', 'pt', 'n_tracks']
+
+        for n_jobs in [1, 2]:
+            for output in [None, os.path.join(directory, 'output_{}'.format(n_jobs))]:
+                for selection in [None, 'n_tracks > 4']:
+                    expected = full if selection is None else full[full.n_tracks > 4]
+                    data = read_trees(filenames, 'tree', branches=['pt', 'mass'], selection=selection, chunk_size=300,
+                                      n_jobs=n_jobs, directory=output, reader=reader)
+                    assert data.columns == ['pt', 'mass']
+                    assert data['pt'].dtype == numpy.float32
+                    assert numpy.all(data.values == expected[['pt', 'mass']].values)
+                    if output is not None:
+                        # temporary files used to collect selected events are removed
+                        assert sorted(os.listdir(output)) == ['column_0.npy', 'column_1.npy', 'columns.json']
+
+        data = read_trees(filenames[0], 'tree', reader=reader)
+        assert data.columns == ['mass', 'pt', 'n_tracks']
+        dataframe = tree2pandas(filenames[0], 'tree', start=10, stop=100, reader=reader)
+        expected = numpy.clip(pandas.DataFrame(numpy.load(filenames[0])[10:100]), -1e33, 1e33)
+        assert numpy.all(dataframe.values == expected.values)
+        assert dataframe['n_tracks'].dtype == numpy.int32
+    finally:
+        shutil.rmtree(directory)
+
+
+class ConcurrentReader(NumpyFileReader):
+    """While the ntuple is being converted, the same ntuple is cached by other cache (as other process would do)"""
+    def __init__(self, cache_directory, filenames):
+        self.cache_directory = cache_directory
+        self.filenames = filenames
+        self.cached = False
+
+    def read(self, *args, **kwargs):
+        if not self.cached:
+            self.cached = True
+            NtupleCache(self.cache_directory, reader=NumpyFileReader()).load(self.filenames, 'tree')
+        return NumpyFileReader.read(self, *args, **kwargs)
+
+
+def test_ntuple_cache():
+    directory = tempfile.mkdtemp()
+    try:
+        filenames = generate_ntuples(directory, n_files=2)
+        cache = NtupleCache(os.path.join(directory, 'cache'), reader=NumpyFileReader())
+        expected = read_trees(filenames, 'tree', reader=NumpyFileReader())
+        for _ in range(3):
+            data = cache.load(filenames, 'tree', chunk_size=300)
+            assert isinstance(data['mass'], numpy.memmap)
+            assert numpy.all(data.values == expected.values)
+        cache.load(filenames, 'tree', branches=['mass'], selection='n_tracks > 4')
+        assert (cache.n_hits, cache.n_misses) == (2, 2)
+        assert list(cache.report()['hit']) == [False, True, True, False]
+
+        # file modification invalidates cache
+        os.utime(filenames[0], (0, 0))
+        cache.load(filenames, 'tree')
+        assert cache.n_misses == 3
+
+        # eviction of least recently used entries, the last loaded ntuple is kept
+        assert len(os.listdir(cache.cache_directory)) == 3
+        cache.max_size = 1
+        cache.load(filenames[:1], 'tree')
+        assert len(os.listdir(cache.cache_directory)) == 1
+        assert cache.load(filenames[:1], 'tree').shape == (1000, 3)
+        assert (cache.n_hits, cache.n_misses) == (3, 4)
+        cache.clear()
+        assert cache.size == 0
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_concurrent_caching():
+    directory = tempfile.mkdtemp()
+    try:
+        filenames = generate_ntuples(directory, n_files=2)
+        cache_directory = os.path.join(directory, 'cache')
+        cache = NtupleCache(cache_directory, reader=ConcurrentReader(cache_directory, filenames))
+        data = cache.load(filenames, 'tree')
+        assert cache.reader.cached and cache.n_misses == 1
+        assert numpy.all(data.values == read_trees(filenames, 'tree', reader=NumpyFileReader()).values)
+        # only the entry is left, temporary directory is removed
+        assert len(os.listdir(cache_directory)) == 1
+    finally:
+        shutil.rmtree(directory)
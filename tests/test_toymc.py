@@ -1,5 +1,6 @@
 from __future__ import division, print_function, absolute_import
 
+import multiprocessing
 import numpy
 import pandas
 from matplotlib.cbook import Null
@@ -19,3 +20,117 @@ def test_compare_toymc():
     if __name__ != '__main__':
         toymc.pylab = Null()
     toymc.compare_toymc(pandas.DataFrame(numpy.random.normal(size=(1000, 10))))
+
+
+def test_second_events(size=300, knn=5):
+    data = numpy.random.normal(size=(size, 3))
+    secondary_weights = numpy.random.random(size)
+    for symmetrize in [False, True]:
+        neighbourhoods = toymc.compute_neighbourhoods(data, knn=knn, symmetrize=symmetrize)
+        rows = [neighbourhoods.indices[neighbourhoods.indptr[i]:neighbourhoods.indptr[i + 1]] for i in range(size)]
+
+        probabilities = numpy.zeros(size)
+        for neighbours in rows:
+            probabilities[neighbours] += secondary_weights[neighbours] / numpy.sum(secondary_weights[neighbours])
+        assert numpy.allclose(probabilities / size,
+                              toymc.count_probabilities(numpy.ones(size), secondary_weights, neighbourhoods))
+
+        tables = toymc.compute_cumulative_tables(neighbourhoods, secondary_weights)
+        first = numpy.repeat([0, 1], 20000)
+        second = toymc.choose_second_events(neighbourhoods, tables, first, numpy.random.RandomState(42))
+        for i in [0, 1]:
+            expected = secondary_weights[rows[i]] / numpy.sum(secondary_weights[rows[i]])
+            frequencies = numpy.array([numpy.mean(second[first == i] == j) for j in rows[i]])
+            assert numpy.allclose(frequencies, expected, atol=0.02)
+
+
+def test_toymc_chunks(size=1000):
+    import shutil
+    import tempfile
+    df = pandas.DataFrame(numpy.random.normal(size=(size, 3)), columns=['a', 'b', 'c'])
+    chunks = list(toymc.generate_toymc_chunks(df, 2500, chunk_size=1000, random_seed=13))
+    assert [len(chunk) for chunk in chunks] == [1000, 1000, 500]
+    model = toymc.NeighbourModel().fit(df)
+    assert numpy.allclose(model.sample_chunk(500, random_seed=13, chunk=2), chunks[2].values)
+
+    result = pandas.concat(chunks)
+    assert numpy.allclose(result.mean(), df.mean(), atol=0.1)
+    assert numpy.allclose(result.std(), df.std(), atol=0.1)
+
+    directory = tempfile.mkdtemp()
+    try:
+        written = toymc.write_toymc(directory, df, 2500, chunk_size=1000, random_seed=13)
+        assert written.shape == (2500, 3)
+        assert numpy.allclose(written.values, result.values, atol=1e-5)
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_toymc_generator(size=1000):
+    import os
+    import tempfile
+    df = pandas.DataFrame(numpy.random.normal(size=(size, 3)), columns=['a', 'b', 'c'])
+    df['n_jets'] = numpy.random.randint(0, 3, size=size)
+    df['tiny'] = 0
+    df.loc[:1, 'tiny'] = 1
+    generator = toymc.ToyMCGenerator(clustering_features=['n_jets', 'tiny'], integer_features=['c']).fit(df)
+    assert generator.n_copied_groups >= 1
+    result = generator.sample(3000, random_seed=42)
+    assert list(result.columns) == list(df.columns) and len(result) == 3000
+    assert result['n_jets'].dtype == df['n_jets'].dtype
+    assert result['c'].dtype.kind == 'i'
+    expected_sizes = df.groupby(['n_jets', 'tiny']).size() * 3
+    assert numpy.all(numpy.abs(result.groupby(['n_jets', 'tiny']).size() - expected_sizes) <= 1)
+    # events of tiny groups are copies
+    tiny = result[result.tiny == 1]
+    assert numpy.all(numpy.in1d(tiny['a'], df['a']))
+    assert numpy.allclose(result['a'].mean(), df['a'].mean(), atol=0.1)
+
+    chunks = list(generator.sample_chunks(2500, chunk_size=1000, random_seed=7))
+    assert [len(chunk) for chunk in chunks] == [1000, 1000, 500]
+
+    filename = tempfile.mktemp()
+    try:
+        generator.save(filename)
+        restored = toymc.ToyMCGenerator.load(filename)
+        assert numpy.all(restored.sample(3000, random_seed=42).values == result.values)
+        assert numpy.all(list(restored.sample_chunks(2500, chunk_size=1000, random_seed=7))[2].values ==
+                         chunks[2].values)
+    finally:
+        os.remove(filename)
+
+
+def test_parallel_toymc_generator(size=2000):
+    df = pandas.DataFrame(numpy.random.normal(size=(size, 3)), columns=['a', 'b', 'c'])
+    df['n_jets'] = numpy.random.poisson(1, size=size)
+    results = []
+    for n_jobs in [1, 3]:
+        generator = toymc.ToyMCGenerator(clustering_features=['n_jets'], n_jobs=n_jobs).fit(df)
+        results.append(generator.sample(5000, random_seed=42))
+        assert len(results[-1]) == 5000
+    assert numpy.all(results[0].values == results[1].values)
+
+
+def test_parallel_toymc_chunks(size=2000):
+    df = pandas.DataFrame(numpy.random.normal(size=(size, 2)), columns=['a', 'b'])
+    df['n_jets'] = numpy.random.poisson(1, size=size)
+    pools = []
+    original_pool = multiprocessing.Pool
+
+    def counting_pool(*args, **kwargs):
+        pools.append(original_pool(*args, **kwargs))
+        return pools[-1]
+
+    results = []
+    for n_jobs in [1, 2]:
+        generator = toymc.ToyMCGenerator(clustering_features=['n_jets'], n_jobs=n_jobs).fit(df)
+        multiprocessing.Pool = counting_pool
+        try:
+            results.append(list(generator.sample_chunks(2500, chunk_size=1000, random_seed=3)))
+        finally:
+            multiprocessing.Pool = original_pool
+    # processes are forked once for all chunks
+    assert len(pools) == 1
+    assert [len(chunk) for chunk in results[1]] == [1000, 1000, 500]
+    for chunk1, chunk2 in zip(*results):
+        assert numpy.all(chunk1.values == chunk2.values)
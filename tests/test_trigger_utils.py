@@ -0,0 +1,59 @@
+from __future__ import division, print_function, absolute_import
+
+import numpy
+import pandas
+from sklearn.ensemble import GradientBoostingClassifier
+from hep_ml.commonutils import generate_sample
+from hep_ml.columnar import ColumnarDataset
+from hep_ml.trigger_utils import EventScoreAccumulator, compute_event_scores, predict_event_scores, \
+    efficiency_vs_rate
+
+__author__ = 'Alex Rogozhnikov'
+
+
+def test_event_scores(n_candidates=10000, n_events=1000):
+    event_ids = numpy.random.randint(0, n_events, size=n_candidates) * 7
+    scores = numpy.random.random(n_candidates)
+    labels = (event_ids % 2).astype(int)
+    expected = pandas.DataFrame({'score': scores, 'label': labels}).groupby(event_ids).max()
+
+    result = compute_event_scores(event_ids, scores, labels=labels)
+    assert numpy.all(result.index == expected.index)
+    assert numpy.all(result['score'] == expected['score'])
+    assert numpy.all(result['label'] == expected['label'])
+
+    # events are split between parts
+    accumulator = EventScoreAccumulator(compaction_size=500)
+    for start in range(0, n_candidates, 300):
+        accumulator.add(event_ids[start:start + 300], scores[start:start + 300], labels=labels[start:start + 300])
+    streamed = accumulator.compute()
+    assert numpy.all(streamed.index == expected.index)
+    assert numpy.all(streamed['score'] == expected['score'])
+
+
+def test_efficiency_vs_rate(n_events=1000):
+    event_scores = pandas.DataFrame({'score': numpy.random.random(n_events), 'weight': numpy.ones(n_events),
+                                     'label': numpy.random.randint(0, 2, size=n_events)})
+    rates = [0., 0.01, 0.1, 0.5, 1.]
+    result = efficiency_vs_rate(event_scores, rates)
+    signal = event_scores[event_scores.label == 1]
+    background = event_scores[event_scores.label == 0]
+    for rate, threshold, efficiency in result.values:
+        passed_background = numpy.mean(background.score > threshold)
+        assert numpy.allclose(rate, passed_background)
+        assert passed_background <= rate + 1e-10
+        assert numpy.allclose(efficiency, numpy.mean(signal.score > threshold))
+    assert numpy.allclose(result['rate'], rates, atol=2. / len(background))
+    assert result['efficiency'].values[-1] == 1
+
+
+def test_predict_event_scores(n_candidates=3000):
+    X, y = generate_sample(n_candidates, 5)
+    event_ids = numpy.arange(n_candidates) // 3
+    clf = GradientBoostingClassifier(n_estimators=10).fit(X, y)
+    expected = compute_event_scores(event_ids, clf.predict_proba(X)[:, 1], labels=y)
+    for data in [X, ColumnarDataset.from_dataframe(X, dtype=None), X.values]:
+        result = predict_event_scores(clf, data, event_ids, labels=y, chunk_size=1000)
+        assert numpy.allclose(result.values, expected.values)
+    curve = efficiency_vs_rate(result, [0.1, 0.5])
+    assert numpy.all(curve['efficiency'] > curve['rate'])
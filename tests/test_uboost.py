@@ -149,3 +149,17 @@ def check_classifiers(n_samples=10000, output_name_pattern=None):
     if output_name_pattern is not None:
         pl.savefig(output_name_pattern % "efficiency_curves", bbox="tight")
 
+
+
+def test_warm_start(n_samples=1000):
+    trainX, trainY = generate_sample(n_samples, 10, 0.6)
+    options = dict(uniform_variables=['column0'], n_neighbors=20, random_state=42,
+                   base_estimator=DecisionTreeClassifier(max_depth=3))
+    uBDT = uBoostBDT(n_estimators=5, warm_start=True, **options).fit(trainX, trainY)
+    uBDT.n_estimators = 15
+    uBDT.fit(trainX, trainY)
+    full = uBoostBDT(n_estimators=15, **options).fit(trainX, trainY)
+    assert len(uBDT.estimators_) == 15
+    assert np.allclose(uBDT.score_cuts_, full.score_cuts_)
+    assert np.allclose(uBDT.score_cut, full.score_cut)
+    assert np.allclose(uBDT.predict_score(trainX), full.predict_score(trainX))
@@ -83,3 +83,113 @@ def test_gradient_boosting(n_samples=1000):
 
 # TODO test that in the bins/groups we have only events of the needed class
 
+
+
+def test_warm_start(n_samples=1000):
+    trainX, trainY = generate_sample(n_samples, 10, distance=0.6)
+    for loss in [BinomialDevianceLossFunction(), KnnFlatnessLossFunction(['column0'], ada_coefficient=0.5)]:
+        clf = uGradientBoostingClassifier(loss=loss, n_estimators=5, subsample=0.7, random_state=42, warm_start=True)
+        clf.fit(trainX, trainY)
+        clf.n_estimators = 12
+        clf.fit(trainX, trainY)
+        assert len(clf.estimators) == 12
+        full = uGradientBoostingClassifier(loss=loss, n_estimators=12, subsample=0.7, random_state=42)
+        full.fit(trainX, trainY)
+        assert numpy.allclose(clf.predict_proba(trainX), full.predict_proba(trainX))
+        assert full._train_score is None
+
+
+def test_out_of_core(n_samples=2000):
+    import tempfile
+    import shutil
+    from hep_ml.columnar import ColumnarDataset
+    trainX, trainY = generate_sample(n_samples, 10, distance=0.6)
+    testX, testY = generate_sample(n_samples, 10, distance=0.6)
+    directory = tempfile.mkdtemp()
+    try:
+        dataset = ColumnarDataset.from_dataframe(trainX, directory=directory)
+        for loss in [BinomialDevianceLossFunction(), BinFlatnessLossFunction(['column0'], ada_coefficient=0.5)]:
+            clf = uGradientBoostingClassifier(loss=loss, n_estimators=20, max_depth=4, block_size=500, chunk_size=300,
+                                              learning_rate=0.2, train_variables=list(trainX.columns[1:]))
+            clf.fit(dataset, trainY)
+            assert clf._train_score is None
+            assert clf.score(testX, testY) > 0.7
+            staged = list(clf.staged_predict_score(testX))[-1]
+            assert numpy.allclose(staged, clf.predict_score(testX), atol=1e-5)
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_float32_mode(n_samples=1000):
+    from hep_ml.losses import AdaLossFunction
+    trainX, trainY = generate_sample(n_samples, 10, distance=0.6)
+    for loss in [AdaLossFunction(), BinomialDevianceLossFunction(),
+                 BinFlatnessLossFunction(['column0'], ada_coefficient=0.5)]:
+        probas = []
+        for dtype in [numpy.float64, numpy.float32]:
+            clf = uGradientBoostingClassifier(loss=loss, n_estimators=10, subsample=0.7, random_state=42,
+                                              warm_start=True, dtype=dtype)
+            clf.fit(trainX, trainY)
+            assert clf._train_score.dtype == dtype
+            assert clf.loss.negative_gradient(clf._train_score).dtype == dtype
+            probas.append(clf.predict_proba(trainX))
+        # trees may choose different splits in rare cases of almost equal gains
+        assert numpy.mean(numpy.abs(probas[0] - probas[1])) < 1e-2
+
+    # positions are accumulated in float64
+    size = 10 ** 6
+    positions = compute_positions(numpy.arange(size), numpy.ones(size, dtype=numpy.float32))
+    assert positions.dtype == numpy.float32
+    assert numpy.allclose(positions, (numpy.arange(size) + 0.5) / size, atol=1e-6)
+
+
+def test_matrix_loss_cache(n_samples=1000):
+    X, y = generate_sample(n_samples, 10)
+    pred = numpy.random.normal(size=n_samples)
+    gradients = []
+    for n_threads in [1, 3]:
+        loss = SimpleKnnLossFunction(['column0'], knn=5, n_threads=n_threads).fit(X, y, sample_weight=None)
+        A = loss.A.tocsr()
+        exponents = loss.w * numpy.exp(- A.dot(loss.y_signed * pred))
+        assert numpy.allclose(loss(pred), numpy.sum(exponents))
+        assert numpy.allclose(loss.compute_exponents(pred), exponents)
+        gradients.append(loss.negative_gradient(pred))
+        assert numpy.allclose(gradients[-1], A.T.dot(exponents) * loss.y_signed)
+        # predictions changed in place
+        pred[:10] += 1.
+        assert not numpy.allclose(loss(pred), numpy.sum(exponents))
+        pred[:10] -= 1.
+    assert numpy.allclose(gradients[0], gradients[1])
+    check_gradient(SimpleKnnLossFunction(['column0'], knn=5), size=200)
+
+
+def test_compact_sparse_matrix(n_rows=1000, n_columns=300):
+    from hep_ml.losses import CompactSparseMatrix
+    row_lengths = numpy.random.poisson(3, size=n_rows)
+    indptr = numpy.append(0, numpy.cumsum(row_lengths))
+    indices = numpy.random.randint(0, n_columns, size=indptr[-1]).astype(numpy.int32)
+    matrix = CompactSparseMatrix(indptr, indices, numpy.random.random(n_rows), n_columns, chunk_size=100)
+    csr = matrix.tocsr()
+    vector = numpy.random.normal(size=n_columns)
+    for n_threads in [1, 3]:
+        assert numpy.allclose(matrix.dot(vector, n_threads=n_threads), csr.dot(vector))
+    vector = numpy.random.normal(size=n_rows)
+    assert numpy.allclose(matrix.transpose_dot(vector), csr.T.dot(vector))
+
+    # rows of knn loss contain neighbours of event
+    from hep_ml.commonutils import computeSignalKnnIndices
+    X, y = generate_sample(n_rows, 10)
+    loss = SimpleKnnLossFunction(['column0', 'column1'], knn=5)
+    A, w = loss.compute_parameters(X, y, chunk_size=77)
+    assert A.indices.dtype == numpy.int32 and A.shape == (n_rows, n_rows)
+    knn_indices = computeSignalKnnIndices(['column0', 'column1'], X, y == 1, n_neighbors=5)[y == 1]
+    assert numpy.all(A.indices[:A.indptr[numpy.sum(y == 1)]] == knn_indices.ravel())
+    assert numpy.all(A.indices[A.indptr[numpy.sum(y == 1)]:] == numpy.flatnonzero(y == 0))
+
+    # compact matrix gives the same loss and gradients as CSR matrix
+    pred = numpy.random.normal(size=n_rows)
+    losses = [SimpleKnnLossFunction(['column0', 'column1'], knn=5, compact_matrix=compact).fit(X, y, None)
+              for compact in [False, True]]
+    assert isinstance(losses[1].A, CompactSparseMatrix) and not isinstance(losses[0].A, CompactSparseMatrix)
+    assert numpy.allclose(losses[0](pred), losses[1](pred))
+    assert numpy.allclose(losses[0].negative_gradient(pred), losses[1].negative_gradient(pred))